@@ -1,10 +1,10 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, jsonify, send_file
 import pandas as pd
 import os
 import json
-import re
 from datetime import datetime
 import sqlite3
+import tempfile
 import threading
 import time
 from werkzeug.utils import secure_filename
@@ -13,18 +13,21 @@ from werkzeug.utils import secure_filename
 from whatsapp.zapi_client import ZAPIClient
 from whatsapp.templates import TEMPLATES, formatar_mensagem, listar_templates
 
+# Pool de conexões SQLite e fila de escrita única
+from database import (get_pool, get_writer, InvalidCursor, encode_cursor, decode_cursor, decode_offset_cursor,
+                      keyset_where, next_cursor, sort_key)
+from database.stats import StatsReconciler, lead_stats, message_stats
+from database.search import lead_search
+from database.phones import normalize_phone_series
+from database.cache import ResponseCache
+from database.export import InvalidColumns, iter_csv, parquet_available, select_columns, write_parquet
+from database.importer import ImportJobs, import_file, insert_leads, iter_chunks, save_upload, update_status_by_phone
+from database.migrations import run_migrations
+from database.campaigns import (CampaignEngine, campaign_summary, campaign_results, list_campaigns,
+                                latest_campaign_id, recent_results)
+
 app = Flask(__name__)
 
-# Variável global para controle de envio em massa
-envio_em_andamento = {
-    'ativo': False,
-    'total': 0,
-    'enviados': 0,
-    'sucesso': 0,
-    'falha': 0,
-    'cancelado': False,
-    'resultados': []
-}
 app.secret_key = 'sua_chave_secreta_aqui'
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(__file__), 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
@@ -32,28 +35,20 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
 # Criar pasta de uploads se não existir
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-def normalizar_telefone(telefone):
-    """Remove todos os caracteres não numéricos do telefone para comparação"""
-    if not telefone:
-        return ''
-    # Remove tudo que não é dígito
-    apenas_numeros = re.sub(r'\D', '', str(telefone))
-    # Se começar com 55 e tiver mais de 11 dígitos, remove o 55
-    if apenas_numeros.startswith('55') and len(apenas_numeros) > 11:
-        apenas_numeros = apenas_numeros[2:]
-    # Se tiver 11 dígitos e o primeiro for 0, remove o 0
-    if len(apenas_numeros) == 11 and apenas_numeros.startswith('0'):
-        apenas_numeros = apenas_numeros[1:]
-    return apenas_numeros
-
 # Caminho para os arquivos Excel
 EXCEL_FOLDER = r"C:\Users\kaleb\Desktop\CONTATOS SMART REFORÇO"
 DB_PATH = os.path.join(os.path.dirname(__file__), 'leads.db')
 
+# Conexões reaproveitadas (WAL + busy_timeout) e escritas pesadas serializadas
+db_pool = get_pool(DB_PATH)
+db_writer = get_writer(DB_PATH)
+stats_reconciler = StatsReconciler(db_writer)
+response_cache = ResponseCache()
+import_jobs = ImportJobs(db_writer, on_change=lambda: response_cache.invalidate('cidades'))
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Obtém uma conexão do pool (conn.close() devolve a conexão ao pool)"""
+    return db_pool.acquire()
 
 def init_db():
     conn = get_db()
@@ -155,56 +150,28 @@ def init_db():
         ''')
     
     conn.commit()
+    
+    # Índices e alterações de schema versionadas
+    run_migrations(conn)
     conn.close()
 
+def excel_sources():
+    """Planilhas da pasta EXCEL_FOLDER com a cidade (nome do arquivo) como padrão"""
+    return [(os.path.join(EXCEL_FOLDER, arquivo), {'cidade': arquivo.replace('.xlsx', '')})
+            for arquivo in sorted(os.listdir(EXCEL_FOLDER)) if arquivo.endswith('.xlsx')]
+
 def importar_excel():
-    """Importa todos os arquivos Excel para o banco de dados"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
+    """Importa todos os arquivos Excel para o banco de dados (cidade = nome do arquivo)"""
     total_importados = 0
     
-    for arquivo in os.listdir(EXCEL_FOLDER):
-        if arquivo.endswith('.xlsx'):
-            cidade = arquivo.replace('.xlsx', '')
-            caminho = os.path.join(EXCEL_FOLDER, arquivo)
-            
-            try:
-                df = pd.read_excel(caminho)
-                
-                # Mapear colunas
-                colunas_map = {
-                    'qBF1Pd': 'nome',
-                    'UsdlK': 'telefone',
-                    'W4Efsd 3': 'endereco',
-                    'W4Efsd': 'tipo_servico',
-                    'MW4etd': 'avaliacao',
-                    'hfpxzc href': 'link_maps'
-                }
-                
-                for _, row in df.iterrows():
-                    nome = str(row.get('qBF1Pd', '')) if pd.notna(row.get('qBF1Pd')) else ''
-                    telefone = str(row.get('UsdlK', '')) if pd.notna(row.get('UsdlK')) else ''
-                    endereco = str(row.get('W4Efsd 3', '')) if pd.notna(row.get('W4Efsd 3')) else ''
-                    tipo_servico = str(row.get('W4Efsd', '')) if pd.notna(row.get('W4Efsd')) else ''
-                    avaliacao = str(row.get('MW4etd', '')) if pd.notna(row.get('MW4etd')) else ''
-                    link_maps = str(row.get('hfpxzc href', '')) if pd.notna(row.get('hfpxzc href')) else ''
-                    
-                    if telefone and telefone != 'nan':
-                        try:
-                            cursor.execute('''
-                                INSERT OR IGNORE INTO leads 
-                                (nome, telefone, endereco, cidade, tipo_servico, avaliacao, link_maps)
-                                VALUES (?, ?, ?, ?, ?, ?, ?)
-                            ''', (nome, telefone, endereco, cidade, tipo_servico, avaliacao, link_maps))
-                            total_importados += cursor.rowcount
-                        except:
-                            pass
-            except Exception as e:
-                print(f"Erro ao importar {arquivo}: {e}")
+    for caminho, defaults in excel_sources():
+        try:
+            # Lido em blocos; cada bloco é gravado por um job da fila de escrita
+            relatorio = import_file(caminho, lambda p: db_writer.run(insert_leads, p), defaults)
+            total_importados += relatorio['importados']
+        except Exception as e:
+            print(f"Erro ao importar {os.path.basename(caminho)}: {e}")
     
-    conn.commit()
-    conn.close()
     return total_importados
 
 @app.route('/')
@@ -214,36 +181,39 @@ def index():
 @app.route('/api/stats')
 def get_stats():
     conn = get_db()
-    cursor = conn.cursor()
-    
-    # Total de leads
-    cursor.execute('SELECT COUNT(*) as total FROM leads')
-    total = cursor.fetchone()['total']
-    
-    # Por status
-    cursor.execute('SELECT status, COUNT(*) as count FROM leads GROUP BY status')
-    status_counts = {row['status']: row['count'] for row in cursor.fetchall()}
-    
-    # Por cidade (top 10)
-    cursor.execute('SELECT cidade, COUNT(*) as count FROM leads GROUP BY cidade ORDER BY count DESC LIMIT 10')
-    por_cidade = [{'cidade': row['cidade'], 'count': row['count']} for row in cursor.fetchall()]
-    
-    # Total de cidades
-    cursor.execute('SELECT COUNT(DISTINCT cidade) as total FROM leads')
-    total_cidades = cursor.fetchone()['total']
     
+    # Contadores mantidos por trigger (stats_contadores), sem varrer leads
+    stats = lead_stats(conn)
+    status_counts = stats['por_status']
     conn.close()
     
     return jsonify({
-        'total': total,
+        'total': stats['total'],
         'novo': status_counts.get('novo', 0),
         'em_contato': status_counts.get('em_contato', 0),
         'convertido': status_counts.get('convertido', 0),
         'perdido': status_counts.get('perdido', 0),
-        'por_cidade': por_cidade,
-        'total_cidades': total_cidades
+        'por_cidade': stats['por_cidade'],
+        'total_cidades': stats['total_cidades']
+    })
+
+@app.route('/api/db/metrics')
+def get_db_metrics():
+    """Métricas do pool de conexões e da fila de escrita"""
+    return jsonify({
+        'pool': db_pool.get_stats(),
+        'writer': db_writer.get_stats(),
+        'stats_reconciler': stats_reconciler.get_stats(),
+        'campaigns': campaign_engine.get_stats(),
+        'imports': import_jobs.get_stats(),
+        'response_cache': response_cache.get_stats()
     })
 
+@app.route('/api/stats/reconcile', methods=['POST'])
+def reconcile_stats():
+    """Recalcula os contadores do dashboard do zero e informa as divergências"""
+    return jsonify(stats_reconciler.run_now())
+
 @app.route('/api/leads')
 def get_leads():
     conn = get_db()
@@ -257,10 +227,28 @@ def get_leads():
     
     offset = (page - 1) * per_page
     
-    query = 'SELECT * FROM leads WHERE 1=1'
-    params = []
+    # Busca full-text (FTS5) ordenada por relevância; LIKE se o índice não existir
+    busca = lead_search(conn, search) if search else None
+    
+    # Cursor da página anterior (tem prioridade sobre page)
+    try:
+        if busca:
+            after = decode_offset_cursor(request.args.get('cursor'), 'leads_busca')
+        else:
+            after = decode_cursor(request.args.get('cursor'), 'leads_atualizados', size=2)
+    except InvalidCursor as e:
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    
+    if busca:
+        busca_sql, params = busca
+        # CROSS JOIN fixa o FTS como laço externo (senão o SQLite pode varrer leads pelo índice de status)
+        query = f'SELECT leads.* FROM ({busca_sql}) busca CROSS JOIN leads ON leads.id = busca.id WHERE 1=1'
+    else:
+        query = 'SELECT leads.* FROM leads WHERE 1=1'
+        params = []
     
-    if search:
+    if search and not busca:
         query += ' AND (nome LIKE ? OR telefone LIKE ? OR endereco LIKE ?)'
         search_param = f'%{search}%'
         params.extend([search_param, search_param, search_param])
@@ -274,16 +262,31 @@ def get_leads():
         params.append(status)
     
     # Contar total
-    count_query = query.replace('SELECT *', 'SELECT COUNT(*) as total')
+    count_query = query.replace('SELECT leads.*', 'SELECT COUNT(*) as total', 1)
     cursor.execute(count_query, params)
     total = cursor.fetchone()['total']
     
     # Buscar leads
-    query += ' ORDER BY updated_at DESC LIMIT ? OFFSET ?'
-    params.extend([per_page, offset])
-    
-    cursor.execute(query, params)
-    leads = [dict(row) for row in cursor.fetchall()]
+    if busca:
+        # Resultado da busca ordenado por relevância: o cursor guarda o deslocamento
+        offset = after if after is not None else offset
+        query += ' ORDER BY busca.rank, leads.id LIMIT ? OFFSET ?'
+        params.extend([per_page, offset])
+        cursor.execute(query, params)
+        leads = [dict(row) for row in cursor.fetchall()]
+        cursor_proximo = encode_cursor('leads_busca', [offset + per_page]) if len(leads) == per_page else None
+    else:
+        sort_columns = ('updated_at', 'id')
+        if after is not None:
+            keyset, keyset_params = keyset_where(sort_columns, after)
+            query += f' AND {keyset} ORDER BY updated_at DESC, id DESC LIMIT ?'
+            params.extend(keyset_params + [per_page])
+        else:
+            query += ' ORDER BY updated_at DESC, id DESC LIMIT ? OFFSET ?'
+            params.extend([per_page, offset])
+        cursor.execute(query, params)
+        leads = [dict(row) for row in cursor.fetchall()]
+        cursor_proximo = next_cursor('leads_atualizados', leads, sort_columns, per_page)
     
     conn.close()
     
@@ -292,7 +295,8 @@ def get_leads():
         'total': total,
         'page': page,
         'per_page': per_page,
-        'total_pages': (total + per_page - 1) // per_page
+        'total_pages': (total + per_page - 1) // per_page,
+        'next_cursor': cursor_proximo
     })
 
 @app.route('/api/leads/<int:lead_id>')
@@ -369,6 +373,7 @@ def add_anotacao(lead_id):
     return jsonify({'success': True})
 
 @app.route('/api/cidades')
+@response_cache.cached('cidades', ttl=60)
 def get_cidades():
     conn = get_db()
     cursor = conn.cursor()
@@ -383,16 +388,78 @@ def get_cidades():
 @app.route('/api/importar', methods=['POST'])
 def importar():
     total = importar_excel()
+    response_cache.invalidate('cidades')
     return jsonify({'success': True, 'total_importados': total})
 
+@app.route('/api/import', methods=['POST'])
+def iniciar_importacao():
+    """
+    Importação em segundo plano, lida em blocos: o arquivo enviado (CSV/XLSX,
+    cidade opcional no form) ou, sem arquivo, as planilhas da pasta EXCEL_FOLDER.
+    Retorna o job_id para acompanhar em /api/import/<job_id>.
+    """
+    arquivo = request.files.get('arquivo') or request.files.get('file')
+    if arquivo is None or arquivo.filename == '':
+        fontes = excel_sources()
+        if not fontes:
+            return jsonify({'success': False, 'error': 'Nenhuma planilha na pasta de importação'}), 400
+        job_id = import_jobs.start(fontes)
+    else:
+        try:
+            caminho = save_upload(arquivo, app.config['UPLOAD_FOLDER'])
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        defaults = {'cidade': request.form['cidade']} if request.form.get('cidade') else {}
+        job_id = import_jobs.start([(caminho, defaults)], cleanup=True)
+    
+    return jsonify({'success': True, 'job_id': job_id}), 202
+
+@app.route('/api/import/<job_id>')
+def status_importacao(job_id):
+    """Progresso da importação (status, progresso em %, contadores e tempos)"""
+    job = import_jobs.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Importação não encontrada'}), 404
+    return jsonify(job)
+
+@app.route('/api/import/<job_id>/cancel', methods=['POST'])
+def cancelar_importacao(job_id):
+    """Interrompe a importação após o bloco atual (o que já foi gravado fica)"""
+    if import_jobs.get(job_id) is None:
+        return jsonify({'success': False, 'error': 'Importação não encontrada'}), 404
+    if not import_jobs.cancel(job_id):
+        return jsonify({'success': False, 'error': 'Importação já terminou'}), 409
+    return jsonify({'success': True, 'job_id': job_id})
+
 @app.route('/api/exportar')
 def exportar():
-    conn = get_db()
-    
+    """
+    Exporta os leads filtrados em streaming (lotes do cursor direto na resposta).
+
+    Query params:
+        cidade, status: filtros
+        colunas: lista separada por vírgula (padrão: todas)
+        formato: csv (padrão) ou parquet
+        gzip: 1 para comprimir (CSV em .csv.gz; Parquet com codec gzip)
+    """
     cidade = request.args.get('cidade', '')
     status = request.args.get('status', '')
+    formato = request.args.get('formato', 'csv').lower()
+    comprimir = request.args.get('gzip', '').lower() in ('1', 'true', 'sim')
+    
+    if formato not in ('csv', 'parquet'):
+        return jsonify({'success': False, 'error': 'Formato deve ser csv ou parquet'}), 400
+    if formato == 'parquet' and not parquet_available():
+        return jsonify({'success': False, 'error': 'Exportação Parquet requer o pacote pyarrow'}), 400
+    
+    conn = get_db()
+    try:
+        colunas = select_columns(conn, request.args.get('colunas'))
+    except InvalidColumns as e:
+        conn.close()
+        return jsonify({'success': False, 'error': str(e)}), 400
     
-    query = 'SELECT * FROM leads WHERE 1=1'
+    query = f"SELECT {', '.join(colunas)} FROM leads WHERE 1=1"
     params = []
     
     if cidade:
@@ -403,14 +470,45 @@ def exportar():
         query += ' AND status = ?'
         params.append(status)
     
-    df = pd.read_sql_query(query, conn, params=params)
-    conn.close()
+    query += ' ORDER BY id'
     
-    # Salvar como CSV
-    export_path = os.path.join(os.path.dirname(__file__), 'export_leads.csv')
-    df.to_csv(export_path, index=False, encoding='utf-8-sig')
+    if formato == 'parquet':
+        # Parquet precisa do rodapé no fim: arquivo temporário exclusivo da requisição
+        fd, export_path = tempfile.mkstemp(prefix='export_', suffix='.parquet', dir=app.config['UPLOAD_FOLDER'])
+        os.close(fd)
+        try:
+            write_parquet(conn.execute(query, params), colunas, export_path, compress=comprimir)
+        except Exception:
+            os.remove(export_path)
+            raise
+        finally:
+            conn.close()
+        response = send_file(export_path, as_attachment=True, download_name='leads_exportados.parquet',
+                             mimetype='application/vnd.apache.parquet')
+        response.call_on_close(lambda: os.remove(export_path))
+        return response
+    
+    def gerar():
+        # A conexão fica com a resposta até o último lote (ou até o cliente desistir)
+        try:
+            yield from iter_csv(conn.execute(query, params), colunas, compress=comprimir)
+        finally:
+            conn.close()
     
-    return send_file(export_path, as_attachment=True, download_name='leads_exportados.csv')
+    download_name = 'leads_exportados.csv.gz' if comprimir else 'leads_exportados.csv'
+    return Response(gerar(), mimetype='application/gzip' if comprimir else 'text/csv; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename={download_name}'})
+
+POSSIVEIS_COLUNAS_TELEFONE = ['telefone', 'phone', 'numero', 'número', 'celular', 'whatsapp', 'tel', 'fone', 'contato']
+
+def encontrar_coluna_telefone(colunas, preferida=''):
+    """Coluna escolhida pelo usuário, senão a primeira com nome de telefone, senão a primeira"""
+    if preferida and preferida in colunas:
+        return preferida
+    for col in colunas:
+        if any(nome in str(col).lower() for nome in POSSIVEIS_COLUNAS_TELEFONE):
+            return col
+    return colunas[0]
 
 @app.route('/api/atualizar-em-massa', methods=['POST'])
 def atualizar_em_massa():
@@ -426,111 +524,54 @@ def atualizar_em_massa():
     if arquivo.filename == '':
         return jsonify({'success': False, 'error': 'Nenhum arquivo selecionado'}), 400
     
-    # Salvar arquivo temporariamente
-    filename = secure_filename(arquivo.filename)
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    arquivo.save(filepath)
+    # Salvar arquivo temporariamente (nome único: uploads simultâneos não se sobrescrevem)
+    try:
+        filepath = save_upload(arquivo, app.config['UPLOAD_FOLDER'], ('.csv', '.xlsx', '.xls'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Formato de arquivo não suportado. Use CSV ou Excel.'}), 400
     
     try:
-        # Ler o arquivo (CSV ou Excel)
-        if filename.endswith('.csv'):
-            df = pd.read_csv(filepath, dtype=str)
-        elif filename.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(filepath, dtype=str)
-        else:
-            return jsonify({'success': False, 'error': 'Formato de arquivo não suportado. Use CSV ou Excel.'}), 400
-        
-        # Encontrar a coluna de telefone
+        # Ler o arquivo em blocos, guardando só a coluna de telefone
         telefone_col = None
-        
-        if coluna_telefone and coluna_telefone in df.columns:
-            telefone_col = coluna_telefone
-        else:
-            # Tentar encontrar automaticamente
-            possiveis_nomes = ['telefone', 'phone', 'numero', 'número', 'celular', 'whatsapp', 'tel', 'fone', 'contato']
-            for col in df.columns:
-                if any(nome in col.lower() for nome in possiveis_nomes):
-                    telefone_col = col
-                    break
-            
-            # Se não encontrou, usar a primeira coluna
+        telefones = []
+        for bloco, _ in iter_chunks(filepath):
             if telefone_col is None:
-                telefone_col = df.columns[0]
+                telefone_col = encontrar_coluna_telefone(bloco.columns, coluna_telefone)
+            originais = bloco[telefone_col].fillna('').astype(str)
+            telefones.append(pd.DataFrame({'norm': normalize_phone_series(originais), 'original': originais}))
         
-        # Extrair telefones da planilha e normalizar
-        telefones_planilha = {}
-        for idx, row in df.iterrows():
-            tel_original = str(row[telefone_col]) if pd.notna(row[telefone_col]) else ''
-            tel_normalizado = normalizar_telefone(tel_original)
-            if tel_normalizado:
-                telefones_planilha[tel_normalizado] = tel_original
+        if telefone_col is None:
+            return jsonify({'success': False, 'error': 'Planilha vazia'}), 400
+        telefones = pd.concat(telefones, ignore_index=True)
+        validos = telefones['norm'].notna()
+        telefones_invalidos = telefones.loc[~validos & (telefones['original'].str.strip() != ''), 'original']
+        telefones_validos = telefones[validos].drop_duplicates('norm')
         
-        # Buscar todos os leads e criar índice normalizado
-        conn = get_db()
-        cursor = conn.cursor()
+        # Match e atualização com operações de conjunto (telefone_norm indexado)
+        resultado = db_writer.run(update_status_by_phone, telefones_validos, novo_status)
         
-        cursor.execute('SELECT id, telefone, status FROM leads')
-        leads = cursor.fetchall()
-        
-        # Criar mapeamento de telefone normalizado -> lead_id
-        leads_por_telefone = {}
-        for lead in leads:
-            tel_normalizado = normalizar_telefone(lead['telefone'])
-            if tel_normalizado:
-                leads_por_telefone[tel_normalizado] = {
-                    'id': lead['id'],
-                    'telefone_original': lead['telefone'],
-                    'status_anterior': lead['status']
-                }
-        
-        # Fazer o match e atualizar
-        atualizados = []
-        nao_encontrados = []
-        
-        for tel_normalizado, tel_original in telefones_planilha.items():
-            if tel_normalizado in leads_por_telefone:
-                lead_info = leads_por_telefone[tel_normalizado]
-                
-                # Atualizar status
-                cursor.execute('''
-                    UPDATE leads SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
-                ''', (novo_status, lead_info['id']))
-                
-                # Registrar no histórico
-                cursor.execute('''
-                    INSERT INTO historico (lead_id, acao, descricao)
-                    VALUES (?, 'status_change', ?)
-                ''', (lead_info['id'], f'Status alterado de "{lead_info["status_anterior"]}" para "{novo_status}" (atualização em massa)'))
-                
-                atualizados.append({
-                    'telefone_planilha': tel_original,
-                    'telefone_sistema': lead_info['telefone_original']
-                })
-            else:
-                nao_encontrados.append(tel_original)
-        
-        conn.commit()
-        conn.close()
-        
-        # Remover arquivo temporário
-        os.remove(filepath)
+        nao_encontrados = telefones_invalidos.tolist()[:50]
+        nao_encontrados += resultado['amostra_nao_encontrados'][:50 - len(nao_encontrados)]
         
         return jsonify({
             'success': True,
-            'total_planilha': len(telefones_planilha),
-            'total_atualizados': len(atualizados),
-            'total_nao_encontrados': len(nao_encontrados),
-            'atualizados': atualizados[:50],  # Limitar para não sobrecarregar
-            'nao_encontrados': nao_encontrados[:50],
+            'total_planilha': len(telefones_validos) + len(telefones_invalidos),
+            'total_atualizados': resultado['encontrados'],
+            'total_alterados': resultado['alterados'],
+            'total_sem_mudanca': resultado['sem_mudanca'],
+            'total_nao_encontrados': resultado['nao_encontrados'] + len(telefones_invalidos),
+            'atualizados': resultado['atualizados'],  # Limitar para não sobrecarregar
+            'nao_encontrados': nao_encontrados,
             'novo_status': novo_status,
             'coluna_usada': telefone_col
         })
         
     except Exception as e:
-        # Remover arquivo temporário em caso de erro
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        # Remover arquivo temporário
         if os.path.exists(filepath):
             os.remove(filepath)
-        return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/preview-colunas', methods=['POST'])
 def preview_colunas():
@@ -564,9 +605,8 @@ def preview_colunas():
         
         # Sugerir coluna de telefone
         sugestao = None
-        possiveis_nomes = ['telefone', 'phone', 'numero', 'número', 'celular', 'whatsapp', 'tel', 'fone', 'contato']
         for col in colunas:
-            if any(nome in col.lower() for nome in possiveis_nomes):
+            if any(nome in col.lower() for nome in POSSIVEIS_COLUNAS_TELEFONE):
                 sugestao = col
                 break
         
@@ -589,8 +629,12 @@ def preview_colunas():
 
 # ==================== ROTAS WHATSAPP Z-API ====================
 
+# Cliente em cache; recriado só quando whatsapp_config muda
+zapi_client = None
+
 def get_zapi_client():
-    """Retorna cliente Z-API configurado"""
+    """Retorna cliente Z-API configurado (mesma sessão HTTP entre chamadas)"""
+    global zapi_client
     conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT instance_id, token, client_token FROM whatsapp_config WHERE id = 1')
@@ -599,7 +643,12 @@ def get_zapi_client():
     
     if config and config['instance_id'] and config['token']:
         client_token = config['client_token'] if 'client_token' in config.keys() else None
-        return ZAPIClient(config['instance_id'], config['token'], client_token)
+        client = zapi_client
+        if (client is None or client.instance_id != config['instance_id']
+                or client.token != config['token'] or client.client_token != client_token):
+            client = ZAPIClient(config['instance_id'], config['token'], client_token)
+            zapi_client = client
+        return client
     return None
 
 
@@ -670,6 +719,7 @@ def whatsapp_status():
 
 
 @app.route('/api/whatsapp/templates')
+@response_cache.cached('templates', ttl=3600)
 def get_templates():
     """Retorna lista de templates disponíveis"""
     templates = listar_templates()
@@ -870,17 +920,65 @@ def verificar_numero_whatsapp():
     })
 
 
+def registrar_envio_massa(conn, lead, mensagem, template_usado, resultado):
+    """Grava o resultado de um envio em massa (executado pela fila de escrita)"""
+    conn.execute('''
+        INSERT INTO whatsapp_messages (lead_id, telefone, mensagem, template_usado, status, message_id, erro)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        lead['id'],
+        lead['telefone'],
+        mensagem,
+        template_usado,
+        'enviado' if resultado.success else 'falhou',
+        resultado.message_id,
+        resultado.error
+    ))
+    
+    if resultado.success:
+        conn.execute('''
+            UPDATE leads SET status = 'em_contato', updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (lead['id'],))
+
+
+def formatar_mensagem_campanha(parametros, lead):
+    """Mensagem da campanha personalizada para o lead"""
+    mensagem_template = parametros.get('mensagem') or ''
+    try:
+        return mensagem_template.format(
+            nome=lead.get('nome', 'Cliente'),
+            cidade=lead.get('cidade', ''),
+            telefone=lead.get('telefone', ''),
+            endereco=lead.get('endereco', ''),
+            tipo_servico=lead.get('tipo_servico', '')
+        )
+    except (KeyError, IndexError, ValueError):
+        return mensagem_template
+
+
+def enviar_para_destinatario(parametros, lead):
+    """Envia a mensagem da campanha para um lead (chamado pelo motor de campanhas)"""
+    client = get_zapi_client()
+    if not client:
+        raise RuntimeError('WhatsApp não configurado')
+    return client.enviar_texto(lead['telefone'], formatar_mensagem_campanha(parametros, lead))
+
+
+def registrar_destinatario(conn, parametros, lead, resultado):
+    """Grava o envio em whatsapp_messages (mesma transação do estado da campanha)"""
+    registrar_envio_massa(conn, lead, formatar_mensagem_campanha(parametros, lead),
+                          parametros.get('template', 'personalizada'), resultado)
+
+
+# Campanhas de envio em massa (estado no banco, retomadas ao reiniciar)
+CAMPANHA_ORIGEM = 'zapi'
+campaign_engine = CampaignEngine(db_pool, db_writer, enviar_para_destinatario,
+                                 origem=CAMPANHA_ORIGEM, recorder=registrar_destinatario)
+
+
 @app.route('/api/whatsapp/send-bulk', methods=['POST'])
 def send_bulk_whatsapp():
-    """Inicia envio em massa de mensagens"""
-    global envio_em_andamento
-    
-    if envio_em_andamento['ativo']:
-        return jsonify({
-            'success': False,
-            'error': 'Já existe um envio em andamento'
-        })
-    
+    """Cria uma campanha de envio em massa (persistida; continua após reinício)"""
     data = request.json
     lead_ids = data.get('lead_ids', [])
     mensagem_template = data.get('mensagem')
@@ -902,118 +1000,142 @@ def send_bulk_whatsapp():
             'error': 'WhatsApp não configurado'
         })
     
-    # Buscar dados dos leads
+    # Só leads que existem entram na campanha
     conn = get_db()
     cursor = conn.cursor()
     
     placeholders = ','.join('?' * len(lead_ids))
-    cursor.execute(f'SELECT * FROM leads WHERE id IN ({placeholders})', lead_ids)
-    leads = [dict(row) for row in cursor.fetchall()]
+    cursor.execute(f'SELECT id FROM leads WHERE id IN ({placeholders})', lead_ids)
+    ids = [row['id'] for row in cursor.fetchall()]
     conn.close()
     
-    # Resetar estado
-    envio_em_andamento = {
-        'ativo': True,
-        'total': len(leads),
-        'enviados': 0,
-        'sucesso': 0,
-        'falha': 0,
-        'cancelado': False,
-        'resultados': []
-    }
-    
-    # Iniciar thread de envio
-    def enviar_em_background():
-        global envio_em_andamento
-        import random
-        
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        for lead in leads:
-            if envio_em_andamento['cancelado']:
-                break
-            
-            # Formatar mensagem
-            try:
-                mensagem = mensagem_template.format(
-                    nome=lead.get('nome', 'Cliente'),
-                    cidade=lead.get('cidade', ''),
-                    telefone=lead.get('telefone', ''),
-                    endereco=lead.get('endereco', ''),
-                    tipo_servico=lead.get('tipo_servico', '')
-                )
-            except:
-                mensagem = mensagem_template
-            
-            # Enviar
-            resultado = client.enviar_texto(lead['telefone'], mensagem)
-            
-            envio_em_andamento['enviados'] += 1
-            
-            if resultado.success:
-                envio_em_andamento['sucesso'] += 1
-            else:
-                envio_em_andamento['falha'] += 1
-            
-            envio_em_andamento['resultados'].append({
-                'lead_id': lead['id'],
-                'nome': lead['nome'],
-                'telefone': lead['telefone'],
-                'sucesso': resultado.success,
-                'erro': resultado.error
-            })
-            
-            # Salvar no banco
-            cursor.execute('''
-                INSERT INTO whatsapp_messages (lead_id, telefone, mensagem, template_usado, status, message_id, erro)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                lead['id'],
-                lead['telefone'],
-                mensagem,
-                template_usado,
-                'enviado' if resultado.success else 'falhou',
-                resultado.message_id,
-                resultado.error
-            ))
-            
-            if resultado.success:
-                cursor.execute('''
-                    UPDATE leads SET status = 'em_contato', updated_at = CURRENT_TIMESTAMP WHERE id = ?
-                ''', (lead['id'],))
-            
-            conn.commit()
-            
-            # Aguardar intervalo
-            if lead != leads[-1] and not envio_em_andamento['cancelado']:
-                intervalo = random.randint(intervalo_min, intervalo_max)
-                time.sleep(intervalo)
-        
-        conn.close()
-        envio_em_andamento['ativo'] = False
-    
-    thread = threading.Thread(target=enviar_em_background)
-    thread.daemon = True
-    thread.start()
+    campanha_id = campaign_engine.create(ids, {
+        'mensagem': mensagem_template,
+        'template': template_usado,
+        'intervalo_min': intervalo_min,
+        'intervalo_max': intervalo_max
+    })
     
     return jsonify({
         'success': True,
-        'message': f'Envio iniciado para {len(leads)} leads'
+        'campaign_id': campanha_id,
+        'message': f'Envio iniciado para {len(ids)} leads'
     })
 
 
 @app.route('/api/whatsapp/send-bulk/status')
 def get_bulk_status():
-    """Retorna status do envio em massa"""
-    return jsonify(envio_em_andamento)
+    """Status da campanha informada em ?campaign_id= (ou da mais recente)"""
+    conn = get_db()
+    try:
+        campanha_id = request.args.get('campaign_id', type=int) or latest_campaign_id(conn, CAMPANHA_ORIGEM)
+        campanha = campaign_summary(conn, campanha_id) if campanha_id else None
+        resultados = recent_results(conn, campanha_id) if campanha else []
+    finally:
+        conn.close()
+    
+    if not campanha:
+        return jsonify({'ativo': False, 'total': 0, 'enviados': 0, 'sucesso': 0, 'falha': 0,
+                        'cancelado': False, 'resultados': []})
+    return jsonify({
+        'campaign_id': campanha['id'],
+        'status': campanha['status'],
+        'ativo': campanha['ativa'],
+        'total': campanha['total'],
+        'enviados': campanha['enviados'],
+        'sucesso': campanha['sucesso'],
+        'falha': campanha['falha'],
+        'cancelado': campanha['status'] == 'cancelada',
+        'resultados': [{
+            'lead_id': r['lead_id'],
+            'nome': r['nome'],
+            'telefone': r['telefone'],
+            'sucesso': r['status'] == 'enviado',
+            'erro': r['erro']
+        } for r in resultados]
+    })
 
 
 @app.route('/api/whatsapp/send-bulk/cancel', methods=['POST'])
 def cancel_bulk_send():
-    """Cancela envio em massa"""
-    global envio_em_andamento
-    envio_em_andamento['cancelado'] = True
+    """Cancela a campanha informada ou todas as ativas"""
+    data = request.get_json(silent=True) or {}
+    campanha_id = data.get('campaign_id') or request.args.get('campaign_id', type=int)
+    ids = [campanha_id] if campanha_id else campaign_engine.active_ids()
+    for cid in ids:
+        campaign_engine.cancel(cid)
+    return jsonify({'success': True, 'cancelled': ids})
+
+
+# ==================== ROTAS DE CAMPANHAS ====================
+
+@app.route('/api/campaigns')
+def list_campaigns_route():
+    """Campanhas mais recentes primeiro (paginado por cursor)"""
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    try:
+        after = decode_cursor(request.args.get('cursor'), 'campanhas', size=1)
+    except InvalidCursor as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    conn = get_db()
+    try:
+        campanhas = list_campaigns(conn, CAMPANHA_ORIGEM, after, limit)
+    finally:
+        conn.close()
+    return jsonify({
+        'campaigns': campanhas,
+        'next_cursor': next_cursor('campanhas', campanhas, ('id',), limit)
+    })
+
+
+@app.route('/api/campaigns/<int:campanha_id>')
+def get_campaign(campanha_id):
+    """Parâmetros, status e contadores de uma campanha"""
+    conn = get_db()
+    try:
+        campanha = campaign_summary(conn, campanha_id)
+    finally:
+        conn.close()
+    if not campanha:
+        return jsonify({'success': False, 'error': 'Campanha não encontrada'}), 404
+    campanha.update(campaign_engine.progress(campanha_id))
+    return jsonify(campanha)
+
+
+@app.route('/api/campaigns/<int:campanha_id>/results')
+def get_campaign_results(campanha_id):
+    """Resultado por destinatário (?status=enviado|falhou|pendente|cancelado, paginado por cursor)"""
+    limit = min(request.args.get('limit', 100, type=int), 500)
+    try:
+        after = decode_cursor(request.args.get('cursor'), f'campanha:{campanha_id}', size=1)
+    except InvalidCursor as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    conn = get_db()
+    try:
+        resultados = campaign_results(conn, campanha_id, request.args.get('status'), after, limit)
+    finally:
+        conn.close()
+    return jsonify({
+        'results': resultados,
+        'next_cursor': next_cursor(f'campanha:{campanha_id}', resultados, ('id',), limit)
+    })
+
+
+@app.route('/api/campaigns/<int:campanha_id>/<acao>', methods=['POST'])
+def control_campaign(campanha_id, acao):
+    """Pausa, retoma ou cancela uma campanha"""
+    if acao == 'pause':
+        ok = campaign_engine.pause(campanha_id)
+    elif acao == 'resume':
+        ok = bool(campaign_engine.resume(campanha_id))
+    elif acao == 'cancel':
+        ok = campaign_engine.cancel(campanha_id)
+    else:
+        return jsonify({'success': False, 'error': 'Ação inválida'}), 404
+    if not ok:
+        return jsonify({'success': False, 'error': 'Campanha não encontrada ou em status incompatível'}), 409
     return jsonify({'success': True})
 
 
@@ -1027,15 +1149,35 @@ def get_whatsapp_history():
     per_page = int(request.args.get('per_page', 50))
     offset = (page - 1) * per_page
     
-    cursor.execute('''
-        SELECT wm.*, l.nome as lead_nome, l.cidade as lead_cidade
-        FROM whatsapp_messages wm
-        LEFT JOIN leads l ON wm.lead_id = l.id
-        ORDER BY wm.sent_at DESC
-        LIMIT ? OFFSET ?
-    ''', (per_page, offset))
+    # Cursor da página anterior (tem prioridade sobre page)
+    try:
+        after = decode_cursor(request.args.get('cursor'), 'whatsapp_history', size=2)
+    except InvalidCursor as e:
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    
+    # Ordem por COALESCE(sent_at, 0) (indexada): NULL pararia a paginação por cursor
+    if after is not None:
+        keyset, keyset_params = keyset_where((sort_key('wm.sent_at'), 'wm.id'), after)
+        cursor.execute(f'''
+            SELECT wm.*, l.nome as lead_nome, l.cidade as lead_cidade
+            FROM whatsapp_messages wm
+            LEFT JOIN leads l ON wm.lead_id = l.id
+            WHERE {keyset}
+            ORDER BY {sort_key('wm.sent_at')} DESC, wm.id DESC
+            LIMIT ?
+        ''', keyset_params + [per_page])
+    else:
+        cursor.execute(f'''
+            SELECT wm.*, l.nome as lead_nome, l.cidade as lead_cidade
+            FROM whatsapp_messages wm
+            LEFT JOIN leads l ON wm.lead_id = l.id
+            ORDER BY {sort_key('wm.sent_at')} DESC, wm.id DESC
+            LIMIT ? OFFSET ?
+        ''', (per_page, offset))
     
     messages = [dict(row) for row in cursor.fetchall()]
+    cursor_proximo = next_cursor('whatsapp_history', messages, ('sent_at', 'id'), per_page)
     
     cursor.execute('SELECT COUNT(*) as total FROM whatsapp_messages')
     total = cursor.fetchone()['total']
@@ -1046,7 +1188,8 @@ def get_whatsapp_history():
         'messages': messages,
         'total': total,
         'page': page,
-        'per_page': per_page
+        'per_page': per_page,
+        'next_cursor': cursor_proximo
     })
 
 
@@ -1054,32 +1197,52 @@ def get_whatsapp_history():
 def get_whatsapp_stats():
     """Retorna estatísticas de envio"""
     conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT COUNT(*) as total FROM whatsapp_messages')
-    total = cursor.fetchone()['total']
-    
-    cursor.execute("SELECT COUNT(*) as count FROM whatsapp_messages WHERE status = 'enviado'")
-    enviados = cursor.fetchone()['count']
-    
-    cursor.execute("SELECT COUNT(*) as count FROM whatsapp_messages WHERE status = 'falhou'")
-    falhou = cursor.fetchone()['count']
-    
-    cursor.execute("SELECT COUNT(*) as count FROM whatsapp_messages WHERE DATE(sent_at) = DATE('now')")
-    hoje = cursor.fetchone()['count']
     
+    # Contadores mantidos por trigger (stats_contadores), sem varrer whatsapp_messages
+    stats = message_stats(conn)
     conn.close()
     
     return jsonify({
-        'total': total,
-        'enviados': enviados,
-        'falhou': falhou,
-        'hoje': hoje
+        'total': stats['total'],
+        'enviados': stats['por_status'].get('enviado', 0),
+        'falhou': stats['por_status'].get('falhou', 0),
+        'hoje': stats['hoje']
     })
 
 
+# ==================== INICIALIZAÇÃO ====================
+
+_servicos_lock = threading.Lock()
+_servicos_iniciados = False
+
+
+def iniciar_servicos():
+    """
+    Serviços em segundo plano do processo que atende as requisições
+    (idempotente): retoma as campanhas interrompidas e liga a reconciliação
+    periódica dos contadores.
+    Chamado por main.py, pelo __main__ (só no processo filho do reloader)
+    e, para qualquer outro servidor WSGI, antes do primeiro request.
+    """
+    global _servicos_iniciados
+    with _servicos_lock:
+        if _servicos_iniciados:
+            return
+        _servicos_iniciados = True
+    campaign_engine.resume()
+    stats_reconciler.start()
+
+
+@app.before_request
+def _iniciar_servicos_no_primeiro_request():
+    if not _servicos_iniciados:
+        iniciar_servicos()
+
+
 if __name__ == '__main__':
     init_db()
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        iniciar_servicos()  # Só no processo do reloader que atende as requisições
     print("Banco de dados inicializado!")
     print("Acesse: http://localhost:5000")
     app.run(debug=True, port=5000)
@@ -1,7 +1,6 @@
 import sys
 import os
 import sqlite3
-import pandas as pd
 from datetime import datetime
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
@@ -13,6 +12,11 @@ from PyQt5.QtWidgets import (
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QUrl
 from PyQt5.QtGui import QFont, QColor, QIcon, QDesktopServices, QPalette
 
+from database.migrations import run_migrations
+from database.search import lead_search
+from database.export import write_csv
+from database.importer import import_file, insert_leads
+
 # Caminhos
 if getattr(sys, 'frozen', False):
     # Executável PyInstaller
@@ -170,9 +174,13 @@ class ImportThread(QThread):
     
     def run(self):
         conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
         total_importados = 0
         
+        def gravar(preparado):
+            relatorio = insert_leads(conn, preparado)
+            conn.commit()
+            return relatorio
+        
         arquivos = [f for f in os.listdir(EXCEL_FOLDER) if f.endswith('.xlsx')]
         
         for i, arquivo in enumerate(arquivos):
@@ -182,30 +190,11 @@ class ImportThread(QThread):
             self.progress.emit(int((i + 1) / len(arquivos) * 100), f"Importando: {cidade}")
             
             try:
-                df = pd.read_excel(caminho)
-                
-                for _, row in df.iterrows():
-                    nome = str(row.get('qBF1Pd', '')) if pd.notna(row.get('qBF1Pd')) else ''
-                    telefone = str(row.get('UsdlK', '')) if pd.notna(row.get('UsdlK')) else ''
-                    endereco = str(row.get('W4Efsd 3', '')) if pd.notna(row.get('W4Efsd 3')) else ''
-                    tipo_servico = str(row.get('W4Efsd', '')) if pd.notna(row.get('W4Efsd')) else ''
-                    avaliacao = str(row.get('MW4etd', '')) if pd.notna(row.get('MW4etd')) else ''
-                    link_maps = str(row.get('hfpxzc href', '')) if pd.notna(row.get('hfpxzc href')) else ''
-                    
-                    if telefone and telefone != 'nan':
-                        try:
-                            cursor.execute('''
-                                INSERT OR IGNORE INTO leads 
-                                (nome, telefone, endereco, cidade, tipo_servico, avaliacao, link_maps)
-                                VALUES (?, ?, ?, ?, ?, ?, ?)
-                            ''', (nome, telefone, endereco, cidade, tipo_servico, avaliacao, link_maps))
-                            total_importados += cursor.rowcount
-                        except:
-                            pass
+                total_importados += import_file(caminho, gravar, {'cidade': cidade})['importados']
             except Exception as e:
+                conn.rollback()
                 print(f"Erro ao importar {arquivo}: {e}")
         
-        conn.commit()
         conn.close()
         self.finished.emit(total_importados)
 
@@ -457,6 +446,9 @@ class MainWindow(QMainWindow):
         ''')
         
         conn.commit()
+        
+        # Índices e busca full-text (mesmas migrações dos apps web)
+        run_migrations(conn)
         conn.close()
     
     def setup_ui(self):
@@ -709,10 +701,17 @@ class MainWindow(QMainWindow):
         cidade = self.combo_cidade.currentText()
         status = self.combo_status.currentText()
         
-        query = 'SELECT id, nome, telefone, cidade, status FROM leads WHERE 1=1'
-        params = []
+        # Busca full-text (FTS5) ordenada por relevância; LIKE se o índice não existir
+        busca = lead_search(conn, search) if search else None
+        if busca:
+            busca_sql, params = busca
+            query = (f'SELECT leads.id, nome, telefone, cidade, status FROM ({busca_sql}) busca '
+                     f'CROSS JOIN leads ON leads.id = busca.id WHERE 1=1')
+        else:
+            query = 'SELECT leads.id, nome, telefone, cidade, status FROM leads WHERE 1=1'
+            params = []
         
-        if search:
+        if search and not busca:
             query += ' AND (nome LIKE ? OR telefone LIKE ? OR endereco LIKE ?)'
             search_param = f'%{search}%'
             params.extend([search_param, search_param, search_param])
@@ -726,7 +725,7 @@ class MainWindow(QMainWindow):
             params.append(status)
         
         # Contar total
-        count_query = query.replace('SELECT id, nome, telefone, cidade, status', 'SELECT COUNT(*)')
+        count_query = query.replace('SELECT leads.id, nome, telefone, cidade, status', 'SELECT COUNT(*)')
         cursor.execute(count_query, params)
         total = cursor.fetchone()[0]
         
@@ -734,7 +733,8 @@ class MainWindow(QMainWindow):
         
         # Buscar com paginação
         offset = (self.current_page - 1) * self.per_page
-        query += f' ORDER BY updated_at DESC LIMIT {self.per_page} OFFSET {offset}'
+        order = 'busca.rank, leads.id' if busca else 'updated_at DESC'
+        query += f' ORDER BY {order} LIMIT {self.per_page} OFFSET {offset}'
         
         cursor.execute(query, params)
         leads = cursor.fetchall()
@@ -846,7 +846,7 @@ class MainWindow(QMainWindow):
     def exportar_csv(self):
         filename, _ = QFileDialog.getSaveFileName(self, "Salvar CSV", 
                                                    "leads_exportados.csv", 
-                                                   "CSV Files (*.csv)")
+                                                   "CSV Files (*.csv);;CSV compactado (*.csv.gz)")
         if filename:
             conn = sqlite3.connect(DB_PATH)
             
@@ -854,10 +854,16 @@ class MainWindow(QMainWindow):
             cidade = self.combo_cidade.currentText()
             status = self.combo_status.currentText()
             
-            query = 'SELECT * FROM leads WHERE 1=1'
-            params = []
+            busca = lead_search(conn, search) if search else None
+            if busca:
+                busca_sql, params = busca
+                query = (f'SELECT leads.* FROM ({busca_sql}) busca '
+                         f'CROSS JOIN leads ON leads.id = busca.id WHERE 1=1')
+            else:
+                query = 'SELECT * FROM leads WHERE 1=1'
+                params = []
             
-            if search:
+            if search and not busca:
                 query += ' AND (nome LIKE ? OR telefone LIKE ? OR endereco LIKE ?)'
                 search_param = f'%{search}%'
                 params.extend([search_param, search_param, search_param])
@@ -870,8 +876,9 @@ class MainWindow(QMainWindow):
                 query += ' AND status = ?'
                 params.append(status)
             
-            df = pd.read_sql_query(query, conn, params=params)
-            df.to_csv(filename, index=False, encoding='utf-8-sig')
+            # Grava em lotes direto no arquivo (gzip se terminar em .gz)
+            cursor = conn.execute(query, params)
+            write_csv(cursor, [col[0] for col in cursor.description], filename)
             conn.close()
             
             QMessageBox.information(self, "Exportação", 
@@ -7,6 +7,7 @@ from flask import Flask, render_template, request, jsonify, send_file, Response
 import pandas as pd
 import os
 import json
+import hashlib
 import re
 from datetime import datetime
 import sqlite3
@@ -15,7 +16,21 @@ import time
 from werkzeug.utils import secure_filename
 
 # Importar cliente Meta WhatsApp API
-from whatsapp.meta_client import WhatsAppCloudAPI, MessageStatus, MessageType, ErrorCodes
+from whatsapp.meta_client import WhatsAppCloudAPI, MessageStatus, MessageType, ErrorCodes, ReadReceiptDispatcher
+from whatsapp.scheduler import SendScheduler
+
+# Pool de conexões SQLite e fila de escrita única
+from database import (get_pool, get_writer, InvalidCursor, encode_cursor, decode_cursor, decode_offset_cursor,
+                      keyset_where, next_cursor, sort_key)
+from database.stats import StatsReconciler, lead_stats
+from database.queue import DurableQueue, PartitionedWorkerPool
+from database.search import highlight_snippet, lead_search, message_search
+from database.phones import normalize_phone
+from database.cache import ResponseCache
+from database.importer import ImportJobs, prepare_leads, insert_leads, save_upload
+from database.migrations import run_migrations
+from database.campaigns import (CampaignEngine, campaign_summary, campaign_results, list_campaigns,
+                                latest_campaign_id, recent_results)
 
 app = Flask(__name__)
 app.secret_key = 'sua_chave_secreta_leads_whatsapp_2024'
@@ -27,20 +42,13 @@ app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['MEDIA_FOLDER'], exist_ok=True)
 
-# Variável global para controle de envio em massa
-envio_em_andamento = {
-    'ativo': False,
-    'total': 0,
-    'enviados': 0,
-    'sucesso': 0,
-    'falha': 0,
-    'cancelado': False,
-    'resultados': []
-}
-
 # Cache do cliente WhatsApp
 whatsapp_client = None
 
+# Ritmo de envio pelos limites da Meta (tier, por destinatário, mensagens/s),
+# compartilhado por todos os envios do processo
+send_scheduler = SendScheduler()
+
 # =============================================================================
 # BANCO DE DADOS
 # =============================================================================
@@ -48,10 +56,35 @@ whatsapp_client = None
 DB_PATH = os.path.join(os.path.dirname(__file__), 'leads.db')
 EXCEL_FOLDER = r"C:\Users\kaleb\Desktop\CONTATOS SMART REFORÇO"
 
+# Conexões reaproveitadas (WAL + busy_timeout) e escritas pesadas serializadas
+db_pool = get_pool(DB_PATH)
+db_writer = get_writer(DB_PATH)
+stats_reconciler = StatsReconciler(db_writer)
+response_cache = ResponseCache()
+import_jobs = ImportJobs(db_writer, on_change=lambda: response_cache.invalidate('cidades'))
+
+# Fila durável do webhook (arquivo próprio) e workers que a consomem
+WEBHOOK_QUEUE_PATH = os.path.join(os.path.dirname(__file__), 'webhook_queue.db')
+webhook_queue = DurableQueue(WEBHOOK_QUEUE_PATH)
+webhook_workers = PartitionedWorkerPool(
+    webhook_queue, lambda events: processar_lote_webhook(events), workers=4, name='webhook'
+)
+
+# Confirmações de leitura em segundo plano (só a última mensagem de cada conversa)
+read_receipts = ReadReceiptDispatcher(lambda: get_whatsapp_client(), max_workers=4)
+
+# Campanhas de envio em massa (estado no banco, retomadas ao reiniciar);
+# envios simultâneos no ritmo do send_scheduler
+CAMPANHA_ORIGEM = 'cloud_api'
+campaign_engine = CampaignEngine(
+    db_pool, db_writer, lambda parametros, lead: enviar_para_destinatario(parametros, lead),
+    origem=CAMPANHA_ORIGEM, recorder=lambda *args: registrar_destinatario(*args),
+    scheduler=send_scheduler, workers=int(os.getenv('CAMPANHA_WORKERS', 8))
+)
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Obtém uma conexão do pool (conn.close() devolve a conexão ao pool)"""
+    return db_pool.acquire()
 
 def init_db():
     """Inicializa todas as tabelas do banco de dados"""
@@ -488,38 +521,41 @@ INSTRUÇÕES:
         ''')
     
     conn.commit()
+    
+    # Índices e alterações de schema versionadas
+    run_migrations(conn)
     conn.close()
     print("Banco de dados inicializado!")
 
 def get_whatsapp_client():
-    """Obtém ou cria o cliente WhatsApp"""
+    """
+    Obtém o cliente WhatsApp.
+    O cliente fica em cache e só é recriado quando whatsapp_config muda;
+    todos usam a mesma sessão HTTP (whatsapp.transport).
+    """
     global whatsapp_client
     
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM whatsapp_config WHERE id = 1')
+    cursor.execute('SELECT phone_number_id, access_token, business_account_id FROM whatsapp_config WHERE id = 1')
     config = cursor.fetchone()
     conn.close()
     
-    if config and config['phone_number_id'] and config['access_token']:
-        whatsapp_client = WhatsAppCloudAPI(
+    if not (config and config['phone_number_id'] and config['access_token']):
+        return None
+    
+    client = whatsapp_client
+    if (client is None or client.phone_number_id != config['phone_number_id']
+            or client.access_token != config['access_token']
+            or client.business_account_id != (config['business_account_id'] or None)):
+        client = WhatsAppCloudAPI(
             phone_number_id=config['phone_number_id'],
             access_token=config['access_token'],
-            business_account_id=config['business_account_id'] or None
+            business_account_id=config['business_account_id'] or None,
+            scheduler=send_scheduler
         )
-        return whatsapp_client
-    return None
-
-def normalizar_telefone(telefone):
-    """Remove caracteres não numéricos do telefone"""
-    if not telefone:
-        return ''
-    apenas_numeros = re.sub(r'\D', '', str(telefone))
-    if apenas_numeros.startswith('55') and len(apenas_numeros) > 11:
-        apenas_numeros = apenas_numeros[2:]
-    if len(apenas_numeros) == 11 and apenas_numeros.startswith('0'):
-        apenas_numeros = apenas_numeros[1:]
-    return apenas_numeros
+        whatsapp_client = client
+    return client
 
 # =============================================================================
 # ROTAS PRINCIPAIS - SISTEMA UNIFICADO
@@ -546,38 +582,118 @@ def chat_page():
 @app.route('/api/stats')
 def get_stats():
     conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT COUNT(*) as total FROM leads')
-    total = cursor.fetchone()['total']
-    
-    cursor.execute('SELECT status, COUNT(*) as count FROM leads GROUP BY status')
-    status_counts = {row['status']: row['count'] for row in cursor.fetchall()}
-    
-    cursor.execute('SELECT cidade, COUNT(*) as count FROM leads GROUP BY cidade ORDER BY count DESC LIMIT 10')
-    por_cidade = [{'cidade': row['cidade'], 'count': row['count']} for row in cursor.fetchall()]
-    
-    cursor.execute('SELECT COUNT(DISTINCT cidade) as total FROM leads')
-    total_cidades = cursor.fetchone()['total']
     
+    # Contadores mantidos por trigger (stats_contadores), sem varrer leads
+    stats = lead_stats(conn)
+    status_counts = stats['por_status']
     conn.close()
     
     return jsonify({
-        'total': total,
+        'total': stats['total'],
         'novo': status_counts.get('novo', 0),
         'em_contato': status_counts.get('em_contato', 0),
         'em_trial': status_counts.get('em_trial', 0),
         'ativo': status_counts.get('ativo', 0),
         'convertido': status_counts.get('convertido', 0),
         'perdido': status_counts.get('perdido', 0),
-        'por_cidade': por_cidade,
-        'total_cidades': total_cidades
+        'por_cidade': stats['por_cidade'],
+        'total_cidades': stats['total_cidades']
+    })
+
+@app.route('/api/db/metrics')
+def get_db_metrics():
+    """Métricas do pool de conexões e da fila de escrita"""
+    return jsonify({
+        'pool': db_pool.get_stats(),
+        'writer': db_writer.get_stats(),
+        'stats_reconciler': stats_reconciler.get_stats(),
+        'webhook_queue': webhook_workers.get_stats(),
+        'read_receipts': read_receipts.get_stats(),
+        'campaigns': campaign_engine.get_stats(),
+        'send_scheduler': send_scheduler.get_stats(),
+        'imports': import_jobs.get_stats(),
+        'response_cache': response_cache.get_stats(),
+        'bot_cache': get_bot_cache_stats(),
+        'bot_stream': bot_stream_stats.get_stats(),
+        'bot_answer_cache': bot_answer_cache.get_stats(),
+        'knowledge_index': knowledge_index.get_stats(),
+        'llm_gateway': llm_gateway.get_stats(),
+        'bot_router': provider_health.get_stats()
     })
 
+@app.route('/api/stats/reconcile', methods=['POST'])
+def reconcile_stats():
+    """Recalcula os contadores do dashboard do zero e informa as divergências"""
+    return jsonify(stats_reconciler.run_now())
+
 # =============================================================================
 # API - LEADS
 # =============================================================================
 
+def vincular_contato_lead(conn, links):
+    """Persiste o vínculo contato -> lead encontrado pelo telefone (executado pela fila de escrita)"""
+    conn.executemany(
+        'UPDATE whatsapp_contacts SET lead_id = ? WHERE id = ? AND lead_id IS NULL',
+        [(lead_id, contact_id) for contact_id, lead_id in links]
+    )
+
+def buscar_contatos_dos_leads(cursor, leads, chunk_size=500):
+    """
+    Retorna {lead_id: contato} para uma lista de leads em lotes.
+    
+    Primeiro pelo vínculo persistido (whatsapp_contacts.lead_id); os leads
+    sem vínculo são procurados pelo telefone normalizado (telefone_norm,
+    indexado) em consultas IN e o
+    vínculo encontrado é gravado para que a próxima leitura não precise do telefone.
+    """
+    contatos = {}
+    lead_ids = [lead['id'] for lead in leads]
+    
+    for i in range(0, len(lead_ids), chunk_size):
+        chunk = lead_ids[i:i + chunk_size]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'''
+            SELECT id AS contact_id, lead_id, phone, unread_count
+            FROM whatsapp_contacts
+            WHERE lead_id IN ({placeholders})
+            ORDER BY id
+        ''', chunk)
+        for row in cursor.fetchall():
+            contatos.setdefault(row['lead_id'], dict(row))
+    
+    # Leads ainda sem vínculo: busca pelo telefone em E.164 (igualdade no índice)
+    por_telefone = {}
+    for lead in leads:
+        if lead['id'] in contatos:
+            continue
+        norm = normalize_phone(lead['telefone'])
+        if norm:
+            por_telefone.setdefault(norm, lead['id'])
+    
+    links = []
+    telefones = list(por_telefone)
+    for i in range(0, len(telefones), chunk_size):
+        chunk = telefones[i:i + chunk_size]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'''
+            SELECT id AS contact_id, lead_id, phone, unread_count, telefone_norm
+            FROM whatsapp_contacts
+            WHERE telefone_norm IN ({placeholders})
+            ORDER BY id
+        ''', chunk)
+        for row in cursor.fetchall():
+            lead_id = por_telefone[row['telefone_norm']]
+            if lead_id in contatos:
+                continue
+            contatos[lead_id] = dict(row)
+            if row['lead_id'] is None:
+                links.append((row['contact_id'], lead_id))
+    
+    if links:
+        db_writer.submit(vincular_contato_lead, links)
+    
+    return contatos
+
 @app.route('/api/leads')
 def get_leads():
     """Lista leads com informações de mensagens integradas"""
@@ -591,10 +707,28 @@ def get_leads():
     cidade = request.args.get('cidade', '')
     format_type = request.args.get('format', 'list')  # 'list' ou 'paginated'
     
-    query = 'SELECT * FROM leads WHERE 1=1'
-    params = []
+    # Busca full-text (FTS5) ordenada por relevância; LIKE se o índice não existir
+    busca = lead_search(conn, search) if search else None
     
-    if search:
+    # Cursor opaco da página anterior (tem prioridade sobre page)
+    try:
+        if busca:
+            after = decode_offset_cursor(request.args.get('cursor'), 'leads_busca')
+        else:
+            after = decode_cursor(request.args.get('cursor'), 'leads', size=2)
+    except InvalidCursor as e:
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    
+    if busca:
+        busca_sql, params = busca
+        # CROSS JOIN fixa o FTS como laço externo (senão o SQLite pode varrer leads pelo índice de status)
+        query = f'SELECT leads.* FROM ({busca_sql}) busca CROSS JOIN leads ON leads.id = busca.id WHERE 1=1'
+    else:
+        query = 'SELECT leads.* FROM leads WHERE 1=1'
+        params = []
+    
+    if search and not busca:
         query += ' AND (nome LIKE ? OR telefone LIKE ? OR endereco LIKE ?)'
         search_term = f'%{search}%'
         params.extend([search_term, search_term, search_term])
@@ -608,40 +742,47 @@ def get_leads():
         params.append(cidade)
     
     # Contar total
-    count_query = query.replace('SELECT *', 'SELECT COUNT(*)')
+    count_query = query.replace('SELECT leads.*', 'SELECT COUNT(*)', 1)
     cursor.execute(count_query, params)
     total = cursor.fetchone()[0]
     
-    # Ordenar por última mensagem ou criação
-    query += ' ORDER BY COALESCE(ultima_msg, created_at) DESC LIMIT ? OFFSET ?'
-    params.extend([per_page, (page - 1) * per_page])
-    
-    cursor.execute(query, params)
-    leads_raw = cursor.fetchall()
-    
-    # Enriquecer com dados de contato/mensagens
-    leads = []
-    for lead_row in leads_raw:
-        lead = dict(lead_row)
-        
-        # Buscar contato associado
-        try:
-            cursor.execute('''
-                SELECT wc.id as contact_id, wc.unread_count
-                FROM whatsapp_contacts wc
-                WHERE wc.lead_id = ? OR wc.phone = ?
-            ''', (lead['id'], lead.get('telefone', '')))
-            
-            contact = cursor.fetchone()
-            if contact:
-                lead['contact_id'] = contact['contact_id']
-                lead['nao_lidas'] = contact['unread_count'] or 0
-            else:
-                lead['nao_lidas'] = lead.get('nao_lidas', 0)
-        except:
-            lead['nao_lidas'] = 0
-        
-        leads.append(lead)
+    if busca:
+        # Resultado da busca é curto e ordenado por relevância: o cursor guarda o deslocamento
+        offset = after if after is not None else (page - 1) * per_page
+        query += ' ORDER BY busca.rank, leads.id LIMIT ? OFFSET ?'
+        params.extend([per_page, offset])
+        cursor.execute(query, params)
+        leads_raw = cursor.fetchall()
+        cursor_proximo = encode_cursor('leads_busca', [offset + per_page]) if len(leads_raw) == per_page else None
+    else:
+        # Ordenar por última mensagem ou criação
+        # (ordem_recente = COALESCE(ultima_msg, created_at), mantida por trigger e indexada)
+        sort_columns = ('ordem_recente', 'id')
+        if after is not None:
+            keyset, keyset_params = keyset_where(sort_columns, after)
+            query += f' AND {keyset} ORDER BY ordem_recente DESC, id DESC LIMIT ?'
+            params.extend(keyset_params + [per_page])
+        else:
+            query += ' ORDER BY ordem_recente DESC, id DESC LIMIT ? OFFSET ?'
+            params.extend([per_page, (page - 1) * per_page])
+        cursor.execute(query, params)
+        leads_raw = cursor.fetchall()
+        cursor_proximo = next_cursor('leads', leads_raw, sort_columns, per_page)
+    
+    # Enriquecer com dados de contato/mensagens (uma consulta em lote, sem N+1)
+    leads = [dict(lead_row) for lead_row in leads_raw]
+    try:
+        contatos = buscar_contatos_dos_leads(cursor, leads)
+    except sqlite3.Error:
+        contatos = {}
+    
+    for lead in leads:
+        contact = contatos.get(lead['id'])
+        if contact:
+            lead['contact_id'] = contact['contact_id']
+            lead['nao_lidas'] = contact['unread_count'] or 0
+        else:
+            lead['nao_lidas'] = lead.get('nao_lidas') or 0
     
     conn.close()
     
@@ -652,11 +793,15 @@ def get_leads():
             'total': total,
             'page': page,
             'per_page': per_page,
-            'pages': (total + per_page - 1) // per_page
+            'pages': (total + per_page - 1) // per_page,
+            'next_cursor': cursor_proximo
         })
     
-    # Formato lista simples
-    return jsonify(leads)
+    # Formato lista simples (cursor da próxima página vai no header)
+    response = jsonify(leads)
+    if cursor_proximo:
+        response.headers['X-Next-Cursor'] = cursor_proximo
+    return response
 
 @app.route('/api/leads/<int:lead_id>')
 def get_lead(lead_id):
@@ -727,6 +872,7 @@ def add_anotacao(lead_id):
     return jsonify({'success': True, 'id': anotacao_id})
 
 @app.route('/api/cidades')
+@response_cache.cached('cidades', ttl=60)
 def get_cidades():
     conn = get_db()
     cursor = conn.cursor()
@@ -786,9 +932,19 @@ def save_whatsapp_config():
     global whatsapp_client
     whatsapp_client = None
     get_whatsapp_client()
+    response_cache.invalidate('whatsapp_templates')
     
     return jsonify({'success': True})
 
+@app.route('/api/whatsapp/templates')
+@response_cache.cached('whatsapp_templates')
+def get_whatsapp_templates():
+    """Templates de mensagem aprovados na conta (Meta API, em cache)"""
+    client = get_whatsapp_client()
+    if not client:
+        return jsonify({'error': 'WhatsApp não configurado'}), 400
+    return jsonify(client.get_templates())
+
 @app.route('/api/whatsapp/status')
 def get_whatsapp_status():
     """
@@ -926,6 +1082,13 @@ def get_messages(contact_id):
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 50, type=int)
     
+    # Cursor para carregar mensagens mais antigas (tem prioridade sobre page)
+    try:
+        after = decode_cursor(request.args.get('cursor'), f'messages:{contact_id}', size=2)
+    except InvalidCursor as e:
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    
     # Buscar contato
     cursor.execute('SELECT * FROM whatsapp_contacts WHERE id = ?', (contact_id,))
     contact = cursor.fetchone()
@@ -934,15 +1097,27 @@ def get_messages(contact_id):
         conn.close()
         return jsonify({'error': 'Contato não encontrado'}), 404
     
-    # Buscar mensagens
-    cursor.execute('''
-        SELECT * FROM whatsapp_messages 
-        WHERE contact_id = ?
-        ORDER BY timestamp DESC
-        LIMIT ? OFFSET ?
-    ''', (contact_id, per_page, (page - 1) * per_page))
+    # Buscar mensagens (índice contact_id, COALESCE(timestamp, 0) + rowid):
+    # timestamp não tem default, e NULL pararia a paginação por cursor
+    sort_columns = ('timestamp', 'id')
+    if after is not None:
+        keyset, keyset_params = keyset_where((sort_key('timestamp'), 'id'), after)
+        cursor.execute(f'''
+            SELECT * FROM whatsapp_messages 
+            WHERE contact_id = ? AND {keyset}
+            ORDER BY {sort_key('timestamp')} DESC, id DESC
+            LIMIT ?
+        ''', [contact_id] + keyset_params + [per_page])
+    else:
+        cursor.execute(f'''
+            SELECT * FROM whatsapp_messages 
+            WHERE contact_id = ?
+            ORDER BY {sort_key('timestamp')} DESC, id DESC
+            LIMIT ? OFFSET ?
+        ''', (contact_id, per_page, (page - 1) * per_page))
     
     messages = [dict(row) for row in cursor.fetchall()]
+    cursor_proximo = next_cursor(f'messages:{contact_id}', messages, sort_columns, per_page)
     messages.reverse()  # Ordem cronológica
     
     # Marcar como lidas
@@ -955,9 +1130,59 @@ def get_messages(contact_id):
     
     return jsonify({
         'contact': dict(contact),
-        'messages': messages
+        'messages': messages,
+        'next_cursor': cursor_proximo
     })
 
+@app.route('/api/whatsapp/messages/search')
+def search_messages():
+    """Busca mensagens pelo conteúdo (FTS5), ordenadas por relevância"""
+    q = request.args.get('q', '').strip()
+    contact_id = request.args.get('contact_id', type=int)
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    
+    if not q:
+        return jsonify({'error': 'Parâmetro q obrigatório'}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    busca = message_search(conn, q)
+    if busca:
+        busca_sql, params = busca
+        query = f'''
+            SELECT m.id, m.contact_id, m.direction, m.type, m.content, m.timestamp,
+                   c.name as contact_name, c.phone, busca.trecho
+            FROM ({busca_sql}) busca
+            JOIN whatsapp_messages m ON m.id = busca.id
+            LEFT JOIN whatsapp_contacts c ON c.id = m.contact_id
+            WHERE 1=1
+        '''
+        order = ' ORDER BY busca.rank LIMIT ?'
+    else:
+        query = '''
+            SELECT m.id, m.contact_id, m.direction, m.type, m.content, m.timestamp,
+                   c.name as contact_name, c.phone, NULL as trecho
+            FROM whatsapp_messages m
+            LEFT JOIN whatsapp_contacts c ON c.id = m.contact_id
+            WHERE m.content LIKE ?
+        '''
+        params = [f'%{q}%']
+        order = ' ORDER BY m.timestamp DESC LIMIT ?'
+    
+    if contact_id:
+        query += ' AND m.contact_id = ?'
+        params.append(contact_id)
+    
+    cursor.execute(query + order, params + [limit])
+    results = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    
+    for result in results:
+        result['trecho'] = highlight_snippet(result['trecho'])
+    
+    return jsonify({'results': results, 'total': len(results)})
+
 # =============================================================================
 # API - WHATSAPP ENVIO DE MENSAGENS
 # =============================================================================
@@ -1047,12 +1272,9 @@ def send_message():
             cursor.execute('SELECT phone FROM whatsapp_contacts WHERE id = ?', (contact_id,))
             phone_data = cursor.fetchone()
             if phone_data:
-                # Buscar lead com esse telefone
-                phone_clean = re.sub(r'\D', '', phone_data['phone'])
-                cursor.execute('''
-                    SELECT id FROM leads 
-                    WHERE REPLACE(REPLACE(REPLACE(REPLACE(telefone, '(', ''), ')', ''), '-', ''), ' ', '') LIKE ?
-                ''', (f'%{phone_clean[-9:]}%',))
+                # Buscar lead com esse telefone (telefone_norm indexado)
+                cursor.execute('SELECT id FROM leads WHERE telefone_norm = ?',
+                              (normalize_phone(phone_data['phone']),))
                 lead_found = cursor.fetchone()
                 if lead_found:
                     cursor.execute('''
@@ -1247,10 +1469,45 @@ def receive_webhook():
     if data.get('object') != 'whatsapp_business_account':
         return jsonify({'status': 'ok'})
     
+    # Template aprovado/rejeitado/pausado: a lista em cache mudou
+    if any(change.get('field') == 'message_template_status_update'
+           for entry in data.get('entry', []) for change in entry.get('changes', [])):
+        response_cache.invalidate('whatsapp_templates')
+    
     events = WhatsAppCloudAPI.parse_webhook(data)
     
-    conn = get_db()
+    # Só persiste na fila durável e responde; o processamento é feito pelos workers.
+    # Chave = telefone do contato, para manter a ordem das mensagens de cada conversa.
+    webhook_queue.put_many([
+        (event.get('from') or event.get('recipient') or '', event) for event in events
+    ])
+    webhook_workers.start()
+    
+    return jsonify({'status': 'ok'})
+
+def processar_lote_webhook(events):
+    """Processa um lote de eventos da fila do webhook (executado pelos workers)"""
+    # Gravar pela fila de escrita única (não disputa o lock com o envio em massa)
+    mensagens_recebidas = db_writer.run(salvar_eventos_webhook, events)
+    
+    # Marcar como lida na API (em segundo plano, sem segurar o worker)
+    for msg_id, phone in mensagens_recebidas:
+        send_scheduler.open_window(phone)  # respostas nas próximas 24h não contam no tier
+        read_receipts.submit(msg_id, conversation=phone)
+
+# Progressão do status de uma mensagem enviada ('failed' é final)
+ORDEM_STATUS = {'pending': 0, 'sent': 1, 'delivered': 2, 'read': 3, 'failed': 4}
+_SQL_ORDEM_STATUS = 'CASE status {} ELSE 0 END'.format(
+    ' '.join(f"WHEN '{nome}' THEN {ordem}" for nome, ordem in ORDEM_STATUS.items())
+)
+
+def salvar_eventos_webhook(conn, events):
+    """
+    Grava os eventos do webhook (executado pela fila de escrita).
+    Retorna (message_id, telefone) das mensagens recebidas para marcar como lidas.
+    """
     cursor = conn.cursor()
+    mensagens_recebidas = []
     
     for event in events:
         if event['type'] == 'message':
@@ -1278,12 +1535,8 @@ def receive_webhook():
                     cursor.execute('UPDATE whatsapp_contacts SET name = ? WHERE id = ?', 
                                   (contact_name, contact_id))
             else:
-                # Tentar vincular a um lead existente pelo telefone
-                phone_clean = re.sub(r'\D', '', phone)
-                cursor.execute('''
-                    SELECT id FROM leads 
-                    WHERE REPLACE(REPLACE(REPLACE(REPLACE(telefone, '(', ''), ')', ''), '-', ''), ' ', '') LIKE ?
-                ''', (f'%{phone_clean[-9:]}%',))
+                # Tentar vincular a um lead existente pelo telefone (telefone_norm indexado)
+                cursor.execute('SELECT id FROM leads WHERE telefone_norm = ?', (normalize_phone(phone),))
                 lead_found = cursor.fetchone()
                 lead_id = lead_found['id'] if lead_found else None
                 
@@ -1326,14 +1579,9 @@ def receive_webhook():
                     ''', (timestamp, lead_id))
                 
                 print(f"[WEBHOOK] Mensagem recebida de {phone}: {content[:50]}...")
-            
-            # Marcar como lida na API
-            client = get_whatsapp_client()
-            if client and msg_id:
-                try:
-                    client.mark_as_read(msg_id)
-                except Exception as e:
-                    print(f"[WEBHOOK] Erro ao marcar como lida: {e}")
+                
+                # Confirmação de leitura só na primeira vez (evento reentregue não reenvia)
+                mensagens_recebidas.append((msg_id, phone))
         
         elif event['type'] == 'status':
             # Atualização de status de mensagem enviada
@@ -1342,18 +1590,18 @@ def receive_webhook():
             error_message = event.get('error_message', '')
             
             if msg_id:
-                cursor.execute('''
+                # Status nunca volta atrás (ex.: 'delivered' atrasado depois de 'read')
+                cursor.execute(f'''
                     UPDATE whatsapp_messages 
                     SET status = ?, error_message = ?
-                    WHERE wa_message_id = ?
-                ''', (status, error_message if status == 'failed' else None, msg_id))
+                    WHERE wa_message_id = ? AND {_SQL_ORDEM_STATUS} <= ?
+                ''', (status, error_message if status == 'failed' else None, msg_id,
+                      ORDEM_STATUS.get(status, 0)))
                 
-                print(f"[WEBHOOK] Status atualizado: {msg_id} -> {status}")
+                if cursor.rowcount:
+                    print(f"[WEBHOOK] Status atualizado: {msg_id} -> {status}")
     
-    conn.commit()
-    conn.close()
-    
-    return jsonify({'status': 'ok'})
+    return mensagens_recebidas
 
 # =============================================================================
 # API - IMPORTAÇÃO CSV
@@ -1373,69 +1621,63 @@ def import_csv():
         return jsonify({'error': 'Arquivo deve ser CSV'}), 400
     
     try:
-        df = pd.read_csv(file, encoding='utf-8')
+        df = pd.read_csv(file, encoding='utf-8', dtype=str)
     except:
         try:
             file.seek(0)
-            df = pd.read_csv(file, encoding='latin-1')
+            df = pd.read_csv(file, encoding='latin-1', dtype=str)
         except Exception as e:
             return jsonify({'error': f'Erro ao ler arquivo: {str(e)}'}), 400
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    importados = 0
-    duplicados = 0
-    
-    # Mapear colunas
-    col_map = {
-        'nome': ['nome', 'name', 'empresa', 'company', 'qBF1Pd'],
-        'telefone': ['telefone', 'phone', 'tel', 'celular', 'whatsapp', 'UsdlK'],
-        'cidade': ['cidade', 'city', 'municipio'],
-        'endereco': ['endereco', 'address', 'endereço', 'W4Efsd 3'],
-        'tipo_servico': ['tipo_servico', 'categoria', 'category', 'W4Efsd'],
-    }
-    
-    def find_column(df, options):
-        for opt in options:
-            for col in df.columns:
-                if opt.lower() in col.lower():
-                    return col
-        return None
-    
-    mapped = {k: find_column(df, v) for k, v in col_map.items()}
-    
-    for _, row in df.iterrows():
-        telefone = str(row.get(mapped['telefone'], '')) if mapped['telefone'] else ''
-        telefone = re.sub(r'\D', '', telefone)
-        
-        if not telefone or len(telefone) < 10:
-            continue
-        
-        nome = str(row.get(mapped['nome'], '')) if mapped['nome'] else ''
-        cidade = str(row.get(mapped['cidade'], '')) if mapped['cidade'] else ''
-        endereco = str(row.get(mapped['endereco'], '')) if mapped['endereco'] else ''
-        tipo = str(row.get(mapped['tipo_servico'], '')) if mapped['tipo_servico'] else ''
-        
-        try:
-            cursor.execute('''
-                INSERT INTO leads (nome, telefone, cidade, endereco, tipo_servico)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (nome, telefone, cidade, endereco, tipo))
-            importados += 1
-        except sqlite3.IntegrityError:
-            duplicados += 1
-    
-    conn.commit()
-    conn.close()
+    # Este app grava o telefone só com dígitos
+    preparado = prepare_leads(df, phone_digits_only=True)
+    relatorio = db_writer.run(insert_leads, preparado)
+    response_cache.invalidate('cidades')
     
     return jsonify({
         'success': True,
-        'importados': importados,
-        'duplicados': duplicados,
-        'total': len(df)
+        'importados': relatorio['importados'],
+        'duplicados': relatorio['duplicados_arquivo'] + relatorio['duplicados_banco'] + relatorio['ignorados'],
+        'invalidos': relatorio['invalidos'] + relatorio['sem_telefone'],
+        'total': relatorio['total'],
+        'tempos_ms': relatorio['tempos_ms']
     })
 
+@app.route('/api/import', methods=['POST'])
+def start_import():
+    """
+    Importa um CSV/XLSX grande em segundo plano, lido e gravado em blocos.
+    Retorna o job_id para acompanhar em /api/import/<job_id>.
+    """
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        return jsonify({'error': 'Nenhum arquivo enviado'}), 400
+    
+    try:
+        caminho = save_upload(file, app.config['UPLOAD_FOLDER'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    job_id = import_jobs.start([(caminho, {})], cleanup=True, phone_digits_only=True)
+    return jsonify({'success': True, 'job_id': job_id}), 202
+
+@app.route('/api/import/<job_id>')
+def get_import(job_id):
+    """Progresso da importação (status, progresso em %, contadores e tempos)"""
+    job = import_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Importação não encontrada'}), 404
+    return jsonify(job)
+
+@app.route('/api/import/<job_id>/cancel', methods=['POST'])
+def cancel_import(job_id):
+    """Interrompe a importação após o bloco atual (o que já foi gravado fica)"""
+    if import_jobs.get(job_id) is None:
+        return jsonify({'error': 'Importação não encontrada'}), 404
+    if not import_jobs.cancel(job_id):
+        return jsonify({'error': 'Importação já terminou'}), 409
+    return jsonify({'success': True, 'job_id': job_id})
+
 # =============================================================================
 # API - LEADS PARA WHATSAPP
 # =============================================================================
@@ -1531,16 +1773,114 @@ def get_leads_for_bulk():
         'showing': len(leads)
     })
 
+def registrar_envio_massa(conn, lead_id, nome, phone, mensagem, wa_message_id):
+    """Grava contato, mensagem e conversa de um envio em massa (executado pela fila de escrita)"""
+    cursor = conn.cursor()
+    
+    # Criar/atualizar contato
+    cursor.execute('SELECT id FROM whatsapp_contacts WHERE phone = ?', (phone,))
+    existing = cursor.fetchone()
+    
+    if existing:
+        contact_id = existing['id']
+    else:
+        cursor.execute('''
+            INSERT INTO whatsapp_contacts (phone, name, lead_id)
+            VALUES (?, ?, ?)
+        ''', (phone, nome, lead_id))
+        contact_id = cursor.lastrowid
+        cursor.execute('INSERT INTO whatsapp_conversations (contact_id) VALUES (?)', (contact_id,))
+    
+    # Salvar mensagem
+    now = datetime.now()
+    cursor.execute('''
+        INSERT INTO whatsapp_messages 
+        (wa_message_id, contact_id, direction, type, content, status, timestamp)
+        VALUES (?, ?, 'outgoing', 'text', ?, 'sent', ?)
+    ''', (wa_message_id, contact_id, mensagem, now))
+    
+    # Atualizar conversa
+    cursor.execute('''
+        UPDATE whatsapp_conversations 
+        SET last_message = ?, last_message_type = 'text', last_message_time = ?
+        WHERE contact_id = ?
+    ''', (mensagem[:100], now, contact_id))
+    
+    # Atualizar status do lead
+    cursor.execute('UPDATE leads SET status = "em_contato" WHERE id = ?', (lead_id,))
+    return contact_id
+
+def preparar_envio_massa(parametros, lead):
+    """Telefone formatado e mensagem personalizada de um destinatário da campanha"""
+    phone = re.sub(r'\D', '', lead['telefone'] or '')
+    if not phone.startswith('55'):
+        phone = '55' + phone
+    
+    mensagem = parametros.get('message') or ''
+    if '{nome}' in mensagem:
+        mensagem = mensagem.replace('{nome}', lead['nome'] or '')
+    if '{cidade}' in mensagem:
+        mensagem = mensagem.replace('{cidade}', lead['cidade'] or '')
+    if '{tipo}' in mensagem:
+        mensagem = mensagem.replace('{tipo}', lead['tipo_servico'] or '')
+    return phone, mensagem
+
+def enviar_para_destinatario(parametros, lead):
+    """Envia a mensagem da campanha para um lead (chamado pelo motor de campanhas)"""
+    client = get_whatsapp_client()
+    if not client:
+        raise RuntimeError('WhatsApp não configurado')
+    
+    phone, mensagem = preparar_envio_massa(parametros, lead)
+    if parametros.get('template_name'):
+        return client.send_template(phone, parametros['template_name'])
+    return client.send_text(phone, mensagem)
+
+def registrar_destinatario(conn, parametros, lead, resultado):
+    """Grava o envio bem-sucedido no histórico do WhatsApp (mesma transação do estado da campanha)"""
+    if resultado.success:
+        phone, mensagem = preparar_envio_massa(parametros, lead)
+        registrar_envio_massa(conn, lead['id'], lead['nome'], phone, mensagem, resultado.message_id)
+
+def status_campanha_legado(campanha_id=None):
+    """Campanha no formato antigo de /send-bulk/status (resultados mais recentes)"""
+    conn = get_db()
+    try:
+        if campanha_id is None:
+            campanha_id = latest_campaign_id(conn, CAMPANHA_ORIGEM)
+        campanha = campaign_summary(conn, campanha_id) if campanha_id else None
+        resultados = recent_results(conn, campanha_id) if campanha else []
+    finally:
+        conn.close()
+    
+    if not campanha:
+        return {'ativo': False, 'total': 0, 'enviados': 0, 'sucesso': 0, 'falha': 0,
+                'cancelado': False, 'resultados': []}
+    return {
+        'campaign_id': campanha['id'],
+        'status': campanha['status'],
+        'ativo': campanha['ativa'],
+        'total': campanha['total'],
+        'enviados': campanha['enviados'],
+        'sucesso': campanha['sucesso'],
+        'falha': campanha['falha'],
+        'cancelado': campanha['status'] == 'cancelada',
+        'resultados': [{
+            'lead_id': r['lead_id'],
+            'nome': r['nome'],
+            'success': r['status'] == 'enviado',
+            **({} if r['status'] == 'enviado' else {'error': r['erro']})
+        } for r in resultados]
+    }
+
 @app.route('/api/whatsapp/send-bulk', methods=['POST'])
 def send_bulk_messages():
-    """Envia mensagens em massa para múltiplos leads"""
-    global envio_em_andamento
-    
+    """Cria uma campanha de envio em massa (persistida; continua após reinício)"""
     data = request.get_json()
     lead_ids = data.get('lead_ids', [])
     message = data.get('message', '')
     template_name = data.get('template_name')  # Para usar template da Meta
-    delay_seconds = data.get('delay', 3)  # Delay entre mensagens
+    delay_seconds = data.get('delay', 0)  # Pausa extra opcional; o ritmo vem do send_scheduler
     
     if not lead_ids:
         return jsonify({'error': 'Nenhum lead selecionado'}), 400
@@ -1552,148 +1892,102 @@ def send_bulk_messages():
     if not client:
         return jsonify({'error': 'WhatsApp não configurado'}), 400
     
-    # Iniciar envio em background
-    envio_em_andamento = {
-        'ativo': True,
-        'total': len(lead_ids),
-        'enviados': 0,
-        'sucesso': 0,
-        'falha': 0,
-        'cancelado': False,
-        'resultados': []
-    }
-    
-    def enviar_em_massa():
-        global envio_em_andamento
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        for lead_id in lead_ids:
-            if envio_em_andamento['cancelado']:
-                break
-            
-            # Buscar lead
-            cursor.execute('SELECT * FROM leads WHERE id = ?', (lead_id,))
-            lead = cursor.fetchone()
-            
-            if not lead or not lead['telefone']:
-                envio_em_andamento['falha'] += 1
-                envio_em_andamento['resultados'].append({
-                    'lead_id': lead_id,
-                    'success': False,
-                    'error': 'Lead não encontrado ou sem telefone'
-                })
-                envio_em_andamento['enviados'] += 1
-                continue
-            
-            # Formatar telefone
-            phone = re.sub(r'\D', '', lead['telefone'])
-            if not phone.startswith('55'):
-                phone = '55' + phone
-            
-            # Personalizar mensagem
-            msg_personalizada = message
-            if '{nome}' in msg_personalizada:
-                msg_personalizada = msg_personalizada.replace('{nome}', lead['nome'] or '')
-            if '{cidade}' in msg_personalizada:
-                msg_personalizada = msg_personalizada.replace('{cidade}', lead['cidade'] or '')
-            if '{tipo}' in msg_personalizada:
-                msg_personalizada = msg_personalizada.replace('{tipo}', lead['tipo_servico'] or '')
-            
-            try:
-                # Enviar mensagem
-                if template_name:
-                    result = client.send_template(phone, template_name)
-                else:
-                    result = client.send_text(phone, msg_personalizada)
-                
-                if result.success:
-                    envio_em_andamento['sucesso'] += 1
-                    
-                    # Criar/atualizar contato
-                    cursor.execute('SELECT id FROM whatsapp_contacts WHERE phone = ?', (phone,))
-                    existing = cursor.fetchone()
-                    
-                    if existing:
-                        contact_id = existing['id']
-                    else:
-                        cursor.execute('''
-                            INSERT INTO whatsapp_contacts (phone, name, lead_id)
-                            VALUES (?, ?, ?)
-                        ''', (phone, lead['nome'], lead_id))
-                        contact_id = cursor.lastrowid
-                        cursor.execute('INSERT INTO whatsapp_conversations (contact_id) VALUES (?)', (contact_id,))
-                    
-                    # Salvar mensagem
-                    now = datetime.now()
-                    cursor.execute('''
-                        INSERT INTO whatsapp_messages 
-                        (wa_message_id, contact_id, direction, type, content, status, timestamp)
-                        VALUES (?, ?, 'outgoing', 'text', ?, 'sent', ?)
-                    ''', (result.message_id, contact_id, msg_personalizada, now))
-                    
-                    # Atualizar conversa
-                    cursor.execute('''
-                        UPDATE whatsapp_conversations 
-                        SET last_message = ?, last_message_type = 'text', last_message_time = ?
-                        WHERE contact_id = ?
-                    ''', (msg_personalizada[:100], now, contact_id))
-                    
-                    # Atualizar status do lead
-                    cursor.execute('UPDATE leads SET status = "em_contato" WHERE id = ?', (lead_id,))
-                    
-                    conn.commit()
-                    
-                    envio_em_andamento['resultados'].append({
-                        'lead_id': lead_id,
-                        'nome': lead['nome'],
-                        'success': True
-                    })
-                else:
-                    envio_em_andamento['falha'] += 1
-                    envio_em_andamento['resultados'].append({
-                        'lead_id': lead_id,
-                        'nome': lead['nome'],
-                        'success': False,
-                        'error': result.error
-                    })
-            except Exception as e:
-                envio_em_andamento['falha'] += 1
-                envio_em_andamento['resultados'].append({
-                    'lead_id': lead_id,
-                    'success': False,
-                    'error': str(e)
-                })
-            
-            envio_em_andamento['enviados'] += 1
-            
-            # Delay entre mensagens
-            if not envio_em_andamento['cancelado']:
-                time.sleep(delay_seconds)
-        
-        conn.close()
-        envio_em_andamento['ativo'] = False
-    
-    # Iniciar thread de envio
-    thread = threading.Thread(target=enviar_em_massa)
-    thread.daemon = True
-    thread.start()
+    campanha_id = campaign_engine.create(lead_ids, {
+        'message': message,
+        'template_name': template_name,
+        'intervalo_min': delay_seconds,
+        'intervalo_max': delay_seconds
+    })
     
     return jsonify({
         'success': True,
+        'campaign_id': campanha_id,
         'message': f'Envio iniciado para {len(lead_ids)} leads'
     })
 
 @app.route('/api/whatsapp/send-bulk/status')
 def get_bulk_status():
-    """Retorna o status do envio em massa"""
-    return jsonify(envio_em_andamento)
+    """Status da campanha informada em ?campaign_id= (ou da mais recente)"""
+    return jsonify(status_campanha_legado(request.args.get('campaign_id', type=int)))
 
 @app.route('/api/whatsapp/send-bulk/cancel', methods=['POST'])
 def cancel_bulk_send():
-    """Cancela o envio em massa"""
-    global envio_em_andamento
-    envio_em_andamento['cancelado'] = True
+    """Cancela a campanha informada ou todas as ativas"""
+    data = request.get_json(silent=True) or {}
+    campanha_id = data.get('campaign_id') or request.args.get('campaign_id', type=int)
+    ids = [campanha_id] if campanha_id else campaign_engine.active_ids()
+    for cid in ids:
+        campaign_engine.cancel(cid)
+    return jsonify({'success': True, 'cancelled': ids})
+
+# =============================================================================
+# API - CAMPANHAS
+# =============================================================================
+
+@app.route('/api/campaigns')
+def list_campaigns_route():
+    """Campanhas mais recentes primeiro (paginado por cursor)"""
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    try:
+        after = decode_cursor(request.args.get('cursor'), 'campanhas', size=1)
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db()
+    try:
+        campanhas = list_campaigns(conn, CAMPANHA_ORIGEM, after, limit)
+    finally:
+        conn.close()
+    return jsonify({
+        'campaigns': campanhas,
+        'next_cursor': next_cursor('campanhas', campanhas, ('id',), limit)
+    })
+
+@app.route('/api/campaigns/<int:campanha_id>')
+def get_campaign(campanha_id):
+    """Parâmetros, status e contadores de uma campanha"""
+    conn = get_db()
+    try:
+        campanha = campaign_summary(conn, campanha_id)
+    finally:
+        conn.close()
+    if not campanha:
+        return jsonify({'error': 'Campanha não encontrada'}), 404
+    campanha.update(campaign_engine.progress(campanha_id))
+    return jsonify(campanha)
+
+@app.route('/api/campaigns/<int:campanha_id>/results')
+def get_campaign_results(campanha_id):
+    """Resultado por destinatário (?status=enviado|falhou|pendente|cancelado, paginado por cursor)"""
+    limit = min(request.args.get('limit', 100, type=int), 500)
+    try:
+        after = decode_cursor(request.args.get('cursor'), f'campanha:{campanha_id}', size=1)
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db()
+    try:
+        resultados = campaign_results(conn, campanha_id, request.args.get('status'), after, limit)
+    finally:
+        conn.close()
+    return jsonify({
+        'results': resultados,
+        'next_cursor': next_cursor(f'campanha:{campanha_id}', resultados, ('id',), limit)
+    })
+
+@app.route('/api/campaigns/<int:campanha_id>/<acao>', methods=['POST'])
+def control_campaign(campanha_id, acao):
+    """Pausa, retoma ou cancela uma campanha"""
+    if acao == 'pause':
+        ok = campaign_engine.pause(campanha_id)
+    elif acao == 'resume':
+        ok = bool(campaign_engine.resume(campanha_id))
+    elif acao == 'cancel':
+        ok = campaign_engine.cancel(campanha_id)
+    else:
+        return jsonify({'error': 'Ação inválida'}), 404
+    if not ok:
+        return jsonify({'error': 'Campanha não encontrada ou em status incompatível'}), 409
     return jsonify({'success': True})
 
 @app.route('/api/whatsapp/import-leads-as-contacts', methods=['POST'])
@@ -1751,6 +2045,7 @@ def import_leads_as_contacts():
 # =============================================================================
 
 @app.route('/api/unidades')
+@response_cache.cached('unidades')
 def get_unidades():
     """Lista todas as unidades"""
     conn = get_db()
@@ -1779,6 +2074,7 @@ def create_unidade():
     unidade_id = cursor.lastrowid
     conn.commit()
     conn.close()
+    response_cache.invalidate('unidades')
     
     return jsonify({'success': True, 'id': unidade_id})
 
@@ -1801,6 +2097,7 @@ def update_unidade(unidade_id):
         params.append(unidade_id)
         cursor.execute(f'UPDATE unidades SET {", ".join(updates)} WHERE id = ?', params)
         conn.commit()
+        response_cache.invalidate('unidades')
     
     conn.close()
     return jsonify({'success': True})
@@ -1859,6 +2156,7 @@ def remove_lead_from_unidade(lead_id, unidade_id):
 # =============================================================================
 
 @app.route('/api/crm/pipelines')
+@response_cache.cached('pipelines', 'unidades')
 def get_pipelines():
     """Lista todos os pipelines"""
     conn = get_db()
@@ -1903,9 +2201,11 @@ def create_pipeline():
     
     conn.commit()
     conn.close()
+    response_cache.invalidate('pipelines', 'estagios')
     return jsonify({'success': True, 'id': pipeline_id})
 
 @app.route('/api/crm/pipelines/<int:pipeline_id>/estagios')
+@response_cache.cached('estagios')
 def get_estagios(pipeline_id):
     """Lista estágios de um pipeline"""
     conn = get_db()
@@ -1929,6 +2229,7 @@ def create_estagio():
     ''', (data.get('pipeline_id'), data.get('nome'), data.get('cor', '#6b7280'), data.get('ordem', 0)))
     conn.commit()
     conn.close()
+    response_cache.invalidate('estagios')
     return jsonify({'success': True})
 
 # =============================================================================
@@ -2127,29 +2428,110 @@ try:
 except ImportError:
     cloud_ai_available = False
 
-# Cache do bot
-smart_bot = None
-cloud_bot = None
+from bot.quick_responses import QuickResponses, TIPOS as QUICK_RESPONSE_TYPES
+from bot.streaming import StreamError, StreamStats, TimedStream
+from bot.answer_cache import AnswerCache, EMBED_MODEL as BOT_CACHE_EMBED_MODEL, ollama_embedder
+from bot.gateway import LLMGateway, GatewayBusy, GatewayTimeout
+from bot.router import ProviderHealth, ProviderRouter
+from bot.knowledge import KnowledgeIndex, EMBED_MODEL as BOT_KB_EMBED_MODEL, TOP_K as KB_TOP_K
+
+# Cache do bot: instância montada, configuração e respostas rápidas compiladas,
+# válidos enquanto a versão da configuração não muda (invalidar_bot())
+bot_config_version = 0
+_bot_cache = None
+_bot_cache_lock = threading.Lock()
+_reindex_lock = threading.Lock()
+# Espera entre tentativas de reindexar depois de uma falha (ex.: Ollama fora do ar)
+BOT_KB_RETRY_SECONDS = float(os.getenv('BOT_KB_RETRY_SECONDS', 60))
+_reindex_falhou_em = None
+_bot_cache_stats = {'hits': 0, 'rebuilds': 0, 'invalidations': 0}
+bot_stream_stats = StreamStats()
+# Respostas da IA já geradas, por versão da configuração (bot/answer_cache.py)
+bot_answer_cache = AnswerCache()
+# Índice vetorial da base de conhecimento (bot/knowledge.py), mapeado do disco
+knowledge_index = KnowledgeIndex(os.getenv('BOT_KB_DIR', os.path.join(os.path.dirname(__file__), 'bot_index')))
+knowledge_index.load()
+
+def invalidar_bot():
+    """Marca a configuração do bot como alterada; a próxima mensagem remonta o bot"""
+    global bot_config_version
+    with _bot_cache_lock:
+        bot_config_version += 1
+        _bot_cache_stats['invalidations'] += 1
+    bot_answer_cache.clear()
+
+# Variáveis de ambiente com chaves dos provedores reserva (além de bot_config.cloud_api_keys)
+CLOUD_API_KEY_ENV = {'gemini': 'GEMINI_API_KEY', 'openai': 'OPENAI_API_KEY', 'claude': 'ANTHROPIC_API_KEY'}
+# Chamadas à IA passam pelo gateway: concorrência por provedor, fila limitada, prazo
+llm_gateway = LLMGateway()
+# Latência/erros recentes por provedor; sobrevive às remontagens do bot
+provider_health = ProviderHealth()
+
+def _montar_cloud(provider, api_key, model, config, personalidade):
+    cloud_bot = CloudAIClient(provider=provider, api_key=api_key)
+    cloud_bot.set_config(
+        temperature=config['temperatura'] or 0.7,
+        max_tokens=config['max_tokens'] or 500,
+        model=model
+    )
+    if personalidade:
+        cloud_bot.set_personality(personalidade['system_prompt'])
+    return cloud_bot
 
-def get_smart_bot():
-    """Obtém ou cria instância do bot (Ollama ou Cloud)"""
-    global smart_bot, cloud_bot
-    
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM bot_config WHERE id = 1')
-    config = cursor.fetchone()
-    
-    cursor.execute('SELECT * FROM bot_personalidade WHERE ativo = 1 LIMIT 1')
-    personalidade = cursor.fetchone()
-    conn.close()
+def _montar_ollama(config, personalidade):
+    ollama = OllamaClient(config['ollama_url'] or 'http://localhost:11434')
+    smart_bot = SmartBot(ollama)
+    smart_bot.set_model(
+        config['modelo'] or 'mistral',
+        config['temperatura'] or 0.7,
+        config['max_tokens'] or 500
+    )
+    if personalidade:
+        smart_bot.set_personality(personalidade['system_prompt'])
+    return smart_bot
+
+def _montar_roteador(config, personalidade, usar_cloud):
+    """
+    ProviderRouter com o provedor configurado primeiro, depois os demais
+    provedores em nuvem com chave e por último o Ollama local.
+    None se houver menos de dois provedores.
+    """
+    clients = {}
+    principal = config['cloud_provider'] or 'gemini'
+    if usar_cloud and cloud_ai_available and config['cloud_api_key']:
+        clients[principal] = _montar_cloud(principal, config['cloud_api_key'], config['cloud_model'],
+                                           config, personalidade)
     
-    if not config:
+    if cloud_ai_available:
+        try:
+            chaves = json.loads(config['cloud_api_keys'] or '{}')
+        except ValueError:
+            print("[BOT] cloud_api_keys não é um JSON válido; ignorado")
+            chaves = {}
+        for provider in CloudAIClient.PROVIDERS:
+            api_key = chaves.get(provider) or os.getenv(CLOUD_API_KEY_ENV[provider], '')
+            if provider not in clients and api_key:
+                # Reserva usa o modelo padrão do provedor
+                clients[provider] = _montar_cloud(provider, api_key, None, config, personalidade)
+    
+    if ollama_available:
+        clients['ollama'] = _montar_ollama(config, personalidade)
+    
+    if len(clients) < 2:
         return None
-    
+    return ProviderRouter(clients, provider_health, llm_gateway,
+                          hedge_after=(config['hedge_ms'] or 4000) / 1000)
+
+def _montar_bot(config, personalidade):
+    """Cria o cliente (Ollama, Cloud ou roteador entre provedores) a partir da configuração"""
     # Verificar se deve usar Cloud AI
     usar_cloud = config['usar_cloud'] if 'usar_cloud' in config.keys() else 0
     
+    if 'roteamento_ativo' in config.keys() and config['roteamento_ativo']:
+        roteador = _montar_roteador(config, personalidade, usar_cloud)
+        if roteador:
+            return roteador
+    
     if usar_cloud and cloud_ai_available:
         # Usar API de nuvem (Gemini, OpenAI, Claude)
         provider = config['cloud_provider'] if 'cloud_provider' in config.keys() else 'gemini'
@@ -2157,34 +2539,146 @@ def get_smart_bot():
         cloud_model = config['cloud_model'] if 'cloud_model' in config.keys() else None
         
         if api_key:
-            cloud_bot = CloudAIClient(provider=provider, api_key=api_key)
-            cloud_bot.set_config(
-                temperature=config['temperatura'] or 0.7,
-                max_tokens=config['max_tokens'] or 500,
-                model=cloud_model
-            )
-            
-            if personalidade:
-                cloud_bot.set_personality(personalidade['system_prompt'])
-            
-            return cloud_bot
+            return _montar_cloud(provider, api_key, cloud_model, config, personalidade)
     
     # Usar Ollama local
     if not ollama_available:
         return None
     
-    ollama = OllamaClient(config['ollama_url'] or 'http://localhost:11434')
-    smart_bot = SmartBot(ollama)
-    smart_bot.set_model(
-        config['modelo'] or 'mistral',
-        config['temperatura'] or 0.7,
-        config['max_tokens'] or 500
-    )
-    
-    if personalidade:
-        smart_bot.set_personality(personalidade['system_prompt'])
+    return _montar_ollama(config, personalidade)
+
+def get_bot_cache():
+    """
+    Entrada do cache do bot: {'version', 'config', 'bot', 'respostas_rapidas'}.
+    Só consulta o banco e recria os clientes quando a versão mudou.
+    """
+    global _bot_cache
+    with _bot_cache_lock:
+        if _bot_cache is not None and _bot_cache['version'] == bot_config_version:
+            _bot_cache_stats['hits'] += 1
+            if knowledge_index.stale:
+                reindexar_em_segundo_plano()  # build anterior falhou: nova tentativa
+            return _bot_cache
+        
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM bot_config WHERE id = 1')
+        config = cursor.fetchone()
+        
+        cursor.execute('SELECT * FROM bot_personalidade WHERE ativo = 1 LIMIT 1')
+        personalidade = cursor.fetchone()
+        
+        cursor.execute('SELECT * FROM bot_respostas_rapidas WHERE ativo = 1 ORDER BY prioridade DESC')
+        respostas_rapidas = QuickResponses(dict(row) for row in cursor.fetchall())
+        conn.close()
+        for gatilho in respostas_rapidas.invalidas:
+            print(f"[BOT] Resposta rápida com regex inválida ignorada: {gatilho}")
+        
+        if ollama_available and config:
+            ollama = OllamaClient(config['ollama_url'] or 'http://localhost:11434')
+            if bot_answer_cache.semantic and BOT_CACHE_EMBED_MODEL:
+                bot_answer_cache.set_embedder(ollama_embedder(ollama, BOT_CACHE_EMBED_MODEL))
+            if BOT_KB_EMBED_MODEL:
+                knowledge_index.set_embedder(ollama_embedder(ollama, BOT_KB_EMBED_MODEL),
+                                             f'ollama:{BOT_KB_EMBED_MODEL}')
+        
+        # Índice gerado com outro embedder (ou ainda inexistente): reindexa em
+        # segundo plano; até terminar, a busca usa o índice anterior
+        if knowledge_index.stale:
+            reindexar_em_segundo_plano()
+        
+        bot = _montar_bot(config, personalidade) if config else None
+        if bot:
+            bot.set_knowledge(knowledge_index.retriever(personalidade['id'] if personalidade else None))
+        
+        _bot_cache = {
+            'version': bot_config_version,
+            'config': dict(config) if config else None,
+            'bot': bot,
+            'respostas_rapidas': respostas_rapidas
+        }
+        _bot_cache_stats['rebuilds'] += 1
+        return _bot_cache
+
+def reindexar_conhecimento():
+    """Reindexa bot_conhecimento (só entradas novas/alteradas são recalculadas)"""
+    conn = get_db()
+    try:
+        relatorio = knowledge_index.build(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    return relatorio
+
+_reindex_thread = None
+
+def reindexar_em_segundo_plano():
+    """
+    Reindexa fora do request (uma chamada de embedding por entrada pode levar
+    minutos). Falha não derruba o bot: fica o índice anterior, e nova
+    tentativa só depois de BOT_KB_RETRY_SECONDS.
+    """
+    global _reindex_thread
     
-    return smart_bot
+    def executar():
+        global _reindex_falhou_em
+        try:
+            relatorio = reindexar_conhecimento()
+        except Exception as e:
+            _reindex_falhou_em = time.monotonic()
+            print(f"[BOT] Falha ao reindexar a base de conhecimento (mantido o índice anterior): {e}")
+            return
+        _reindex_falhou_em = None
+        print(f"[BOT] Base de conhecimento reindexada: {relatorio}")
+        invalidar_bot()  # respostas em cache foram geradas com o contexto antigo
+    
+    with _reindex_lock:
+        if _reindex_thread is not None and _reindex_thread.is_alive():
+            return
+        if _reindex_falhou_em is not None and time.monotonic() - _reindex_falhou_em < BOT_KB_RETRY_SECONDS:
+            return
+        _reindex_thread = threading.Thread(target=executar, name='bot-reindex', daemon=True)
+        _reindex_thread.start()
+
+def gerar_resposta_ia(cache, mensagem, historico=None, nome=None):
+    """
+    bot.get_response() pelo gateway. Pedidos idênticos em andamento (mesma
+    configuração, mensagem, histórico e contato) compartilham a chamada.
+    Levanta GatewayBusy (fila cheia) ou GatewayTimeout (prazo estourado).
+    """
+    bot = cache['bot']
+    provider = getattr(bot, 'provider', 'ollama')
+    chave = hashlib.sha1(json.dumps(
+        [cache['version'], mensagem, historico or [], nome], ensure_ascii=False, default=str
+    ).encode('utf-8')).hexdigest()
+    if isinstance(bot, ProviderRouter):
+        # O roteador envia cada provedor ao gateway com o limite do próprio provedor
+        return bot.get_response(mensagem, historico, nome, dedup_key=chave)
+    return llm_gateway.call(provider, bot.get_response, mensagem, historico, nome, dedup_key=chave)
+
+def gerar_stream_ia(cache, mensagem, historico=None, nome=None):
+    """
+    bot.stream_response() segurando uma vaga do provedor no gateway até o fim
+    do stream. Ao iterar, levanta GatewayBusy (fila cheia) ou GatewayTimeout
+    (nenhuma vaga no prazo).
+    """
+    bot = cache['bot']
+    if isinstance(bot, ProviderRouter):
+        # O roteador pega a vaga do provedor que atender
+        yield from bot.stream_response(mensagem, historico, nome)
+        return
+    with llm_gateway.slot(getattr(bot, 'provider', 'ollama')):
+        yield from bot.stream_response(mensagem, historico, nome)
+
+def get_bot_cache_stats():
+    with _bot_cache_lock:
+        stats = dict(_bot_cache_stats)
+        stats['version'] = bot_config_version
+    return stats
+
+def get_smart_bot():
+    """Obtém a instância do bot (Ollama ou Cloud) do cache"""
+    return get_bot_cache()['bot']
 
 @app.route('/api/bot/status')
 def get_bot_status():
@@ -2274,14 +2768,18 @@ def update_bot_config():
     # Campos do Ollama + Cloud AI
     fields = ['ativo', 'modelo', 'ollama_url', 'temperatura', 'max_tokens',
               'resposta_automatica', 'horario_inicio', 'horario_fim', 'dias_semana',
-              'usar_cloud', 'cloud_provider', 'cloud_api_key', 'cloud_model']
+              'usar_cloud', 'cloud_provider', 'cloud_api_key', 'cloud_model',
+              'roteamento_ativo', 'cloud_api_keys', 'hedge_ms']
     
     updates = []
     params = []
     for field in fields:
         if field in data:
+            valor = data[field]
+            if field == 'cloud_api_keys' and isinstance(valor, dict):
+                valor = json.dumps(valor)
             updates.append(f'{field} = ?')
-            params.append(data[field])
+            params.append(valor)
     
     if updates:
         updates.append('updated_at = ?')
@@ -2291,9 +2789,8 @@ def update_bot_config():
     
     conn.close()
     
-    # Resetar bot para pegar novas configurações
-    global smart_bot
-    smart_bot = None
+    # Remontar bot com as novas configurações
+    invalidar_bot()
     
     return jsonify({'success': True})
 
@@ -2303,6 +2800,7 @@ def get_modelos_recomendados():
     return jsonify(MODELOS_RECOMENDADOS)
 
 @app.route('/api/bot/personalidades')
+@response_cache.cached('personalidades', 'unidades')
 def get_personalidades():
     """Lista personalidades do bot"""
     conn = get_db()
@@ -2336,6 +2834,8 @@ def create_personalidade():
     ))
     conn.commit()
     conn.close()
+    response_cache.invalidate('personalidades')
+    invalidar_bot()
     return jsonify({'success': True})
 
 @app.route('/api/bot/personalidades/<int:id>', methods=['PUT'])
@@ -2363,14 +2863,123 @@ def update_personalidade(id):
         conn.commit()
     
     conn.close()
+    response_cache.invalidate('personalidades')
     
-    # Resetar bot
-    global smart_bot
-    smart_bot = None
+    # Remontar bot com a personalidade ativa
+    invalidar_bot()
     
     return jsonify({'success': True})
 
+@app.route('/api/bot/conhecimento')
+def get_conhecimento():
+    """Lista a base de conhecimento do bot"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT k.id, k.personalidade_id, k.titulo, k.conteudo, k.categoria, k.created_at,
+               p.nome as personalidade_nome
+        FROM bot_conhecimento k
+        LEFT JOIN bot_personalidade p ON k.personalidade_id = p.id
+        ORDER BY k.categoria, k.titulo
+    ''')
+    conhecimento = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    return jsonify(conhecimento)
+
+def _atualizar_conhecimento():
+    """Após escrita em bot_conhecimento: reindexa e descarta respostas em cache"""
+    try:
+        relatorio = reindexar_conhecimento()
+    except ValueError as e:
+        return {'error': str(e)}
+    invalidar_bot()
+    return relatorio
+
+@app.route('/api/bot/conhecimento', methods=['POST'])
+def create_conhecimento():
+    """Adiciona uma entrada à base de conhecimento"""
+    data = request.get_json()
+    if not data.get('titulo') or not data.get('conteudo'):
+        return jsonify({'error': 'titulo e conteudo obrigatórios'}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO bot_conhecimento (personalidade_id, titulo, conteudo, categoria)
+        VALUES (?, ?, ?, ?)
+    ''', (
+        data.get('personalidade_id'),
+        data.get('titulo'),
+        data.get('conteudo'),
+        data.get('categoria')
+    ))
+    conhecimento_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return jsonify({'success': True, 'id': conhecimento_id, 'indice': _atualizar_conhecimento()})
+
+@app.route('/api/bot/conhecimento/<int:id>', methods=['PUT'])
+def update_conhecimento(id):
+    """Atualiza uma entrada da base de conhecimento"""
+    data = request.get_json()
+    
+    updates = []
+    params = []
+    for field in ['personalidade_id', 'titulo', 'conteudo', 'categoria']:
+        if field in data:
+            updates.append(f'{field} = ?')
+            params.append(data[field])
+    
+    if not updates:
+        return jsonify({'success': True})
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    params.append(id)
+    cursor.execute(f'UPDATE bot_conhecimento SET {", ".join(updates)} WHERE id = ?', params)
+    conn.commit()
+    alterado = cursor.rowcount
+    conn.close()
+    
+    if not alterado:
+        return jsonify({'error': 'Entrada não encontrada'}), 404
+    return jsonify({'success': True, 'indice': _atualizar_conhecimento()})
+
+@app.route('/api/bot/conhecimento/<int:id>', methods=['DELETE'])
+def delete_conhecimento(id):
+    """Remove uma entrada da base de conhecimento"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM bot_conhecimento WHERE id = ?', (id,))
+    conn.commit()
+    removido = cursor.rowcount
+    conn.close()
+    
+    if not removido:
+        return jsonify({'error': 'Entrada não encontrada'}), 404
+    return jsonify({'success': True, 'indice': _atualizar_conhecimento()})
+
+@app.route('/api/bot/conhecimento/reindexar', methods=['POST'])
+def reindexar_conhecimento_route():
+    """Reindexa toda a base de conhecimento"""
+    relatorio = _atualizar_conhecimento()
+    if 'error' in relatorio:
+        return jsonify(relatorio), 400
+    return jsonify({'success': True, **relatorio})
+
+@app.route('/api/bot/conhecimento/buscar')
+def buscar_conhecimento():
+    """Trechos que seriam incluídos no prompt para uma mensagem (?q=...)"""
+    q = request.args.get('q', '')
+    if not q:
+        return jsonify({'error': 'Parâmetro q obrigatório'}), 400
+    
+    personalidade_id = request.args.get('personalidade_id', type=int)
+    k = request.args.get('k', type=int) or KB_TOP_K
+    return jsonify(knowledge_index.search(q, k, personalidade_id))
+
 @app.route('/api/bot/respostas-rapidas')
+@response_cache.cached('respostas_rapidas')
 def get_respostas_rapidas():
     """Lista respostas rápidas"""
     conn = get_db()
@@ -2385,6 +2994,15 @@ def create_resposta_rapida():
     """Cria resposta rápida"""
     data = request.get_json()
     
+    tipo = data.get('tipo', 'contem')
+    if tipo not in QUICK_RESPONSE_TYPES:
+        return jsonify({'error': f"Tipo inválido: {tipo}"}), 400
+    if tipo == 'regex':
+        try:
+            re.compile(data.get('gatilho') or '')
+        except re.error as e:
+            return jsonify({'error': f'Regex inválida: {e}'}), 400
+    
     conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
@@ -2393,11 +3011,13 @@ def create_resposta_rapida():
     ''', (
         data.get('gatilho'),
         data.get('resposta'),
-        data.get('tipo', 'contem'),
+        tipo,
         data.get('prioridade', 0)
     ))
     conn.commit()
     conn.close()
+    response_cache.invalidate('respostas_rapidas')
+    invalidar_bot()
     return jsonify({'success': True})
 
 @app.route('/api/bot/testar', methods=['POST'])
@@ -2409,18 +3029,13 @@ def testar_bot():
     if not mensagem:
         return jsonify({'error': 'Mensagem obrigatória'}), 400
     
-    bot = get_smart_bot()
+    cache = get_bot_cache()
+    bot = cache['bot']
     if not bot:
         return jsonify({'error': 'Bot não configurado ou Ollama não está rodando'}), 400
     
     # Verificar respostas rápidas primeiro
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM bot_respostas_rapidas WHERE ativo = 1 ORDER BY prioridade DESC')
-    respostas_rapidas = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
-    resposta_rapida = bot.check_quick_response(mensagem, respostas_rapidas)
+    resposta_rapida = cache['respostas_rapidas'].match(mensagem)
     if resposta_rapida:
         return jsonify({
             'success': True,
@@ -2429,10 +3044,26 @@ def testar_bot():
             'tempo': 0
         })
     
+    # Resposta da IA já gerada para a mesma pergunta
+    resposta_cache = bot_answer_cache.get(cache['version'], mensagem)
+    if resposta_cache:
+        return jsonify({
+            'success': True,
+            'resposta': resposta_cache,
+            'tipo': 'cache',
+            'tempo': 0
+        })
+    
     # Gerar resposta com IA
-    response = bot.get_response(mensagem)
+    try:
+        response = gerar_resposta_ia(cache, mensagem)
+    except GatewayBusy:
+        return jsonify({'success': False, 'error': 'Bot ocupado, tente novamente em instantes'}), 503
+    except GatewayTimeout as e:
+        return jsonify({'success': False, 'error': str(e)}), 504
     
     if response.success:
+        bot_answer_cache.put(cache['version'], mensagem, response.message)
         return jsonify({
             'success': True,
             'resposta': response.message,
@@ -2447,6 +3078,100 @@ def testar_bot():
             'error': response.error
         }), 400
 
+def _sse(event: str, data: dict) -> str:
+    """Um evento Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/bot/stream', methods=['GET', 'POST'])
+def stream_bot():
+    """
+    Resposta do bot em streaming (Server-Sent Events), para a página de teste e o chat.
+    GET ?mensagem=...&contact_id=... (EventSource) ou POST com JSON.
+    Com contact_id usa o histórico do contato e grava a troca em bot_historico.
+    
+    Eventos: meta {tipo, modelo} -> token {token}... -> done {resposta, ttft_ms,
+    chunks, chunks_per_s, tokens, tokens_per_s, tempo} | error {error}
+    (tokens/tokens_per_s: contagem do provedor; null se ele não informa)
+    """
+    data = request.get_json(silent=True) or request.args
+    mensagem = data.get('mensagem')
+    contact_id = data.get('contact_id')
+    
+    if not mensagem:
+        return jsonify({'error': 'Mensagem obrigatória'}), 400
+    
+    cache = get_bot_cache()
+    bot = cache['bot']
+    if not bot:
+        return jsonify({'error': 'Bot não configurado ou Ollama não está rodando'}), 400
+    
+    historico = []
+    contact = None
+    if contact_id:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM whatsapp_contacts WHERE id = ?', (contact_id,))
+        contact = cursor.fetchone()
+        cursor.execute('''
+            SELECT role, content FROM bot_historico 
+            WHERE contact_id = ? 
+            ORDER BY created_at DESC LIMIT 10
+        ''', (contact_id,))
+        historico = [dict(row) for row in cursor.fetchall()]
+        historico.reverse()  # Ordem cronológica
+        conn.close()
+    
+    nome = contact['name'] if contact else None
+    modelo = getattr(bot, 'model', None) or getattr(bot.client, 'default_model', None)
+    # Resposta rápida ou resposta da IA já gerada: um único "token"
+    tipo = 'resposta_rapida'
+    resposta_pronta = cache['respostas_rapidas'].match(mensagem)
+    if not resposta_pronta:
+        tipo = 'cache'
+        resposta_pronta = bot_answer_cache.get(cache['version'], mensagem, nome, historico)
+    
+    def gerar():
+        if resposta_pronta:
+            stream = TimedStream(iter([resposta_pronta]))
+            yield _sse('meta', {'tipo': tipo})
+        else:
+            stream = TimedStream(gerar_stream_ia(cache, mensagem, historico, nome))
+            yield _sse('meta', {'tipo': 'ia', 'modelo': modelo})
+        
+        try:
+            for pedaco in stream:
+                yield _sse('token', {'token': pedaco})
+        except GatewayBusy:
+            bot_stream_stats.record(stream.metrics(), error=True)
+            yield _sse('error', {'error': 'Bot ocupado, tente novamente em instantes', **stream.metrics()})
+            return
+        except (StreamError, GatewayTimeout) as e:
+            bot_stream_stats.record(stream.metrics(), error=True)
+            yield _sse('error', {'error': str(e), **stream.metrics()})
+            return
+        
+        metricas = stream.metrics()
+        if not resposta_pronta:
+            bot_stream_stats.record(metricas)
+            bot_answer_cache.put(cache['version'], mensagem, stream.text, nome, historico)
+        
+        if contact_id:
+            conn = get_db()
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO bot_historico (contact_id, role, content) VALUES (?, 'user', ?)
+            ''', (contact_id, mensagem))
+            cursor.execute('''
+                INSERT INTO bot_historico (contact_id, role, content) VALUES (?, 'assistant', ?)
+            ''', (contact_id, stream.text))
+            conn.commit()
+            conn.close()
+        
+        yield _sse('done', {'resposta': stream.text, **metricas})
+    
+    return Response(gerar(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/bot/processar-mensagem', methods=['POST'])
 def processar_mensagem_bot():
     """
@@ -2461,13 +3186,10 @@ def processar_mensagem_bot():
         return jsonify({'error': 'contact_id e mensagem obrigatórios'}), 400
     
     # Verificar se bot está ativo
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM bot_config WHERE id = 1')
-    config = cursor.fetchone()
+    cache = get_bot_cache()
+    config = cache['config']
     
     if not config or not config['ativo'] or not config['resposta_automatica']:
-        conn.close()
         return jsonify({'error': 'Bot não está ativo'}), 400
     
     # Verificar horário de funcionamento
@@ -2476,15 +3198,15 @@ def processar_mensagem_bot():
     dia_semana = str(agora.weekday())
     
     if config['dias_semana'] and dia_semana not in config['dias_semana'].split(','):
-        conn.close()
         return jsonify({'error': 'Fora do horário de atendimento (dia)'}), 400
     
     if config['horario_inicio'] and config['horario_fim']:
         if not (config['horario_inicio'] <= hora_atual <= config['horario_fim']):
-            conn.close()
             return jsonify({'error': 'Fora do horário de atendimento (hora)'}), 400
     
     # Buscar contato e histórico
+    conn = get_db()
+    cursor = conn.cursor()
     cursor.execute('SELECT * FROM whatsapp_contacts WHERE id = ?', (contact_id,))
     contact = cursor.fetchone()
     
@@ -2495,35 +3217,37 @@ def processar_mensagem_bot():
     ''', (contact_id,))
     historico = [dict(row) for row in cursor.fetchall()]
     historico.reverse()  # Ordem cronológica
-    
-    # Verificar respostas rápidas
-    cursor.execute('SELECT * FROM bot_respostas_rapidas WHERE ativo = 1 ORDER BY prioridade DESC')
-    respostas_rapidas = [dict(row) for row in cursor.fetchall()]
-    
     conn.close()
     
-    bot = get_smart_bot()
+    bot = cache['bot']
     if not bot:
         return jsonify({'error': 'Bot não disponível'}), 400
     
-    # Verificar resposta rápida
-    resposta_rapida = bot.check_quick_response(mensagem, respostas_rapidas)
+    # Verificar resposta rápida (lista compilada no cache do bot)
+    resposta_rapida = cache['respostas_rapidas'].match(mensagem)
+    nome = contact['name'] if contact else None
+    resposta_cache = None if resposta_rapida else bot_answer_cache.get(cache['version'], mensagem, nome, historico)
     if resposta_rapida:
         resposta = resposta_rapida
         tipo = 'resposta_rapida'
+    elif resposta_cache:
+        resposta = resposta_cache
+        tipo = 'cache'
     else:
         # Gerar com IA
-        response = bot.get_response(
-            mensagem, 
-            historico, 
-            contact['name'] if contact else None
-        )
+        try:
+            response = gerar_resposta_ia(cache, mensagem, historico, nome)
+        except GatewayBusy:
+            return jsonify({'error': 'Bot ocupado, tente novamente em instantes'}), 503
+        except GatewayTimeout as e:
+            return jsonify({'error': str(e)}), 504
         
         if not response.success:
             return jsonify({'error': response.error}), 400
         
         resposta = response.message
         tipo = 'ia'
+        bot_answer_cache.put(cache['version'], mensagem, resposta, nome, historico)
     
     # Salvar no histórico
     conn = get_db()
@@ -2580,6 +3304,13 @@ def create_lead():
     conn = get_db()
     cursor = conn.cursor()
     
+    # Mesmo número já cadastrado em outro formato
+    cursor.execute('SELECT * FROM leads WHERE telefone_norm = ?', (normalize_phone(telefone),))
+    existente = cursor.fetchone()
+    if existente:
+        conn.close()
+        return jsonify(dict(existente))
+    
     try:
         # Inserir lead
         cursor.execute('''
@@ -2595,7 +3326,11 @@ def create_lead():
         ''', (telefone, nome, lead_id))
         
         contact_id = cursor.lastrowid
-        if contact_id == 0:
+        if cursor.rowcount == 0:
+            # Contato já existia: vincula ao lead novo se ainda estiver solto
+            cursor.execute('''
+                UPDATE whatsapp_contacts SET lead_id = ? WHERE phone = ? AND lead_id IS NULL
+            ''', (lead_id, telefone))
             cursor.execute('SELECT id FROM whatsapp_contacts WHERE phone = ?', (telefone,))
             contact_id = cursor.fetchone()['id']
         
@@ -2606,6 +3341,7 @@ def create_lead():
         ''', (contact_id,))
         
         conn.commit()
+        response_cache.invalidate('cidades')
         
         # Retornar lead criado
         cursor.execute('SELECT * FROM leads WHERE id = ?', (lead_id,))
@@ -2665,6 +3401,7 @@ def update_lead(lead_id):
         ''', params)
         
         conn.commit()
+        response_cache.invalidate('cidades')
     
     conn.close()
     return jsonify({'success': True})
@@ -2696,6 +3433,7 @@ def delete_lead(lead_id):
     
     conn.commit()
     conn.close()
+    response_cache.invalidate('cidades')
     
     return jsonify({'success': True})
 
@@ -2706,20 +3444,15 @@ def get_lead_mensagens(lead_id):
     cursor = conn.cursor()
     
     # Buscar lead e contato associado
-    cursor.execute('''
-        SELECT wc.id as contact_id
-        FROM leads l
-        LEFT JOIN whatsapp_contacts wc ON wc.lead_id = l.id OR wc.phone = l.telefone
-        WHERE l.id = ?
-    ''', (lead_id,))
-    
-    result = cursor.fetchone()
+    cursor.execute('SELECT id, telefone FROM leads WHERE id = ?', (lead_id,))
+    lead = cursor.fetchone()
+    contact = buscar_contatos_dos_leads(cursor, [lead]).get(lead_id) if lead else None
     
-    if not result or not result['contact_id']:
+    if not contact:
         conn.close()
         return jsonify([])
     
-    contact_id = result['contact_id']
+    contact_id = contact['contact_id']
     
     # Buscar mensagens
     cursor.execute('''
@@ -2759,9 +3492,7 @@ def send_lead_mensagem(lead_id):
     telefone = lead['telefone']
     
     # Buscar ou criar contato
-    cursor.execute('SELECT id FROM whatsapp_contacts WHERE phone = ? OR lead_id = ?', 
-                   (telefone, lead_id))
-    contact = cursor.fetchone()
+    contact = buscar_contatos_dos_leads(cursor, [lead]).get(lead_id)
     
     if not contact:
         cursor.execute('''
@@ -2770,7 +3501,7 @@ def send_lead_mensagem(lead_id):
         ''', (telefone, lead['nome'], lead_id))
         contact_id = cursor.lastrowid
     else:
-        contact_id = contact['id']
+        contact_id = contact['contact_id']
     
     # Salvar mensagem localmente
     msg_id = f"local_{datetime.now().timestamp()}"
@@ -2811,16 +3542,12 @@ def marcar_lead_lida(lead_id):
     cursor = conn.cursor()
     
     # Buscar contato do lead
-    cursor.execute('''
-        SELECT wc.id FROM whatsapp_contacts wc
-        JOIN leads l ON wc.lead_id = l.id OR wc.phone = l.telefone
-        WHERE l.id = ?
-    ''', (lead_id,))
-    
-    result = cursor.fetchone()
+    cursor.execute('SELECT id, telefone FROM leads WHERE id = ?', (lead_id,))
+    lead = cursor.fetchone()
+    result = buscar_contatos_dos_leads(cursor, [lead]).get(lead_id) if lead else None
     if result:
         cursor.execute('UPDATE whatsapp_contacts SET unread_count = 0 WHERE id = ?', 
-                       (result['id'],))
+                       (result['contact_id'],))
         conn.commit()
     
     conn.close()
@@ -2830,7 +3557,34 @@ def marcar_lead_lida(lead_id):
 # INICIALIZAÇÃO
 # =============================================================================
 
+_servicos_lock = threading.Lock()
+_servicos_iniciados = False
+
+def iniciar_servicos():
+    """
+    Serviços em segundo plano do processo que atende as requisições
+    (idempotente): workers da fila do webhook, retomada das campanhas e
+    reconciliação periódica dos contadores.
+    Chamado pelo __main__ (só no processo filho do reloader) e, para
+    qualquer outro ponto de entrada, antes do primeiro request.
+    """
+    global _servicos_iniciados
+    with _servicos_lock:
+        if _servicos_iniciados:
+            return
+        _servicos_iniciados = True
+    webhook_workers.start()  # Processa eventos que ficaram na fila antes de reiniciar
+    campaign_engine.resume()
+    stats_reconciler.start()
+
+@app.before_request
+def _iniciar_servicos_no_primeiro_request():
+    if not _servicos_iniciados:
+        iniciar_servicos()
+
 if __name__ == '__main__':
     init_db()
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        iniciar_servicos()  # Só no processo do reloader que atende as requisições
     print("Acesse: http://localhost:5000")
     app.run(debug=True, port=5000)
@@ -7,6 +7,7 @@ WhatsApp Business Cloud API + Supabase
 
 import os
 import re
+import sys
 import json
 import hmac
 import hashlib
@@ -25,6 +26,13 @@ from pathlib import Path
 env_path = Path(__file__).parent / '.env'
 load_dotenv(dotenv_path=env_path)
 
+# Pacotes do gerenciador (dispatcher de confirmações de leitura, normalização de telefone)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from whatsapp.meta_client import ReadReceiptDispatcher
+from whatsapp.scheduler import SendScheduler
+from whatsapp.transport import get_session
+from database.phones import normalize_phone
+
 # ============================================================
 # CONFIGURAÇÃO
 # ============================================================
@@ -58,13 +66,15 @@ class SupabaseClient:
             'Content-Type': 'application/json',
             'Prefer': 'return=representation'
         }
+        # Sessão HTTP compartilhada (keep-alive/pool de conexões)
+        self.session = get_session()
     
     def _request(self, method: str, table: str, data: dict = None, params: dict = None) -> dict:
         """Faz requisição para o Supabase"""
         url = f"{self.url}/rest/v1/{table}"
         
         try:
-            response = requests.request(
+            response = self.session.request(
                 method=method,
                 url=url,
                 headers=self.headers,
@@ -145,7 +155,7 @@ class WhatsAppCloudAPI:
     
     BASE_URL = "https://graph.facebook.com/v22.0"
     
-    def __init__(self):
+    def __init__(self, scheduler: SendScheduler = None):
         self.phone_number_id = os.getenv('WHATSAPP_PHONE_NUMBER_ID')
         self.access_token = os.getenv('WHATSAPP_ACCESS_TOKEN')
         self.verify_token = os.getenv('WHATSAPP_VERIFY_TOKEN')
@@ -155,6 +165,11 @@ class WhatsAppCloudAPI:
             'Authorization': f'Bearer {self.access_token}',
             'Content-Type': 'application/json'
         }
+        
+        # Sessão compartilhada (keep-alive, pool de conexões, retry no adapter)
+        self.session = get_session()
+        # Limites de taxa da Meta (tier, por destinatário, mensagens/s)
+        self.scheduler = scheduler
     
     def _format_phone(self, phone: str) -> str:
         """Formata telefone para o padrão WhatsApp"""
@@ -170,11 +185,15 @@ class WhatsAppCloudAPI:
         return digits
     
     def _make_request(self, endpoint: str, data: dict, method: str = 'POST') -> dict:
-        """Faz requisição para a API do WhatsApp"""
+        """Faz requisição para a API do WhatsApp (envios passam pelo scheduler)"""
         url = f"{self.BASE_URL}/{self.phone_number_id}/{endpoint}"
+        destinatario = data.get('to') if (self.scheduler and data) else None
         
         try:
-            response = requests.request(
+            if destinatario and not self.scheduler.acquire(destinatario):
+                return {'success': False, 'error': 'Envio cancelado antes de sair',
+                        'error_code': SendScheduler.CANCELLED}
+            response = self.session.request(
                 method=method,
                 url=url,
                 headers=self.headers,
@@ -184,6 +203,9 @@ class WhatsAppCloudAPI:
             
             result = response.json()
             
+            if destinatario:
+                self.scheduler.report(destinatario, response.ok, result.get('error', {}).get('code'))
+            
             if response.ok:
                 return {
                     'success': True,
@@ -367,7 +389,7 @@ class WhatsAppCloudAPI:
         url = f"{self.BASE_URL}/{media_id}"
         
         try:
-            response = requests.get(url, headers=self.headers, timeout=30)
+            response = self.session.get(url, headers=self.headers, timeout=30)
             
             if response.ok:
                 data = response.json()
@@ -381,7 +403,7 @@ class WhatsAppCloudAPI:
     def get_media_content(self, media_url: str) -> bytes:
         """Baixa o conteúdo da mídia"""
         try:
-            response = requests.get(
+            response = self.session.get(
                 media_url,
                 headers={'Authorization': f'Bearer {self.access_token}'},
                 timeout=60
@@ -394,7 +416,11 @@ class WhatsAppCloudAPI:
 
 
 # Instância global
-whatsapp = WhatsAppCloudAPI()
+send_scheduler = SendScheduler()
+whatsapp = WhatsAppCloudAPI(scheduler=send_scheduler)
+
+# Confirmações de leitura em segundo plano (só a última mensagem de cada conversa)
+read_receipts = ReadReceiptDispatcher(lambda: whatsapp, max_workers=4)
 
 # ============================================================
 # HELPERS
@@ -432,9 +458,13 @@ def get_or_create_lead(telefone: str, nome: str = None) -> Optional[int]:
     
     # Normalizar telefone
     telefone_limpo = re.sub(r'\D', '', telefone)
+    telefone_norm = normalize_phone(telefone)
     
-    # Buscar lead existente
-    result = supabase.select('leads', filters={'telefone': f'eq.{telefone_limpo}'})
+    # Buscar lead existente (telefone_norm tem índice único, mesmo formato em qualquer origem)
+    if telefone_norm:
+        result = supabase.select('leads', filters={'telefone_norm': f'eq.{telefone_norm}'})
+    else:
+        result = supabase.select('leads', filters={'telefone': f'eq.{telefone_limpo}'})
     
     if result['success'] and result['data']:
         return result['data'][0]['id']
@@ -442,6 +472,7 @@ def get_or_create_lead(telefone: str, nome: str = None) -> Optional[int]:
     # Criar novo lead
     new_lead = {
         'telefone': telefone_limpo,
+        'telefone_norm': telefone_norm,
         'nome': nome or f'Lead {telefone_limpo[-4:]}',
         'origem': 'whatsapp',
         'etapa': 'novo'
@@ -621,8 +652,11 @@ def process_incoming_message(message: dict, contact: dict):
             status='received'
         )
         
-        # Marcar como lida
-        whatsapp.mark_as_read(wamid)
+        # Janela de atendimento aberta: respostas não contam no tier
+        send_scheduler.open_window(telefone)
+        
+        # Marcar como lida (em segundo plano)
+        read_receipts.submit(wamid, conversation=telefone)
         
         # Atualizar último contato do lead
         if lead_id:
@@ -648,6 +682,8 @@ def api_status():
         'status': 'online',
         'whatsapp_configured': bool(whatsapp.phone_number_id and whatsapp.access_token),
         'supabase_configured': bool(supabase.url and supabase.key),
+        'read_receipts': read_receipts.get_stats(),
+        'send_scheduler': send_scheduler.get_stats(),
         'timestamp': datetime.utcnow().isoformat()
     })
 
@@ -0,0 +1,253 @@
+"""
+Cache das respostas geradas pela IA do bot
+
+As mesmas perguntas (preço, horário, endereço) chegam o dia todo; cada uma
+era uma chamada completa ao modelo. O cache guarda a resposta por
+(versão da configuração do bot, mensagem normalizada):
+- Nível exato: mensagem sem acentos, pontuação, maiúsculas e espaços extras
+- Nível semântico (opcional): similaridade de cosseno entre embeddings,
+  pelo modelo de embeddings do Ollama ou, sem ele, um bag-of-words com
+  hashing (features de palavras e trigramas). Só vale entre mensagens com
+  as mesmas negações ("abrem" nunca casa com "não abrem")
+- TTL por entrada e despejo LRU acima de max_entries
+
+Não usa o cache (nem grava) quando a mensagem depende do contato: números
+(telefone, CPF, datas, pedidos), e-mail, possessivos ("meu", "minha"...) ou
+o nome do contato. Respostas que citam o nome do contato não são guardadas.
+Também não usa quando há histórico da conversa: "sim" ou "e o preço?"
+dependem do que veio antes.
+
+A versão da configuração faz parte da chave: trocar modelo, personalidade ou
+respostas rápidas (invalidar_bot()) deixa as respostas antigas inalcançáveis.
+
+Configuração por variáveis de ambiente:
+    BOT_CACHE_MAX            entradas (padrão 500; 0 desliga o cache)
+    BOT_CACHE_TTL            segundos de validade (padrão 3600)
+    BOT_CACHE_SEMANTIC       1 liga o nível semântico (padrão 0)
+    BOT_CACHE_SIMILARITY     cosseno mínimo para acerto semântico (padrão 0.97)
+    BOT_CACHE_EMBED_MODEL    modelo de embeddings do Ollama (ex.: nomic-embed-text);
+                             vazio usa o bag-of-words
+
+Uso:
+    resposta = answer_cache.get(versao, mensagem, contact_name, historico)
+    if resposta is None:
+        resposta = bot.get_response(...).message
+        answer_cache.put(versao, mensagem, resposta, contact_name, historico)
+"""
+
+import os
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Sequence
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = int(os.getenv('BOT_CACHE_MAX', 500))
+DEFAULT_TTL = float(os.getenv('BOT_CACHE_TTL', 3600))
+DEFAULT_SEMANTIC = os.getenv('BOT_CACHE_SEMANTIC', '0') == '1'
+DEFAULT_SIMILARITY = float(os.getenv('BOT_CACHE_SIMILARITY', 0.97))
+EMBED_MODEL = os.getenv('BOT_CACHE_EMBED_MODEL', '')
+
+HASH_DIMENSIONS = 1024
+
+# Mensagens que dependem de quem pergunta: não vão para o cache
+_PESSOAL = re.compile(
+    r'\d|@|\b(meu|minha|meus|minhas|comigo|cpf|rg|protocolo|boleto|fatura)\b'
+)
+# Negações (texto normalizado, sem acentos): invertem o sentido com poucas palavras
+_NEGACAO = re.compile(r'\b(nao|nunca|nem|sem|jamais|nenhum|nenhuma|nada)\b')
+
+
+def normalize_message(message: str) -> str:
+    """Minúsculas, sem acentos, sem pontuação e com espaços simples"""
+    texto = unicodedata.normalize('NFKD', message.lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r'[^\w@]+', ' ', texto)
+    return ' '.join(texto.split())
+
+
+def _mentions_name(normalized: str, contact_name: str = None) -> bool:
+    """O primeiro nome do contato aparece no texto normalizado?"""
+    primeiro = normalize_message(contact_name).split() if contact_name else []
+    return bool(primeiro) and re.search(rf'\b{re.escape(primeiro[0])}\b', normalized) is not None
+
+
+def needs_personal_context(normalized: str, contact_name: str = None) -> bool:
+    return _PESSOAL.search(normalized) is not None or _mentions_name(normalized, contact_name)
+
+
+def negations(normalized: str) -> frozenset:
+    return frozenset(_NEGACAO.findall(normalized))
+
+
+def hashed_bag_of_words(normalized: str, dimensions: int = HASH_DIMENSIONS) -> Optional[np.ndarray]:
+    """Vetor esparso-em-denso de palavras e trigramas com hashing estável (crc32)"""
+    palavras = normalized.split()
+    if not palavras:
+        return None
+    features = palavras + [f'#{p[i:i + 3]}' for p in palavras for i in range(max(len(p) - 2, 1))]
+    vetor = np.zeros(dimensions, dtype=np.float32)
+    for feature in features:
+        h = zlib.crc32(feature.encode('utf-8'))
+        vetor[h % dimensions] += 1.0 if h & 0x80000000 else -1.0
+    return vetor
+
+
+def ollama_embedder(client, model: str) -> Callable[[str], Optional[Sequence[float]]]:
+    """Embedder pelo endpoint /api/embeddings de um OllamaClient"""
+    return lambda texto: client.embeddings(model, texto)
+
+
+class _Entry:
+    __slots__ = ('answer', 'expires', 'vector', 'scope')
+
+    def __init__(self, answer: str, expires: float, vector: Optional[np.ndarray], scope: str):
+        self.answer = answer
+        self.expires = expires
+        self.vector = vector
+        self.scope = scope
+
+
+class AnswerCache:
+    """Cache LRU com TTL de respostas da IA, com nível semântico opcional (thread-safe)"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL,
+                 semantic: bool = DEFAULT_SEMANTIC, similarity: float = DEFAULT_SIMILARITY,
+                 embedder: Callable[[str], Optional[Sequence[float]]] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.semantic = semantic
+        self.similarity = similarity
+        self.embedder = embedder
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[tuple, _Entry]' = OrderedDict()
+        self._stats = {
+            'hits_exact': 0,
+            'hits_semantic': 0,
+            'misses': 0,
+            'bypassed': 0,
+            'stored': 0,
+            'not_stored': 0,
+            'expired': 0,
+            'evictions': 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl > 0
+
+    def set_embedder(self, embedder: Callable[[str], Optional[Sequence[float]]] = None):
+        """Troca o embedder do nível semântico; vetores antigos deixam de ser comparáveis"""
+        with self._lock:
+            self.embedder = embedder
+            for entry in self._entries.values():
+                entry.vector = None
+
+    def _vector(self, normalized: str) -> Optional[np.ndarray]:
+        if not self.semantic:
+            return None
+        if self.embedder is None:
+            vetor = hashed_bag_of_words(normalized)
+        else:
+            bruto = self.embedder(normalized)
+            vetor = None if bruto is None else np.asarray(bruto, dtype=np.float32)
+        if vetor is None:
+            return None
+        norma = float(np.linalg.norm(vetor))
+        return vetor / norma if norma else None
+
+    def cacheable(self, message: str, contact_name: str = None, history: Sequence = None) -> bool:
+        return (self.enabled and not history
+                and not needs_personal_context(normalize_message(message), contact_name))
+
+    def get(self, scope, message: str, contact_name: str = None, history: Sequence = None) -> Optional[str]:
+        """Resposta guardada para a mensagem (exata ou semelhante) ou None"""
+        if not self.enabled:
+            return None
+        normalized = normalize_message(message)
+        if not normalized or history or needs_personal_context(normalized, contact_name):
+            with self._lock:
+                self._stats['bypassed'] += 1
+            return None
+
+        scope = str(scope)
+        key = (scope, normalized)
+        agora = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= agora:
+                del self._entries[key]
+                self._stats['expired'] += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits_exact'] += 1
+                return entry.answer
+            if not self.semantic:
+                self._stats['misses'] += 1
+                return None
+
+        # Nível semântico: embedding fora do lock (pode ser uma chamada HTTP)
+        vetor = self._vector(normalized)
+        with self._lock:
+            negacoes = negations(normalized)
+            candidatos = [(k, e) for k, e in self._entries.items()
+                          if e.scope == scope and e.vector is not None and e.expires > agora
+                          and negations(k[1]) == negacoes]
+            if vetor is not None and candidatos:
+                matriz = np.stack([e.vector for _, e in candidatos])
+                if matriz.shape[1] == vetor.shape[0]:
+                    scores = matriz @ vetor
+                    melhor = int(np.argmax(scores))
+                    if scores[melhor] >= self.similarity:
+                        chave, entry = candidatos[melhor]
+                        self._entries.move_to_end(chave)
+                        self._stats['hits_semantic'] += 1
+                        return entry.answer
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, scope, message: str, answer: str, contact_name: str = None,
+            history: Sequence = None) -> bool:
+        """Guarda a resposta; False se a mensagem/resposta é pessoal, vazia ou depende do histórico"""
+        if not self.enabled or not answer or history:
+            return False
+        normalized = normalize_message(message)
+        if not normalized or needs_personal_context(normalized, contact_name):
+            return False
+        if _mentions_name(normalize_message(answer), contact_name):
+            with self._lock:
+                self._stats['not_stored'] += 1
+            return False
+
+        vetor = self._vector(normalized)
+        scope = str(scope)
+        with self._lock:
+            key = (scope, normalized)
+            self._entries[key] = _Entry(answer, time.monotonic() + self.ttl, vetor, scope)
+            self._entries.move_to_end(key)
+            self._stats['stored'] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        hits = stats['hits_exact'] + stats['hits_semantic']
+        consultas = hits + stats['misses']
+        stats['hit_ratio'] = round(hits / consultas, 3) if consultas else 0.0
+        stats['enabled'] = self.enabled
+        stats['semantic'] = self.semantic
+        stats['embedder'] = 'ollama' if self.embedder is not None else ('hashed_bow' if self.semantic else None)
+        return stats
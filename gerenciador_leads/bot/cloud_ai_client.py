@@ -15,6 +15,12 @@ from typing import List, Dict, Optional, Generator
 from datetime import datetime
 import time
 
+from whatsapp.transport import get_session
+
+from .quick_responses import QuickResponses
+from .knowledge import knowledge_prompt
+from .streaming import StreamError, StreamUsage, iter_sse_data
+
 
 @dataclass
 class AIResponse:
@@ -28,6 +34,26 @@ class AIResponse:
     provider: str = ""
 
 
+def _sse_events(session: requests.Session, url: str, payload: Dict,
+                timeout: float, headers: Dict = None) -> Generator[Dict, None, None]:
+    """POST com stream=True; eventos JSON da resposta SSE. Falhas levantam StreamError."""
+    try:
+        response = session.post(url, headers=headers, json=payload, timeout=timeout, stream=True)
+        with response:
+            if response.status_code != 200:
+                raise StreamError(f"Erro {response.status_code}: {response.text[:200]}")
+            yield from iter_sse_data(response)
+    except requests.exceptions.Timeout:
+        raise StreamError("Timeout - API demorou muito para responder")
+    except requests.exceptions.ConnectionError as e:
+        raise StreamError(f"Falha de conexão: {e}")
+    except requests.exceptions.RequestException as e:
+        # Ex.: ChunkedEncodingError com a conexão caindo no meio do stream
+        raise StreamError(f"Falha no stream: {e}")
+    except ValueError as e:
+        raise StreamError(f"Resposta inválida da API: {e}")
+
+
 # ==================== GOOGLE GEMINI ====================
 class GeminiClient:
     """
@@ -43,8 +69,9 @@ class GeminiClient:
     - 1 milhão tokens/dia
     """
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, session: requests.Session = None):
         self.api_key = api_key
+        self.session = session or get_session('bot')
         self.base_url = "https://generativelanguage.googleapis.com/v1beta"
         self.default_model = "gemini-2.0-flash"
         self.timeout = 60
@@ -54,7 +81,7 @@ class GeminiClient:
         if not self.api_key:
             return False
         try:
-            response = requests.get(
+            response = self.session.get(
                 f"{self.base_url}/models?key={self.api_key}",
                 timeout=10
             )
@@ -65,7 +92,7 @@ class GeminiClient:
     def list_models(self) -> List[str]:
         """Lista modelos disponíveis"""
         try:
-            response = requests.get(
+            response = self.session.get(
                 f"{self.base_url}/models?key={self.api_key}",
                 timeout=10
             )
@@ -123,7 +150,7 @@ class GeminiClient:
         }
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/models/{model}:generateContent?key={self.api_key}",
                 json=payload,
                 timeout=self.timeout
@@ -214,7 +241,7 @@ class GeminiClient:
         }
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/models/{model}:generateContent?key={self.api_key}",
                 json=payload,
                 timeout=self.timeout
@@ -251,6 +278,41 @@ class GeminiClient:
                 error=str(e),
                 provider="gemini"
             )
+    
+    def chat_stream(self, messages: List[Dict],
+                    model: str = None,
+                    temperature: float = 0.7,
+                    max_tokens: int = 500) -> Generator[str, None, None]:
+        """Chat com streaming (streamGenerateContent via SSE)"""
+        model = model or self.default_model
+        
+        contents = []
+        for msg in messages:
+            role = "user" if msg.get('role') in ['user', 'system'] else "model"
+            contents.append({
+                "role": role,
+                "parts": [{"text": msg.get('content', '')}]
+            })
+        
+        payload = {
+            "contents": contents,
+            "generationConfig": {
+                "temperature": temperature,
+                "maxOutputTokens": max_tokens
+            }
+        }
+        
+        url = f"{self.base_url}/models/{model}:streamGenerateContent?alt=sse&key={self.api_key}"
+        tokens = None
+        for event in _sse_events(self.session, url, payload, self.timeout):
+            # usageMetadata é cumulativo: vale o do último evento
+            tokens = event.get('usageMetadata', {}).get('candidatesTokenCount', tokens)
+            for candidate in event.get('candidates', [])[:1]:
+                for part in candidate.get('content', {}).get('parts', []):
+                    if part.get('text'):
+                        yield part['text']
+        if tokens is not None:
+            yield StreamUsage(tokens)
 
 
 # ==================== OPENAI ====================
@@ -264,8 +326,9 @@ class OpenAIClient:
     - gpt-3.5-turbo: Legado, barato
     """
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, session: requests.Session = None):
         self.api_key = api_key
+        self.session = session or get_session('bot')
         self.base_url = "https://api.openai.com/v1"
         self.default_model = "gpt-4o-mini"
         self.timeout = 60
@@ -274,7 +337,7 @@ class OpenAIClient:
         if not self.api_key:
             return False
         try:
-            response = requests.get(
+            response = self.session.get(
                 f"{self.base_url}/models",
                 headers={"Authorization": f"Bearer {self.api_key}"},
                 timeout=10
@@ -305,7 +368,7 @@ class OpenAIClient:
         }
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/chat/completions",
                 headers={
                     "Authorization": f"Bearer {self.api_key}",
@@ -367,7 +430,7 @@ class OpenAIClient:
         }
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/chat/completions",
                 headers={
                     "Authorization": f"Bearer {self.api_key}",
@@ -402,6 +465,39 @@ class OpenAIClient:
                 error=str(e),
                 provider="openai"
             )
+    
+    def chat_stream(self, messages: List[Dict],
+                    model: str = None,
+                    temperature: float = 0.7,
+                    max_tokens: int = 500) -> Generator[str, None, None]:
+        """Chat com streaming (stream: true, deltas via SSE)"""
+        payload = {
+            "model": model or self.default_model,
+            "messages": [
+                {"role": m.get('role', 'user'), "content": m.get('content', '')}
+                for m in messages
+            ],
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": True,
+            "stream_options": {"include_usage": True}  # último evento traz o usage
+        }
+        
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        tokens = None
+        for event in _sse_events(self.session, f"{self.base_url}/chat/completions",
+                                 payload, self.timeout, headers):
+            if event.get('usage'):
+                tokens = event['usage'].get('completion_tokens', tokens)
+            for choice in event.get('choices', [])[:1]:
+                content = (choice.get('delta') or {}).get('content')
+                if content:
+                    yield content
+        if tokens is not None:
+            yield StreamUsage(tokens)
 
 
 # ==================== ANTHROPIC CLAUDE ====================
@@ -414,8 +510,9 @@ class ClaudeClient:
     - claude-3-haiku-20240307: Mais rápido e barato
     """
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, session: requests.Session = None):
         self.api_key = api_key
+        self.session = session or get_session('bot')
         self.base_url = "https://api.anthropic.com/v1"
         self.default_model = "claude-3-haiku-20240307"
         self.timeout = 60
@@ -441,7 +538,7 @@ class ClaudeClient:
             payload["system"] = system_prompt
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/messages",
                 headers={
                     "x-api-key": self.api_key,
@@ -480,6 +577,45 @@ class ClaudeClient:
                 error=str(e),
                 provider="claude"
             )
+    
+    def chat_stream(self, messages: List[Dict],
+                    model: str = None,
+                    temperature: float = 0.7,
+                    max_tokens: int = 500) -> Generator[str, None, None]:
+        """Chat com streaming (eventos content_block_delta via SSE)"""
+        system = "\n\n".join(m.get('content', '') for m in messages if m.get('role') == 'system')
+        payload = {
+            "model": model or self.default_model,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "messages": [
+                {"role": m.get('role', 'user'), "content": m.get('content', '')}
+                for m in messages if m.get('role') != 'system'
+            ],
+            "stream": True
+        }
+        if system:
+            payload["system"] = system
+        
+        headers = {
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01",
+            "Content-Type": "application/json"
+        }
+        tokens = None
+        for event in _sse_events(self.session, f"{self.base_url}/messages",
+                                 payload, self.timeout, headers):
+            if event.get('type') == 'error':
+                raise StreamError(event.get('error', {}).get('message', 'Erro no stream'))
+            if event.get('type') == 'content_block_delta':
+                text = event.get('delta', {}).get('text')
+                if text:
+                    yield text
+            elif event.get('type') == 'message_delta':
+                # output_tokens acumulado da resposta
+                tokens = event.get('usage', {}).get('output_tokens', tokens)
+        if tokens is not None:
+            yield StreamUsage(tokens)
 
 
 # ==================== CLIENTE UNIFICADO ====================
@@ -521,6 +657,7 @@ class CloudAIClient:
         self.temperature = 0.7
         self.max_tokens = 500
         self.model = None
+        self.knowledge = None  # mensagem -> trechos da base de conhecimento
     
     def _create_client(self, provider: str, api_key: str):
         """Cria o cliente apropriado para o provedor"""
@@ -543,6 +680,10 @@ class CloudAIClient:
         """Define a personalidade do bot"""
         self.system_prompt = system_prompt
     
+    def set_knowledge(self, retriever):
+        """Define a busca na base de conhecimento (top-k trechos entram no prompt)"""
+        self.knowledge = retriever
+    
     def set_config(self, temperature: float = None, max_tokens: int = None, model: str = None):
         """Configura parâmetros"""
         if temperature is not None:
@@ -556,6 +697,13 @@ class CloudAIClient:
         """Verifica se a API está disponível"""
         return self.client.is_available() if self.client else False
     
+    def _system_prompt(self, message: str, contact_name: str = None) -> str:
+        """Personalidade + trechos da base de conhecimento + nome do contato"""
+        system = self.system_prompt + knowledge_prompt(self.knowledge, message)
+        if contact_name:
+            system += f"\n\nO cliente se chama: {contact_name}"
+        return system
+    
     def get_response(self, message: str, 
                      conversation_history: List[Dict] = None,
                      contact_name: str = None) -> AIResponse:
@@ -571,9 +719,7 @@ class CloudAIClient:
             )
         
         # Construir system prompt
-        system = self.system_prompt
-        if contact_name:
-            system += f"\n\nO cliente se chama: {contact_name}"
+        system = self._system_prompt(message, contact_name)
         
         # Se tiver histórico, usar chat
         if conversation_history:
@@ -600,25 +746,41 @@ class CloudAIClient:
                 max_tokens=self.max_tokens
             )
     
-    def check_quick_response(self, message: str, quick_responses: List[Dict]) -> Optional[str]:
+    def stream_response(self, message: str,
+                        conversation_history: List[Dict] = None,
+                        contact_name: str = None) -> Generator[str, None, None]:
         """
-        Verifica se há uma resposta rápida para a mensagem.
-        Mesma assinatura do SmartBot.
+        Mesmo que get_response(), mas devolve os pedaços da resposta conforme
+        chegam. Compatível com SmartBot.stream_response().
         """
-        message_lower = message.lower().strip()
+        if not self.client:
+            raise StreamError('Cliente não configurado')
         
-        for qr in quick_responses:
-            gatilho = qr.get('gatilho', '').lower()
-            tipo = qr.get('tipo', 'contem')
-            
-            if tipo == 'exato' and message_lower == gatilho:
-                return qr.get('resposta')
-            elif tipo == 'contem' and gatilho in message_lower:
-                return qr.get('resposta')
-            elif tipo == 'comeca' and message_lower.startswith(gatilho):
-                return qr.get('resposta')
+        system = self._system_prompt(message, contact_name)
         
-        return None
+        messages = [{"role": "system", "content": system}] if system else []
+        for msg in (conversation_history or [])[-10:]:  # Últimas 10 mensagens
+            messages.append({
+                "role": msg.get('role', 'user'),
+                "content": msg.get('content', '')
+            })
+        messages.append({"role": "user", "content": message})
+        
+        return self.client.chat_stream(
+            messages=messages,
+            model=self.model,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens
+        )
+    
+    def check_quick_response(self, message: str, quick_responses) -> Optional[str]:
+        """
+        Verifica se há uma resposta rápida para a mensagem.
+        Mesma assinatura do SmartBot.
+        """
+        if not isinstance(quick_responses, QuickResponses):
+            quick_responses = QuickResponses(quick_responses)
+        return quick_responses.match(message)
     
     @classmethod
     def get_provider_info(cls) -> Dict:
@@ -0,0 +1,323 @@
+"""
+Gateway assíncrono das chamadas de IA (Ollama e provedores em nuvem)
+
+As rotas Flask não chamam mais o modelo direto no thread do request: enviam
+para o gateway e esperam com prazo. O gateway roda um event loop asyncio
+num thread próprio e:
+- Limita a concorrência por provedor (ollama=1, nuvem=4 por padrão)
+- Aceita no máximo max_pending pedidos (executando + na fila); acima disso
+  recusa na hora (GatewayBusy) em vez de prender mais threads do servidor
+- Deduplica prompts idênticos em andamento: quem pede a mesma coisa
+  aguarda a mesma chamada
+- Cancela: prazo estourado em todos os interessados cancela a chamada; se
+  ainda estava na fila ela nem chega ao provedor
+- Mede profundidade da fila e histogramas de espera e latência
+- Streams (SSE) não cabem em submit(): seguram uma vaga do provedor com
+  slot() durante toda a geração, com os mesmos limites e métricas
+
+As chamadas em si continuam sendo os clientes síncronos (requests.Session
+compartilhada), executados num pool de threads limitado. Uma chamada
+cancelada já em andamento não é interrompida, mas segura a vaga do
+provedor até terminar, para o limite de concorrência continuar valendo.
+
+Configuração por variáveis de ambiente:
+    BOT_GATEWAY_LIMITS        'ollama=1,gemini=4,openai=4,claude=4'
+    BOT_GATEWAY_DEFAULT_LIMIT provedores não listados (padrão 2)
+    BOT_GATEWAY_MAX_PENDING   chamadas aceitas ao mesmo tempo (padrão 32)
+    BOT_GATEWAY_WORKERS       threads que executam as chamadas (padrão 16)
+    BOT_GATEWAY_TIMEOUT       prazo padrão de espera em segundos (padrão 60)
+
+Uso:
+    llm_gateway = LLMGateway()
+    resposta = llm_gateway.call('ollama', bot.get_response, mensagem,
+                                dedup_key=chave, timeout=30)
+
+    with llm_gateway.slot('ollama'):
+        for pedaco in bot.stream_response(mensagem):
+            ...
+"""
+
+import asyncio
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable, Optional
+
+DEFAULT_LIMITS = {'ollama': 1, 'gemini': 4, 'openai': 4, 'claude': 4}
+DEFAULT_LIMIT = int(os.getenv('BOT_GATEWAY_DEFAULT_LIMIT', 2))
+DEFAULT_MAX_PENDING = int(os.getenv('BOT_GATEWAY_MAX_PENDING', 32))
+DEFAULT_WORKERS = int(os.getenv('BOT_GATEWAY_WORKERS', 16))
+DEFAULT_TIMEOUT = float(os.getenv('BOT_GATEWAY_TIMEOUT', 60))
+
+# Limites do histograma em segundos (o último balde é +inf)
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def parse_limits(texto: str) -> Dict[str, int]:
+    """'ollama=1,gemini=4' -> {'ollama': 1, 'gemini': 4}"""
+    limites = {}
+    for parte in (texto or '').split(','):
+        if '=' in parte:
+            nome, valor = parte.split('=', 1)
+            limites[nome.strip()] = int(valor)
+    return limites
+
+
+class GatewayBusy(Exception):
+    """Fila cheia: a chamada foi recusada sem ser enviada"""
+
+
+class GatewayTimeout(Exception):
+    """O prazo de espera acabou antes da resposta"""
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, segundos: float):
+        self.counts[bisect_left(BUCKETS, segundos)] += 1
+        self.total += segundos
+        self.count += 1
+
+    def snapshot(self) -> Dict:
+        buckets = {f'le_{b}': c for b, c in zip(BUCKETS, self.counts)}
+        buckets['le_inf'] = self.counts[-1]
+        return {
+            'buckets': buckets,
+            'count': self.count,
+            'avg': round(self.total / self.count, 3) if self.count else None,
+        }
+
+
+class LLMGateway:
+    """Event loop asyncio num thread dedicado que agenda as chamadas de IA"""
+
+    def __init__(self, limits: Dict[str, int] = None, default_limit: int = DEFAULT_LIMIT,
+                 max_pending: int = DEFAULT_MAX_PENDING, workers: int = DEFAULT_WORKERS,
+                 timeout: float = DEFAULT_TIMEOUT):
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(parse_limits(os.getenv('BOT_GATEWAY_LIMITS', '')))
+        self.limits.update(limits or {})
+        self.default_limit = default_limit
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._workers = workers
+
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+        # Estado do loop (só acessado dentro do event loop)
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[Hashable, int] = {}
+
+        # Contadores (protegidos por _lock)
+        self._pending = 0
+        self._running: Dict[str, int] = {}
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'deduplicated': 0,
+            'rejected': 0,
+            'timeouts': 0,
+            'cancelled': 0,
+            'errors': 0,
+            'streams': 0,
+        }
+        self._wait_hist = _Histogram()
+        self._latency_hist = _Histogram()
+
+    # ==================== CICLO DE VIDA ====================
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='llm-gateway')
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever, name='llm-gateway-loop', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            loop, thread, executor = self._loop, self._thread, self._executor
+            self._loop = self._thread = self._executor = None
+        if loop is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # ==================== NO EVENT LOOP ====================
+
+    def _semaphore(self, provider: str) -> asyncio.Semaphore:
+        if provider not in self._semaphores:
+            self._semaphores[provider] = asyncio.Semaphore(self.limits.get(provider, self.default_limit))
+        return self._semaphores[provider]
+
+    async def _acquire(self, provider: str) -> asyncio.Semaphore:
+        semaforo = self._semaphore(provider)
+        enfileirado = time.perf_counter()
+        await semaforo.acquire()
+        with self._lock:
+            self._wait_hist.observe(time.perf_counter() - enfileirado)
+            self._running[provider] = self._running.get(provider, 0) + 1
+        return semaforo
+
+    def _released(self, provider: str, inicio: float):
+        with self._lock:
+            self._running[provider] -= 1
+            self._latency_hist.observe(time.perf_counter() - inicio)
+
+    async def _execute(self, provider: str, fn: Callable, args, kwargs):
+        semaforo = await self._acquire(provider)
+        inicio = time.perf_counter()
+
+        def liberar(_=None):
+            semaforo.release()
+            self._released(provider, inicio)
+
+        chamada = asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        try:
+            return await asyncio.shield(chamada)
+        finally:
+            if chamada.done():
+                liberar()
+            else:
+                # Cancelada no meio: a vaga só volta quando a chamada HTTP terminar
+                chamada.add_done_callback(liberar)
+
+    async def _wait(self, key: Optional[Hashable], provider: str, fn: Callable, args, kwargs):
+        task = self._inflight.get(key) if key is not None else None
+        if task is not None:
+            with self._lock:
+                self._stats['deduplicated'] += 1
+        else:
+            task = asyncio.ensure_future(self._execute(provider, fn, args, kwargs))
+            if key is None:
+                key = object()  # sem deduplicação: espera exclusiva
+            else:
+                self._inflight[key] = task
+                task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Ninguém mais espera por esta chamada: cancela (sai da fila se ainda não começou)
+            if self._waiters.get(key, 0) <= 1:
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    # ==================== API (threads do Flask) ====================
+
+    def _admit(self):
+        """Conta um pedido pendente ou recusa (GatewayBusy) se a fila está cheia"""
+        with self._lock:
+            self._stats['submitted'] += 1
+            if self._pending >= self.max_pending:
+                self._stats['rejected'] += 1
+                raise GatewayBusy(f'{self._pending} chamadas de IA pendentes')
+            self._pending += 1
+
+    def submit(self, provider: str, fn: Callable, *args, dedup_key: Hashable = None, **kwargs):
+        """
+        Agenda fn(*args, **kwargs) e devolve um concurrent.futures.Future.
+        Com dedup_key, chamadas iguais em andamento são compartilhadas.
+        GatewayBusy se o limite de chamadas pendentes foi atingido.
+        """
+        self.start()
+        key = None if dedup_key is None else (provider, dedup_key)
+        self._admit()
+
+        future = asyncio.run_coroutine_threadsafe(self._wait(key, provider, fn, args, kwargs), self._loop)
+
+        def concluir(f):
+            with self._lock:
+                self._pending -= 1
+                if f.cancelled():
+                    self._stats['cancelled'] += 1
+                elif f.exception() is not None:
+                    self._stats['errors'] += 1
+                else:
+                    self._stats['completed'] += 1
+        future.add_done_callback(concluir)
+        return future
+
+    def call(self, provider: str, fn: Callable, *args, timeout: float = None,
+             dedup_key: Hashable = None, **kwargs):
+        """Agenda e espera o resultado até o prazo (GatewayTimeout); ao estourar, cancela"""
+        future = self.submit(provider, fn, *args, dedup_key=dedup_key, **kwargs)
+        try:
+            return future.result(timeout=self.timeout if timeout is None else timeout)
+        except FutureTimeout:
+            future.cancel()
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise GatewayTimeout('A IA não respondeu dentro do prazo')
+
+    @contextmanager
+    def slot(self, provider: str, timeout: float = None):
+        """
+        Segura uma vaga do provedor durante o bloco (streams, que não cabem em
+        submit()). Conta no limite de pendentes e nas métricas como as chamadas.
+        GatewayBusy se a fila está cheia; GatewayTimeout se a vaga não saiu no prazo.
+        """
+        self.start()
+        self._admit()
+        loop = self._loop
+        future = asyncio.run_coroutine_threadsafe(self._acquire(provider), loop)
+        try:
+            semaforo = future.result(timeout=self.timeout if timeout is None else timeout)
+        except FutureTimeout:
+            enfileirado = time.perf_counter()
+
+            def devolver(f):
+                # A vaga saiu junto com o prazo: devolve
+                if not f.cancelled() and f.exception() is None:
+                    loop.call_soon_threadsafe(f.result().release)
+                    self._released(provider, enfileirado)
+            future.cancel()
+            future.add_done_callback(devolver)
+            with self._lock:
+                self._pending -= 1
+                self._stats['timeouts'] += 1
+            raise GatewayTimeout('Nenhuma vaga do provedor de IA dentro do prazo')
+
+        inicio = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            loop.call_soon_threadsafe(semaforo.release)
+            self._released(provider, inicio)
+            with self._lock:
+                self._pending -= 1
+                self._stats['streams'] += 1
+                self._stats['completed' if ok else 'errors'] += 1
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            running = {p: n for p, n in self._running.items() if n}
+            stats['pending'] = self._pending
+            stats['running'] = running
+            stats['queue_depth'] = max(self._pending - sum(running.values()), 0)
+            stats['max_pending'] = self.max_pending
+            stats['limits'] = dict(self.limits)
+            stats['queue_wait_seconds'] = self._wait_hist.snapshot()
+            stats['latency_seconds'] = self._latency_hist.snapshot()
+        return stats
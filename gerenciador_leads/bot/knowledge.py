@@ -0,0 +1,346 @@
+"""
+Base de conhecimento do bot (RAG) sobre bot_conhecimento
+
+Em vez de crescer o system prompt da personalidade, os textos da base são
+divididos em trechos, convertidos em vetores e gravados num índice NumPy em
+disco. A cada mensagem só os top-k trechos mais próximos entram no prompt,
+que fica com tamanho constante qualquer que seja o tamanho da base.
+
+Ingestão (KnowledgeIndex.build):
+    linhas de bot_conhecimento -> trechos (chunk_text) -> embeddings -> índice
+    O vetor de cada entrada fica também na coluna bot_conhecimento.embedding
+    (com o hash do conteúdo e o nome do embedder): reindexar só recalcula as
+    entradas novas ou alteradas.
+
+Índice em disco (BOT_KB_DIR, padrão bot_index/ ao lado do banco):
+    vectors-<n>.npy  float32 N x D, linhas normalizadas, aberto com mmap
+    chunks.json      embedder, arquivo de vetores atual e os trechos
+                     (texto, entrada, personalidade)
+    Cada build grava um novo vectors-<n>.npy e troca chunks.json com os.replace:
+    leitores nunca veem meio índice e o arquivo mapeado nunca é sobrescrito
+    (no Windows um arquivo aberto com mmap não pode ser substituído).
+
+Embedder: modelo de embeddings do Ollama (BOT_KB_EMBED_MODEL, padrão o mesmo
+do cache de respostas) ou, sem ele, o bag-of-words com hashing.
+Build com falha de embedding em alguma entrada (ex.: Ollama fora do ar) não
+troca o índice: fica o anterior, marcado como desatualizado para nova tentativa.
+Trocar o embedder deixa o índice desatualizado (stale) até o próximo build,
+mas a busca continua no índice anterior com o embedder que o gerou; se ele
+não é conhecido neste processo, os trechos são comparados por bag-of-words
+(texto puro).
+
+Uso:
+    knowledge_index = KnowledgeIndex(pasta)
+    knowledge_index.load()
+    knowledge_index.build(conn)                  # após criar/editar entradas
+    knowledge_index.search('qual o horário?', k=3, personalidade_id=1)
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .answer_cache import EMBED_MODEL as CACHE_EMBED_MODEL, hashed_bag_of_words, normalize_message
+
+EMBED_MODEL = os.getenv('BOT_KB_EMBED_MODEL', CACHE_EMBED_MODEL)
+TOP_K = int(os.getenv('BOT_KB_TOP_K', 3))
+MIN_SCORE = float(os.getenv('BOT_KB_MIN_SCORE', 0.3))
+CHUNK_CHARS = int(os.getenv('BOT_KB_CHUNK_CHARS', 600))
+
+HASHED_EMBEDDER = 'hashed_bow'
+
+_CHUNKS = 'chunks.json'
+
+
+def chunk_text(titulo: str, conteudo: str, max_chars: int = CHUNK_CHARS) -> List[str]:
+    """
+    Divide o conteúdo em trechos de até max_chars, quebrando em parágrafos e
+    frases; cada trecho leva o título para não perder o assunto.
+    """
+    frases = []
+    for paragrafo in re.split(r'\n\s*\n', conteudo or ''):
+        paragrafo = ' '.join(paragrafo.split())
+        if paragrafo:
+            frases.extend(re.split(r'(?<=[.!?])\s+', paragrafo))
+
+    trechos, atual = [], ''
+    for frase in frases:
+        while len(frase) > max_chars:
+            if atual:
+                trechos.append(atual)
+                atual = ''
+            trechos.append(frase[:max_chars])
+            frase = frase[max_chars:]
+        if atual and len(atual) + 1 + len(frase) > max_chars:
+            trechos.append(atual)
+            atual = frase
+        else:
+            atual = f'{atual} {frase}'.strip()
+    if atual:
+        trechos.append(atual)
+
+    titulo = (titulo or '').strip()
+    return [f'{titulo}: {t}' if titulo else t for t in trechos] or ([titulo] if titulo else [])
+
+
+def _normalize_rows(vetores: np.ndarray) -> np.ndarray:
+    normas = np.linalg.norm(vetores, axis=1, keepdims=True)
+    normas[normas == 0] = 1.0
+    return (vetores / normas).astype(np.float32)
+
+
+def knowledge_prompt(retriever, message: str) -> str:
+    """Trechos da base de conhecimento relevantes para a mensagem, prontos para o system prompt"""
+    if not retriever:
+        return ""
+    trechos = retriever(message)
+    if not trechos:
+        return ""
+    return ("\n\nInformações da base de conhecimento (use apenas se forem relevantes):\n"
+            + "\n".join(f"- {t}" for t in trechos))
+
+
+class KnowledgeIndex:
+    """Índice vetorial em disco (memmap) dos trechos da base de conhecimento"""
+
+    def __init__(self, directory: str, embedder: Callable[[str], Optional[Sequence[float]]] = None,
+                 embedder_name: str = HASHED_EMBEDDER):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None
+        self._chunks: List[Dict] = []
+        self._personalidades: Optional[np.ndarray] = None
+        self._fallback: Optional[np.ndarray] = None
+        self.loaded_embedder: Optional[str] = None
+        self._incomplete = False  # último build falhou: índice carregado é o anterior
+        self._embedders: Dict[str, Optional[Callable]] = {HASHED_EMBEDDER: None}
+        self.set_embedder(embedder, embedder_name)
+        self._stats = {'searches': 0, 'fallback_searches': 0, 'builds': 0,
+                       'embedded': 0, 'reused': 0, 'embed_errors': 0}
+
+    def set_embedder(self, embedder: Callable[[str], Optional[Sequence[float]]] = None,
+                     embedder_name: str = HASHED_EMBEDDER):
+        """Sem embedder usa o bag-of-words com hashing"""
+        self.embedder = embedder
+        self.embedder_name = embedder_name if embedder is not None else HASHED_EMBEDDER
+        # Embedders já vistos: o índice anterior continua pesquisável até o novo build
+        self._embedders[self.embedder_name] = embedder
+
+    @property
+    def stale(self) -> bool:
+        """O índice carregado foi gerado por outro embedder (ou não existe) ou o último build falhou"""
+        return self._incomplete or self.loaded_embedder != self.embedder_name
+
+    def _embed(self, texto: str, embedder: Optional[Callable] = None, hashed: bool = None) -> Optional[np.ndarray]:
+        """Vetor pelo embedder atual (ou pelo informado; hashed=True força o bag-of-words)"""
+        if hashed is None:
+            embedder, hashed = self.embedder, self.embedder is None
+        if hashed:
+            return hashed_bag_of_words(normalize_message(texto))
+        bruto = embedder(texto)
+        return None if bruto is None else np.asarray(bruto, dtype=np.float32)
+
+    def _fallback_vectors(self, chunks: List[Dict]) -> Optional[np.ndarray]:
+        """Bag-of-words dos trechos carregados (calculado uma vez por load)"""
+        with self._lock:
+            if self._fallback is None and chunks:
+                vetores = [hashed_bag_of_words(normalize_message(c['texto'])) for c in chunks]
+                if all(v is not None for v in vetores):
+                    self._fallback = _normalize_rows(np.stack(vetores))
+            return self._fallback
+
+    # ==================== DISCO ====================
+
+    def load(self) -> bool:
+        """Abre o índice gravado (vetores via mmap); False se não existe"""
+        caminho_chunks = os.path.join(self.directory, _CHUNKS)
+        if not os.path.exists(caminho_chunks):
+            return False
+        with open(caminho_chunks, encoding='utf-8') as f:
+            meta = json.load(f)
+        caminho_vetores = os.path.join(self.directory, meta['vectors'])
+        vetores = np.load(caminho_vetores, mmap_mode='r') if meta['chunks'] else None
+        with self._lock:
+            self._vectors = vetores
+            self._chunks = meta['chunks']
+            self._personalidades = np.array(
+                [c['personalidade_id'] if c['personalidade_id'] is not None else -1 for c in self._chunks],
+                dtype=np.int64)
+            self.loaded_embedder = meta['embedder']
+            self._fallback = None
+        return True
+
+    def _write(self, vetores: np.ndarray, chunks: List[Dict]):
+        os.makedirs(self.directory, exist_ok=True)
+        nome_vetores = f'vectors-{time.time_ns()}.npy'
+        with open(os.path.join(self.directory, nome_vetores), 'wb') as f:
+            np.save(f, vetores)
+        tmp_chunks = os.path.join(self.directory, f'.{_CHUNKS}.tmp')
+        with open(tmp_chunks, 'w', encoding='utf-8') as f:
+            json.dump({
+                'embedder': self.embedder_name,
+                'vectors': nome_vetores,
+                'dimensions': int(vetores.shape[1]) if vetores.ndim == 2 else 0,
+                'chunks': chunks
+            }, f, ensure_ascii=False)
+        os.replace(tmp_chunks, os.path.join(self.directory, _CHUNKS))
+        return nome_vetores
+
+    def _remove_old_vectors(self, atual: str):
+        """Apaga vetores de builds anteriores (os ainda mapeados ficam para a próxima vez)"""
+        for nome in os.listdir(self.directory):
+            if nome.startswith('vectors-') and nome.endswith('.npy') and nome != atual:
+                try:
+                    os.remove(os.path.join(self.directory, nome))
+                except OSError:
+                    pass
+
+    # ==================== INGESTÃO ====================
+
+    def _entry_vectors(self, row) -> Tuple[List[str], Optional[List[np.ndarray]], bool]:
+        """Trechos e vetores de uma entrada; reaproveita bot_conhecimento.embedding se ainda vale"""
+        trechos = chunk_text(row['titulo'], row['conteudo'])
+        assinatura = hashlib.sha1('\x00'.join(trechos).encode('utf-8')).hexdigest()
+        try:
+            salvo = json.loads(row['embedding']) if row['embedding'] else None
+        except ValueError:
+            salvo = None
+        if (isinstance(salvo, dict) and salvo.get('hash') == assinatura
+                and salvo.get('embedder') == self.embedder_name
+                and len(salvo.get('vetores', [])) == len(trechos)):
+            return trechos, [np.asarray(v, dtype=np.float32) for v in salvo['vetores']], False
+
+        vetores = []
+        for trecho in trechos:
+            vetor = self._embed(trecho)
+            if vetor is None:
+                return trechos, None, False
+            vetores.append(vetor)
+        return trechos, vetores, True
+
+    def build(self, conn) -> Dict:
+        """
+        Reindexa toda a bot_conhecimento e troca o índice em disco.
+        Grava na coluna embedding os vetores recalculados (o chamador faz commit).
+        ValueError se alguma entrada ficou sem embedding: o índice anterior
+        continua carregado e stale fica True até um build completo.
+        """
+        with self._build_lock:
+            return self._build(conn)
+
+    def _build(self, conn) -> Dict:
+        rows = conn.execute(
+            'SELECT id, personalidade_id, titulo, conteudo, categoria, embedding FROM bot_conhecimento ORDER BY id'
+        ).fetchall()
+
+        chunks, vetores = [], []
+        relatorio = {'entradas': len(rows), 'trechos': 0, 'recalculadas': 0, 'reaproveitadas': 0, 'falhas': 0}
+        for row in rows:
+            trechos, vetores_entrada, recalculada = self._entry_vectors(row)
+            if vetores_entrada is None:
+                relatorio['falhas'] += 1
+                continue
+            if recalculada:
+                relatorio['recalculadas'] += 1
+                assinatura = hashlib.sha1('\x00'.join(trechos).encode('utf-8')).hexdigest()
+                conn.execute('UPDATE bot_conhecimento SET embedding = ? WHERE id = ?', (json.dumps({
+                    'embedder': self.embedder_name,
+                    'hash': assinatura,
+                    'vetores': [[round(float(x), 6) for x in v] for v in vetores_entrada]
+                }), row['id']))
+            else:
+                relatorio['reaproveitadas'] += 1
+            for trecho, vetor in zip(trechos, vetores_entrada):
+                chunks.append({
+                    'conhecimento_id': row['id'],
+                    'personalidade_id': row['personalidade_id'],
+                    'titulo': row['titulo'],
+                    'categoria': row['categoria'],
+                    'texto': trecho
+                })
+                vetores.append(vetor)
+
+        if relatorio['falhas']:
+            # Trocar agora apagaria essas entradas do índice até a próxima edição
+            with self._lock:
+                self._stats['embed_errors'] += relatorio['falhas']
+                self._incomplete = True
+            raise ValueError(f"{relatorio['falhas']} entrada(s) sem embedding; mantido o índice anterior")
+
+        dimensoes = {v.shape[0] for v in vetores}
+        if len(dimensoes) > 1:
+            raise ValueError(f'Embeddings com dimensões diferentes: {sorted(dimensoes)}')
+        matriz = _normalize_rows(np.stack(vetores)) if vetores else np.zeros((0, 0), dtype=np.float32)
+
+        with self._lock:
+            atual = self._write(matriz, chunks)
+            self._stats['builds'] += 1
+            self._stats['embedded'] += relatorio['recalculadas']
+            self._stats['reused'] += relatorio['reaproveitadas']
+            self._incomplete = False
+        self.load()
+        self._remove_old_vectors(atual)
+        relatorio['trechos'] = len(chunks)
+        return relatorio
+
+    # ==================== BUSCA ====================
+
+    def search(self, query: str, k: int = TOP_K, personalidade_id: int = None,
+               min_score: float = MIN_SCORE) -> List[Dict]:
+        """
+        Top-k trechos por similaridade de cosseno. Entradas sem personalidade valem
+        para todas; com personalidade_id só as dela entram.
+        """
+        with self._lock:
+            vetores, chunks, personalidades = self._vectors, self._chunks, self._personalidades
+            nome = self.loaded_embedder
+            self._stats['searches'] += 1
+        if vetores is None or not chunks or k <= 0:
+            return []
+
+        if nome in self._embedders:
+            # Mesmo embedder que gerou o índice carregado (atual ou anterior ao reindex)
+            consulta = self._embed(query, self._embedders[nome], nome == HASHED_EMBEDDER)
+        else:
+            vetores = self._fallback_vectors(chunks)
+            consulta = self._embed(query, hashed=True)
+            with self._lock:
+                self._stats['fallback_searches'] += 1
+        if vetores is None:
+            return []
+        if consulta is None or consulta.shape[0] != vetores.shape[1]:
+            return []
+        norma = float(np.linalg.norm(consulta))
+        if not norma:
+            return []
+
+        scores = np.asarray(vetores @ (consulta / norma))
+        permitidos = personalidades == -1
+        if personalidade_id is not None:
+            permitidos |= personalidades == personalidade_id
+        scores = np.where(permitidos, scores, -1.0)
+
+        k = min(k, len(scores))
+        melhores = np.argpartition(-scores, k - 1)[:k]
+        melhores = melhores[np.argsort(-scores[melhores])]
+        return [dict(chunks[i], score=round(float(scores[i]), 4))
+                for i in melhores if scores[i] >= min_score]
+
+    def retriever(self, personalidade_id: int = None, k: int = TOP_K) -> Callable[[str], List[str]]:
+        """Função mensagem -> textos dos trechos, para SmartBot/CloudAIClient.set_knowledge()"""
+        return lambda mensagem: [c['texto'] for c in self.search(mensagem, k, personalidade_id)]
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['chunks'] = len(self._chunks)
+            stats['embedder'] = self.embedder_name
+            stats['stale'] = self.stale
+        return stats
@@ -19,6 +19,12 @@ from typing import Optional, List, Dict, Generator
 from dataclasses import dataclass
 from datetime import datetime
 
+from whatsapp.transport import get_session
+
+from .knowledge import knowledge_prompt
+from .quick_responses import QuickResponses
+from .streaming import StreamError, StreamUsage
+
 
 @dataclass
 class ChatMessage:
@@ -41,14 +47,15 @@ class BotResponse:
 class OllamaClient:
     """Cliente para Ollama API local"""
     
-    def __init__(self, base_url: str = "http://localhost:11434"):
+    def __init__(self, base_url: str = "http://localhost:11434", session: requests.Session = None):
         self.base_url = base_url.rstrip('/')
         self.timeout = 120  # 2 minutos para modelos grandes
+        self.session = session or get_session('bot')
     
     def is_available(self) -> bool:
         """Verifica se Ollama está rodando"""
         try:
-            response = requests.get(f"{self.base_url}/api/tags", timeout=5)
+            response = self.session.get(f"{self.base_url}/api/tags", timeout=5)
             return response.status_code == 200
         except:
             return False
@@ -56,7 +63,7 @@ class OllamaClient:
     def list_models(self) -> List[Dict]:
         """Lista modelos disponíveis localmente"""
         try:
-            response = requests.get(f"{self.base_url}/api/tags", timeout=10)
+            response = self.session.get(f"{self.base_url}/api/tags", timeout=10)
             if response.status_code == 200:
                 data = response.json()
                 return data.get('models', [])
@@ -67,7 +74,7 @@ class OllamaClient:
     def get_model_info(self, model: str) -> Dict:
         """Obtém informações de um modelo"""
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/api/show",
                 json={"name": model},
                 timeout=10
@@ -81,7 +88,7 @@ class OllamaClient:
     def pull_model(self, model: str) -> bool:
         """Baixa um modelo (pode demorar)"""
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/api/pull",
                 json={"name": model},
                 timeout=3600,  # 1 hora para downloads grandes
@@ -91,6 +98,20 @@ class OllamaClient:
         except:
             return False
     
+    def embeddings(self, model: str, text: str) -> Optional[List[float]]:
+        """Vetor de embedding do texto (ex.: nomic-embed-text); None se falhar"""
+        try:
+            response = self.session.post(
+                f"{self.base_url}/api/embeddings",
+                json={"model": model, "prompt": text},
+                timeout=30
+            )
+            if response.status_code == 200:
+                return response.json().get('embedding') or None
+            return None
+        except:
+            return None
+    
     def generate(self, model: str, prompt: str, 
                  system: str = None,
                  temperature: float = 0.7,
@@ -119,7 +140,7 @@ class OllamaClient:
             payload["context"] = context
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/api/generate",
                 json=payload,
                 timeout=self.timeout
@@ -188,7 +209,7 @@ class OllamaClient:
         }
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/api/chat",
                 json=payload,
                 timeout=self.timeout
@@ -237,7 +258,7 @@ class OllamaClient:
                     max_tokens: int = 500) -> Generator[str, None, None]:
         """
         Chat com streaming (para UI em tempo real).
-        Retorna um generator com pedaços da resposta.
+        Retorna um generator com pedaços da resposta; falhas levantam StreamError.
         """
         formatted_messages = [
             {"role": msg.role, "content": msg.content}
@@ -255,25 +276,38 @@ class OllamaClient:
         }
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/api/chat",
                 json=payload,
                 timeout=self.timeout,
                 stream=True
             )
             
-            if response.status_code == 200:
-                for line in response.iter_lines():
+            with response:
+                if response.status_code != 200:
+                    raise StreamError(f"Erro {response.status_code}: {response.text[:200]}")
+                
+                for line in response.iter_lines(chunk_size=None):
                     if line:
                         data = json.loads(line)
+                        if data.get('error'):
+                            raise StreamError(data['error'])
                         message = data.get('message', {})
                         content = message.get('content', '')
                         if content:
                             yield content
                         if data.get('done', False):
+                            if data.get('eval_count') is not None:
+                                yield StreamUsage(data['eval_count'])
                             break
-        except Exception as e:
-            yield f"[ERRO: {str(e)}]"
+        except requests.exceptions.Timeout:
+            raise StreamError("Timeout - modelo demorou muito para responder")
+        except requests.exceptions.ConnectionError:
+            raise StreamError("Ollama não está rodando. Execute 'ollama serve'")
+        except requests.exceptions.RequestException as e:
+            raise StreamError(f"Falha no stream: {e}")
+        except ValueError as e:
+            raise StreamError(f"Resposta inválida do Ollama: {e}")
 
 
 class SmartBot:
@@ -286,11 +320,16 @@ class SmartBot:
         self.max_tokens = 500
         self.system_prompt = ""
         self.max_history = 10  # Últimas N mensagens para contexto
+        self.knowledge = None  # mensagem -> trechos da base de conhecimento
     
     def set_personality(self, system_prompt: str):
         """Define a personalidade/contexto do bot"""
         self.system_prompt = system_prompt
     
+    def set_knowledge(self, retriever):
+        """Define a busca na base de conhecimento (top-k trechos entram no prompt)"""
+        self.knowledge = retriever
+    
     def set_model(self, model: str, temperature: float = 0.7, max_tokens: int = 500):
         """Configura o modelo"""
         self.model = model
@@ -308,10 +347,32 @@ class SmartBot:
             conversation_history: Histórico de mensagens [{'role': 'user/assistant', 'content': '...'}]
             contact_name: Nome do contato (para personalização)
         """
+        return self.client.chat(
+            model=self.model,
+            messages=self._build_messages(user_message, conversation_history, contact_name),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens
+        )
+    
+    def stream_response(self, user_message: str,
+                        conversation_history: List[Dict] = None,
+                        contact_name: str = None) -> Generator[str, None, None]:
+        """Mesmo que get_response(), mas devolve os pedaços da resposta conforme chegam"""
+        return self.client.chat_stream(
+            model=self.model,
+            messages=self._build_messages(user_message, conversation_history, contact_name),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens
+        )
+    
+    def _build_messages(self, user_message: str,
+                        conversation_history: List[Dict] = None,
+                        contact_name: str = None) -> List[ChatMessage]:
+        """System prompt + últimas N mensagens do histórico + mensagem atual"""
         messages = []
         
         # Adicionar system prompt (personalidade)
-        system = self.system_prompt
+        system = self.system_prompt + knowledge_prompt(self.knowledge, user_message)
         if contact_name:
             system += f"\n\nO cliente se chama: {contact_name}"
         
@@ -328,37 +389,20 @@ class SmartBot:
         # Adicionar mensagem atual
         messages.append(ChatMessage(role="user", content=user_message))
         
-        # Gerar resposta
-        return self.client.chat(
-            model=self.model,
-            messages=messages,
-            temperature=self.temperature,
-            max_tokens=self.max_tokens
-        )
+        return messages
     
-    def check_quick_response(self, message: str, quick_responses: List[Dict]) -> Optional[str]:
+    def check_quick_response(self, message: str, quick_responses) -> Optional[str]:
         """
         Verifica se há uma resposta rápida configurada para a mensagem.
         
         Args:
             message: Mensagem do usuário
-            quick_responses: Lista de respostas rápidas do banco
+            quick_responses: QuickResponses já compilado, ou a lista do banco
                 [{'gatilho': '...', 'resposta': '...', 'tipo': 'contem/exato/regex'}]
         """
-        message_lower = message.lower().strip()
-        
-        for qr in quick_responses:
-            gatilho = qr.get('gatilho', '').lower()
-            tipo = qr.get('tipo', 'contem')
-            
-            if tipo == 'exato' and message_lower == gatilho:
-                return qr.get('resposta')
-            elif tipo == 'contem' and gatilho in message_lower:
-                return qr.get('resposta')
-            elif tipo == 'comeca' and message_lower.startswith(gatilho):
-                return qr.get('resposta')
-        
-        return None
+        if not isinstance(quick_responses, QuickResponses):
+            quick_responses = QuickResponses(quick_responses)
+        return quick_responses.match(message)
 
 
 # Modelos recomendados por uso de RAM
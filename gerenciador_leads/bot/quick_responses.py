@@ -0,0 +1,149 @@
+"""
+Respostas rápidas do bot compiladas num matcher
+
+As linhas de bot_respostas_rapidas viram estruturas de busca uma vez por
+versão do conjunto de gatilhos (cache do bot), em vez de um laço por todas
+as linhas a cada mensagem:
+- 'exato'   dicionário gatilho -> regra
+- 'comeca'  trie percorrida a partir do início da mensagem
+- 'contem'  autômato Aho-Corasick: uma passada pela mensagem encontra todos
+            os gatilhos contidos nela
+- 'regex'   expressões pré-compiladas (sem diferenciar maiúsculas)
+
+O custo de exato/comeca/contem depende só do tamanho da mensagem, não da
+quantidade de gatilhos. A prioridade é mantida: cada regra guarda sua posição
+na lista (já em ORDER BY prioridade DESC) e vence a menor posição que casar;
+as regex só são testadas se puderem vencer a melhor encontrada.
+
+Uso:
+    respostas = QuickResponses(rows)    # rows já em ORDER BY prioridade DESC
+    resposta = respostas.match(mensagem)
+"""
+
+import re
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Pattern, Tuple
+
+TIPOS = ('contem', 'exato', 'comeca', 'regex')
+
+_NENHUMA = float('inf')
+
+
+class _Trie:
+    """Trie de caracteres; cada nó guarda a menor posição de regra que termina nele"""
+
+    def __init__(self):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.best: List[float] = [_NENHUMA]
+
+    def add(self, palavra: str, posicao: int):
+        node = 0
+        for char in palavra:
+            proximo = self.goto[node].get(char)
+            if proximo is None:
+                proximo = len(self.goto)
+                self.goto[node][char] = proximo
+                self.goto.append({})
+                self.best.append(_NENHUMA)
+            node = proximo
+        self.best[node] = min(self.best[node], posicao)
+
+    def prefix_match(self, texto: str) -> float:
+        """Menor posição entre as regras que são prefixo de `texto`"""
+        node = 0
+        melhor = self.best[0]
+        for char in texto:
+            node = self.goto[node].get(char)
+            if node is None:
+                break
+            if self.best[node] < melhor:
+                melhor = self.best[node]
+        return melhor
+
+
+class _AhoCorasick(_Trie):
+    """Trie com links de falha: encontra todas as ocorrências numa passada"""
+
+    def build(self):
+        self.fail = [0] * len(self.goto)
+        fila = deque(self.goto[0].values())
+        while fila:
+            node = fila.popleft()
+            for char, filho in self.goto[node].items():
+                fila.append(filho)
+                falha = self.fail[node]
+                while falha and char not in self.goto[falha]:
+                    falha = self.fail[falha]
+                destino = self.goto[falha].get(char, 0)
+                # Filhos da raiz falham para a própria raiz
+                self.fail[filho] = destino if destino != filho else 0
+                # Gatilhos que terminam no sufixo também terminam aqui
+                self.best[filho] = min(self.best[filho], self.best[self.fail[filho]])
+
+    def search(self, texto: str) -> float:
+        """Menor posição entre as regras contidas em `texto`"""
+        goto, fail, best = self.goto, self.fail, self.best
+        node = 0
+        melhor = best[0]
+        for char in texto:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if best[node] < melhor:
+                melhor = best[node]
+        return melhor
+
+
+class QuickResponses:
+    """Matcher compilado de respostas rápidas; match() devolve a de maior prioridade que casar"""
+
+    def __init__(self, rows: Iterable[Dict]):
+        self._respostas: List[str] = []
+        self._exato: Dict[str, int] = {}
+        self._comeca = _Trie()
+        self._contem = _AhoCorasick()
+        self._regex: List[Tuple[int, Pattern]] = []
+        self.invalidas: List[str] = []
+
+        for row in rows:
+            gatilho = row.get('gatilho') or ''
+            tipo = row.get('tipo') or 'contem'
+            if tipo not in TIPOS:
+                continue
+            posicao = len(self._respostas)
+            if tipo == 'regex':
+                try:
+                    self._regex.append((posicao, re.compile(gatilho, re.IGNORECASE)))
+                except re.error:
+                    self.invalidas.append(gatilho)
+                    continue
+            elif tipo == 'exato':
+                self._exato.setdefault(gatilho.lower(), posicao)
+            elif tipo == 'comeca':
+                self._comeca.add(gatilho.lower(), posicao)
+            else:
+                self._contem.add(gatilho.lower(), posicao)
+            self._respostas.append(row.get('resposta'))
+
+        self._contem.build()
+
+    def __len__(self) -> int:
+        return len(self._respostas)
+
+    def match(self, message: str) -> Optional[str]:
+        texto = message.strip()
+        message_lower = texto.lower()
+
+        melhor = min(
+            self._exato.get(message_lower, _NENHUMA),
+            self._comeca.prefix_match(message_lower),
+            self._contem.search(message_lower),
+        )
+        for posicao, padrao in self._regex:
+            if posicao >= melhor:
+                break
+            if padrao.search(texto):
+                melhor = posicao
+                break
+
+        return None if melhor == _NENHUMA else self._respostas[melhor]
@@ -0,0 +1,270 @@
+"""
+Roteamento entre provedores de IA com failover e requisições "hedged"
+
+Com o roteamento ativo (bot_config.roteamento_ativo), o bot deixa de depender
+de um único provedor: Gemini, OpenAI, Claude (os que têm API key) e o Ollama
+local entram numa lista ordenada pela saúde recente de cada um:
+- p95 da latência e taxa de erro numa janela deslizante (ProviderHealth)
+- Provedor com muitos erros recentes vai para o fim da fila
+- Sem amostras suficientes vale a ordem configurada (principal primeiro)
+
+get_response():
+    1. Envia ao primeiro da lista
+    2. Se ele não responder dentro do orçamento (hedge_after), envia também
+       ao próximo; fica com a primeira resposta bem-sucedida
+    3. Se um provedor falha, o próximo é acionado na hora (failover)
+    Cada chamada passa pelo gateway (bot/gateway.py) com a chave do próprio
+    provedor, então os limites de concorrência por provedor continuam valendo.
+    Quando um provedor responde, as demais chamadas são canceladas: as que
+    ainda estavam na fila do gateway nem chegam ao provedor.
+
+stream_response(): failover antes do primeiro pedaço; sem hedge (dois streams
+ao mesmo tempo para o mesmo cliente não fazem sentido). O stream segura uma
+vaga do provedor no gateway (slot) até terminar; provedor sem vaga é pulado.
+Stream concluído conta como sucesso na saúde do provedor; falha no meio, como erro.
+
+ProviderRouter tem a mesma interface de SmartBot/CloudAIClient.
+
+Configuração (bot_config):
+    roteamento_ativo   1 liga o roteamento
+    cloud_api_keys     JSON {"openai": "...", "claude": "..."} dos provedores
+                       reserva (ou GEMINI_API_KEY/OPENAI_API_KEY/ANTHROPIC_API_KEY)
+    hedge_ms           orçamento de latência antes do hedge (padrão 4000)
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import ExitStack
+from typing import Dict, Generator, Hashable, List, Optional, Tuple
+
+from .gateway import GatewayBusy, GatewayTimeout, LLMGateway
+from .quick_responses import QuickResponses
+from .streaming import StreamError, StreamUsage
+
+WINDOW = 50           # últimas chamadas consideradas por provedor
+MIN_SAMPLES = 5       # abaixo disso vale a ordem configurada
+ERROR_THRESHOLD = 0.5  # taxa de erro que manda o provedor para o fim
+DEFAULT_HEDGE_AFTER = 4.0
+
+
+class ProviderHealth:
+    """Janela deslizante de (latência, sucesso) por provedor (thread-safe, sobrevive a reconfigurações)"""
+
+    def __init__(self, window: int = WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = {}
+        self._counters: Dict[str, Dict[str, int]] = {}
+
+    def record(self, provider: str, latency: Optional[float], ok: bool):
+        with self._lock:
+            amostras = self._samples.setdefault(provider, deque(maxlen=self.window))
+            amostras.append((latency, ok))
+            contadores = self._counters.setdefault(provider, {'calls': 0, 'errors': 0, 'hedged': 0, 'wins': 0})
+            contadores['calls'] += 1
+            if not ok:
+                contadores['errors'] += 1
+
+    def count(self, provider: str, campo: str):
+        with self._lock:
+            contadores = self._counters.setdefault(provider, {'calls': 0, 'errors': 0, 'hedged': 0, 'wins': 0})
+            contadores[campo] += 1
+
+    def summary(self, provider: str) -> Tuple[Optional[float], float, int]:
+        """(p95 da latência das chamadas bem-sucedidas, taxa de erro, amostras)"""
+        with self._lock:
+            amostras = list(self._samples.get(provider, ()))
+        if not amostras:
+            return None, 0.0, 0
+        erros = sum(1 for _, ok in amostras if not ok)
+        latencias = sorted(lat for lat, ok in amostras if ok and lat is not None)
+        p95 = latencias[min(int(len(latencias) * 0.95), len(latencias) - 1)] if latencias else None
+        return p95, erros / len(amostras), len(amostras)
+
+    def rank(self, providers: List[str], prior: float = DEFAULT_HEDGE_AFTER) -> List[str]:
+        """
+        Ordena pela saúde: provedores com erro demais vão para o fim; os demais
+        pelo p95 ponderado pela taxa de erro. Sem amostras suficientes o
+        provedor vale 'prior' segundos; empate mantém a ordem configurada.
+        """
+        def chave(item):
+            posicao, nome = item
+            p95, taxa_erro, amostras = self.summary(nome)
+            if amostras < MIN_SAMPLES:
+                return (0, prior, posicao)
+            if taxa_erro >= ERROR_THRESHOLD:
+                return (1, 0.0, posicao)
+            # p95 desconhecido (só erros recentes) conta como lento
+            return (0, (p95 if p95 is not None else 60.0) * (1 + 4 * taxa_erro), posicao)
+        return [nome for _, nome in sorted(enumerate(providers), key=chave)]
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            nomes = list(self._counters)
+            contadores = {n: dict(c) for n, c in self._counters.items()}
+        stats = {}
+        for nome in nomes:
+            p95, taxa_erro, amostras = self.summary(nome)
+            stats[nome] = dict(contadores[nome],
+                               p95_seconds=None if p95 is None else round(p95, 3),
+                               error_rate=round(taxa_erro, 3), window=amostras)
+        return stats
+
+
+class ProviderRouter:
+    """Bot que distribui as mensagens entre vários clientes de IA com failover e hedge"""
+
+    def __init__(self, clients: Dict[str, object], health: ProviderHealth, gateway: LLMGateway,
+                 hedge_after: float = DEFAULT_HEDGE_AFTER):
+        if not clients:
+            raise ValueError('Nenhum provedor configurado')
+        self.clients = clients          # nome -> SmartBot/CloudAIClient, na ordem configurada
+        self.health = health
+        self.gateway = gateway          # cada chamada usa o limite do próprio provedor
+        self.hedge_after = hedge_after
+        self.provider = 'router'
+        self.model = getattr(clients[next(iter(clients))], 'model', None)
+
+    def set_personality(self, system_prompt: str):
+        for client in self.clients.values():
+            client.set_personality(system_prompt)
+
+    def set_knowledge(self, retriever):
+        for client in self.clients.values():
+            client.set_knowledge(retriever)
+
+    def ranked(self) -> List[str]:
+        return self.health.rank(list(self.clients), prior=self.hedge_after)
+
+    def _call(self, nome: str, message: str, conversation_history, contact_name):
+        inicio = time.perf_counter()
+        try:
+            response = self.clients[nome].get_response(message, conversation_history, contact_name)
+        except Exception as e:
+            self.health.record(nome, None, False)
+            raise e
+        latencia = time.perf_counter() - inicio
+        self.health.record(nome, latencia if response.success else None, bool(response.success))
+        return response
+
+    def get_response(self, message: str,
+                     conversation_history: List[Dict] = None,
+                     contact_name: str = None,
+                     dedup_key: Hashable = None,
+                     timeout: float = None):
+        """
+        Resposta do provedor mais saudável; hedge no próximo após hedge_after
+        segundos sem resposta e failover imediato em erro.
+        GatewayBusy se nenhum provedor aceitou a chamada; GatewayTimeout se
+        nenhum respondeu dentro do prazo (padrão: o do gateway).
+        """
+        limite = time.monotonic() + (self.gateway.timeout if timeout is None else timeout)
+        fila = self.ranked()
+        em_andamento = {}
+        ultima_falha = None
+
+        def disparar(hedge: bool = False) -> bool:
+            nonlocal ultima_falha
+            while fila:
+                nome = fila.pop(0)
+                try:
+                    future = self.gateway.submit(nome, self._call, nome, message, conversation_history,
+                                                 contact_name, dedup_key=dedup_key)
+                except GatewayBusy as e:
+                    # Provedor saturado: tenta o próximo
+                    ultima_falha = e
+                    continue
+                if hedge:
+                    self.health.count(nome, 'hedged')
+                em_andamento[future] = nome
+                return True
+            return False
+
+        disparar()
+        try:
+            while em_andamento:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    raise GatewayTimeout('A IA não respondeu dentro do prazo')
+                prazo = min(self.hedge_after, restante) if fila else restante
+                prontos, _ = wait(list(em_andamento), timeout=prazo, return_when=FIRST_COMPLETED)
+                if not prontos:
+                    # Orçamento estourado: pede também ao próximo provedor
+                    disparar(hedge=True)
+                    continue
+                for future in prontos:
+                    nome = em_andamento.pop(future)
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        ultima_falha = e
+                        response = None
+                    if response is not None and response.success:
+                        self.health.count(nome, 'wins')
+                        return response
+                    if response is not None:
+                        ultima_falha = response
+                # Falhou: aciona o próximo na hora, se ainda não há outro em andamento
+                if not em_andamento:
+                    disparar()
+        finally:
+            # Perdedoras: saem da fila do gateway; em andamento terminam e só alimentam a saúde
+            for future in em_andamento:
+                future.cancel()
+
+        if isinstance(ultima_falha, Exception):
+            raise ultima_falha
+        return ultima_falha
+
+    def stream_response(self, message: str,
+                        conversation_history: List[Dict] = None,
+                        contact_name: str = None,
+                        timeout: float = None) -> Generator[str, None, None]:
+        """
+        Stream do provedor mais saudável; troca de provedor se falhar antes do
+        primeiro pedaço. Cada stream segura uma vaga do provedor no gateway;
+        provedor sem vaga em hedge_after segundos cede a vez ao próximo.
+        GatewayBusy/GatewayTimeout se nenhum provedor tinha vaga (no prazo).
+        """
+        limite = time.monotonic() + (self.gateway.timeout if timeout is None else timeout)
+        erro = None
+        fila = self.ranked()
+        for posicao, nome in enumerate(fila):
+            restante = max(limite - time.monotonic(), 0)
+            # Espera a vaga por até hedge_after; o último provedor usa o prazo todo
+            prazo = restante if posicao == len(fila) - 1 else min(self.hedge_after, restante)
+            with ExitStack() as vaga:
+                try:
+                    vaga.enter_context(self.gateway.slot(nome, timeout=prazo))
+                except (GatewayBusy, GatewayTimeout) as e:
+                    # Provedor sem vaga: tenta o próximo
+                    erro = e
+                    continue
+                stream = iter(self.clients[nome].stream_response(message, conversation_history, contact_name))
+                try:
+                    primeiro = next(stream, None)
+                except StreamError as e:
+                    self.health.record(nome, None, False)
+                    erro = e
+                    continue
+                if primeiro is None or isinstance(primeiro, StreamUsage):
+                    self.health.record(nome, None, False)
+                    erro = StreamError(f'{nome}: resposta vazia')
+                    continue
+                yield primeiro
+                try:
+                    yield from stream
+                except StreamError:
+                    self.health.record(nome, None, False)
+                    raise
+                # Latência de stream (TTFT + geração) não entra no p95 das respostas completas
+                self.health.record(nome, None, True)
+                return
+        raise erro or StreamError('Nenhum provedor disponível')
+
+    def check_quick_response(self, message: str, quick_responses) -> Optional[str]:
+        if not isinstance(quick_responses, QuickResponses):
+            quick_responses = QuickResponses(quick_responses)
+        return quick_responses.match(message)
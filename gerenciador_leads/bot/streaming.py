@@ -0,0 +1,135 @@
+"""
+Streaming de respostas do bot (Ollama e provedores em nuvem)
+
+Os clientes expõem chat_stream(), um generator de pedaços de texto, e
+SmartBot/CloudAIClient expõem stream_response() com a mesma assinatura de
+get_response(). Erros viram StreamError (antes ou no meio do stream).
+No fim, chat_stream() emite um StreamUsage com os tokens gerados quando o
+provedor informa (eval_count do Ollama, usage de OpenAI/Claude/Gemini).
+
+TimedStream mede o stream enquanto ele é consumido (e não repassa o StreamUsage):
+    ttft_ms         tempo até o primeiro pedaço (time-to-first-token)
+    chunks          pedaços recebidos (um pedaço pode ter vários tokens)
+    chunks_per_s    pedaços por segundo depois do primeiro
+    tokens          tokens gerados segundo o provedor (None se ele não informa)
+    tokens_per_s    tokens por segundo depois do primeiro pedaço
+
+Uso:
+    stream = TimedStream(bot.stream_response(mensagem))
+    for pedaco in stream:
+        enviar(pedaco)
+    stream.metrics()  # {'ttft_ms': ..., 'chunks': ..., 'tokens': ..., 'tokens_per_s': ..., 'tempo': ...}
+
+StreamStats acumula essas métricas por processo (médias de TTFT e tokens/s).
+"""
+
+import json
+import threading
+import time
+from typing import Dict, Iterator, Optional
+
+
+class StreamError(Exception):
+    """Falha do provedor ao gerar a resposta em streaming"""
+
+
+class StreamUsage:
+    """Último item de chat_stream(): tokens gerados informados pelo provedor"""
+    __slots__ = ('tokens',)
+
+    def __init__(self, tokens: int):
+        self.tokens = int(tokens)
+
+
+def iter_sse_data(response) -> Iterator[Dict]:
+    """JSON de cada linha 'data:' de uma resposta Server-Sent Events (para em [DONE])"""
+    for line in response.iter_lines(chunk_size=None):
+        if not line or not line.startswith(b'data:'):
+            continue
+        data = line[5:].strip().decode('utf-8', errors='replace')
+        if data == '[DONE]':
+            return
+        try:
+            yield json.loads(data)
+        except ValueError:
+            continue
+
+
+class TimedStream:
+    """Envolve um generator de texto e registra TTFT, quantidade e taxa de pedaços"""
+
+    def __init__(self, chunks: Iterator[str]):
+        self._chunks = chunks
+        self.started = time.perf_counter()
+        self.first_token: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.chunks = 0
+        self.tokens: Optional[int] = None  # informado pelo provedor
+        self.parts = []
+
+    def __iter__(self):
+        try:
+            for chunk in self._chunks:
+                if isinstance(chunk, StreamUsage):
+                    self.tokens = chunk.tokens
+                    continue
+                if not chunk:
+                    continue
+                if self.first_token is None:
+                    self.first_token = time.perf_counter()
+                self.chunks += 1
+                self.parts.append(chunk)
+                yield chunk
+        finally:
+            self.finished = time.perf_counter()
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.parts)
+
+    def metrics(self) -> Dict:
+        fim = self.finished or time.perf_counter()
+        ttft = None if self.first_token is None else self.first_token - self.started
+        geracao = fim - self.first_token if self.first_token is not None else 0
+        medivel = self.chunks > 1 and geracao > 0
+        return {
+            'ttft_ms': None if ttft is None else round(ttft * 1000, 1),
+            'chunks': self.chunks,
+            'chunks_per_s': round((self.chunks - 1) / geracao, 1) if medivel else None,
+            'tokens': self.tokens,
+            'tokens_per_s': round(self.tokens / geracao, 1) if medivel and self.tokens else None,
+            'tempo': round(fim - self.started, 3)
+        }
+
+
+class StreamStats:
+    """Agregado das métricas dos streams do processo (thread-safe), para /api/db/metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {'streams': 0, 'errors': 0, 'chunks': 0, 'tokens': 0}
+        self._ttft_total = 0.0
+        self._ttft_count = 0
+        self._rate_total = 0.0
+        self._rate_count = 0
+
+    def record(self, metrics: Dict, error: bool = False):
+        with self._lock:
+            self._stats['streams'] += 1
+            if error:
+                self._stats['errors'] += 1
+            self._stats['chunks'] += metrics.get('chunks') or 0
+            self._stats['tokens'] += metrics.get('tokens') or 0
+            if metrics.get('ttft_ms') is not None:
+                self._ttft_total += metrics['ttft_ms']
+                self._ttft_count += 1
+            if metrics.get('tokens_per_s') is not None:
+                self._rate_total += metrics['tokens_per_s']
+                self._rate_count += 1
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['avg_ttft_ms'] = round(self._ttft_total / self._ttft_count, 1) if self._ttft_count else None
+            stats['avg_tokens_per_s'] = round(self._rate_total / self._rate_count, 1) if self._rate_count else None
+        return stats
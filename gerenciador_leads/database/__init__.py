@@ -0,0 +1,8 @@
+from .pool import ConnectionPool, PooledConnection, get_pool
+from .writer import WriteQueue, get_writer
+from .pagination import (InvalidCursor, encode_cursor, decode_cursor, decode_offset_cursor, keyset_where,
+                         next_cursor, sort_key)
+
+__all__ = ['ConnectionPool', 'PooledConnection', 'get_pool', 'WriteQueue', 'get_writer',
+           'InvalidCursor', 'encode_cursor', 'decode_cursor', 'decode_offset_cursor', 'keyset_where',
+           'next_cursor', 'sort_key']
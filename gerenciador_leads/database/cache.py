@@ -0,0 +1,165 @@
+"""
+Cache em memória das respostas de endpoints de leitura (dados de referência)
+
+Listas que quase nunca mudam (cidades, unidades, pipelines, personalidades,
+respostas rápidas, templates) deixam de consultar o SQLite/API a cada tela:
+- TTL por entrada e despejo LRU acima de max_entries
+- ETag em toda resposta; If-None-Match igual devolve 304 sem corpo
+- Invalidação explícita por tag nas rotas de escrita (response_cache.invalidate('unidades'))
+
+Uma leitura que começou antes de uma invalidação não grava o resultado
+(contador de geração por tag), para não recolocar dado velho no cache.
+
+O cache é por processo: escritas feitas pelo outro app (mesmo banco) só
+aparecem após o TTL.
+
+Uso:
+    response_cache = ResponseCache()
+
+    @app.route('/api/unidades')
+    @response_cache.cached('unidades', ttl=600)
+    def get_unidades(): ...
+
+    response_cache.invalidate('unidades')   # em create_unidade/update_unidade
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Dict, Iterable, Optional, Tuple
+
+DEFAULT_TTL = 300
+
+
+class _Entry:
+    __slots__ = ('body', 'mimetype', 'etag', 'expires', 'tags')
+
+    def __init__(self, body: bytes, mimetype: str, etag: str, expires: float, tags: Tuple[str, ...]):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = etag
+        self.expires = expires
+        self.tags = tags
+
+
+class ResponseCache:
+    """Cache LRU com TTL de respostas Flask, com ETag e invalidação por tag (thread-safe)"""
+
+    def __init__(self, max_entries: int = 256, default_ttl: float = DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, _Entry]' = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'not_modified': 0,
+            'expired': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    # ==================== ENTRADAS ====================
+
+    def _get(self, key: str) -> Optional[_Entry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                del self._entries[key]
+                self._stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry
+
+    def _generation(self, tags: Iterable[str]) -> Tuple[int, ...]:
+        with self._lock:
+            return tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def _set(self, key: str, entry: _Entry, generation: Tuple[int, ...]) -> bool:
+        with self._lock:
+            # Invalidado enquanto a resposta era montada: não guarda
+            if tuple(self._generations.get(tag, 0) for tag in entry.tags) != generation:
+                return False
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+            return True
+
+    def invalidate(self, *tags: str) -> int:
+        """Remove as entradas com qualquer uma das tags; retorna quantas saíram"""
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+            chaves = [key for key, entry in self._entries.items() if set(entry.tags) & set(tags)]
+            for key in chaves:
+                del self._entries[key]
+            self._stats['invalidations'] += 1
+            return len(chaves)
+
+    def clear(self):
+        with self._lock:
+            for tag in {tag for entry in self._entries.values() for tag in entry.tags}:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+            self._entries.clear()
+
+    # ==================== FLASK ====================
+
+    def cached(self, *tags: str, ttl: float = None):
+        """
+        Decorator de view GET: responde do cache (chave = caminho + query string)
+        e trata If-None-Match. Só respostas 200 são guardadas.
+        """
+        from flask import make_response, request
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                key = f'{view.__name__}:{request.full_path}'
+                entry = self._get(key)
+                estado = 'HIT'
+                if entry is None:
+                    estado = 'MISS'
+                    generation = self._generation(tags)
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.direct_passthrough:
+                        return response
+                    body = response.get_data()
+                    entry = _Entry(body, response.mimetype, hashlib.sha1(body).hexdigest()[:20],
+                                   time.monotonic() + (self.default_ttl if ttl is None else ttl), tags)
+                    self._set(key, entry, generation)
+                return self._respond(entry, estado)
+            return wrapper
+        return decorator
+
+    def _respond(self, entry: _Entry, estado: str):
+        from flask import Response, request
+
+        if request.if_none_match.contains_weak(entry.etag):
+            with self._lock:
+                self._stats['not_modified'] += 1
+            response = Response(status=304)
+        else:
+            response = Response(entry.body, mimetype=entry.mimetype)
+        response.set_etag(entry.etag)
+        # O navegador sempre revalida (If-None-Match): invalidações aparecem na hora
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Cache'] = estado
+        return response
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['max_entries'] = self.max_entries
+        consultas = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / consultas, 3) if consultas else 0.0
+        return stats
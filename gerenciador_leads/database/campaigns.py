@@ -0,0 +1,522 @@
+"""
+Campanhas de envio em massa persistidas no banco
+
+Cada campanha e cada destinatário têm estado próprio em tabelas
+(criadas pelas migrações):
+    campanhas                 parâmetros (JSON), status e contadores
+    campanha_destinatarios    um registro por lead: pendente -> enviando -> enviado/falhou
+
+- Progresso sobrevive a reinício: resume() retoma as campanhas ativas
+- Várias campanhas rodam ao mesmo tempo (uma thread coordenadora por campanha)
+- Até `workers` envios simultâneos por campanha; resultados de vários envios
+  e a reserva dos próximos são gravados juntos, numa transação só
+- Resultados ficam no banco e são lidos paginados (sem lista crescendo em memória)
+- O destinatário é marcado como 'enviando' antes da chamada à API; se o processo
+  cair nesse meio-tempo ele vira 'falhou' (pode ter sido entregue) em vez de
+  ser reenviado, para não mandar a mesma mensagem duas vezes
+
+Uso:
+    engine = CampaignEngine(db_pool, db_writer, enviar, origem='cloud_api',
+                            recorder=registrar_envio, workers=8)
+    campanha_id = engine.create(lead_ids, {'mensagem': 'Olá {nome}', 'intervalo_min': 3})
+    engine.pause(campanha_id) / engine.resume(campanha_id) / engine.cancel(campanha_id)
+
+    sender(parametros, lead)             -> objeto com success, message_id, error
+    recorder(conn, parametros, lead, r)  -> grava o envio nas tabelas do app (mesma transação)
+"""
+
+import json
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from typing import Callable, Dict, List, Optional, Sequence
+
+from .pagination import keyset_where
+
+# Status da campanha
+ATIVA = 'ativa'
+PAUSADA = 'pausada'
+CANCELADA = 'cancelada'
+CONCLUIDA = 'concluida'
+
+# Status do destinatário
+PENDENTE = 'pendente'
+ENVIANDO = 'enviando'
+ENVIADO = 'enviado'
+FALHOU = 'falhou'
+CANCELADO = 'cancelado'
+
+ERRO_INTERROMPIDO = 'Envio interrompido (reinício do servidor); a mensagem pode ter sido entregue'
+
+
+class _Falha:
+    """Resultado de envio para erros antes/fora da API"""
+
+    def __init__(self, error: str):
+        self.success = False
+        self.message_id = None
+        self.error = error
+
+
+# ==================== ESCRITAS (executadas pela fila de escrita) ====================
+
+def _criar(conn, origem: str, lead_ids: Sequence[int], parametros: Dict) -> int:
+    unicos = list(dict.fromkeys(int(i) for i in lead_ids))
+    cursor = conn.execute('''
+        INSERT INTO campanhas (origem, status, parametros, total, started_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ''', (origem, ATIVA, json.dumps(parametros, default=str), len(unicos)))
+    campanha_id = cursor.lastrowid
+    conn.executemany(
+        'INSERT INTO campanha_destinatarios (campanha_id, lead_id) VALUES (?, ?)',
+        [(campanha_id, lead_id) for lead_id in unicos]
+    )
+    return campanha_id
+
+
+def _reservar(conn, destinatario_ids: Sequence[int]) -> List[int]:
+    """Marca como 'enviando' os que ainda estão pendentes; retorna os reservados"""
+    if not destinatario_ids:
+        return []
+    placeholders = ','.join('?' * len(destinatario_ids))
+    ids = [row[0] for row in conn.execute(
+        f'SELECT id FROM campanha_destinatarios WHERE id IN ({placeholders}) AND status = ?',
+        (*destinatario_ids, PENDENTE)
+    ).fetchall()]
+    conn.executemany('''
+        UPDATE campanha_destinatarios SET status = ?, tentativas = tentativas + 1, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', [(ENVIANDO, i) for i in ids])
+    return ids
+
+
+def _gravar_lote(conn, campanha_id: int, parametros: Dict, concluidos: Sequence,
+                 reservar: Sequence[int], recorder: Optional[Callable]) -> List[int]:
+    """
+    Grava os resultados de vários envios e reserva os próximos destinatários
+    num único job da fila de escrita.
+    concluidos: (destinatario_id, lead, resultado); resultado None = a espera
+    pelo envio foi interrompida (pausa/cancelamento) e nada saiu
+    """
+    devolvidos = [d for d, _, r in concluidos if r is None]
+    feitos = [(d, lead, r) for d, lead, r in concluidos if r is not None]
+
+    if devolvidos:
+        # Volta para a fila (ou fica cancelado, se a campanha foi cancelada)
+        conn.executemany('''
+            UPDATE campanha_destinatarios
+            SET status = CASE WHEN (SELECT status FROM campanhas WHERE id = campanha_id) = ?
+                              THEN ? ELSE ? END,
+                tentativas = tentativas - 1, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = ?
+        ''', [(CANCELADA, CANCELADO, PENDENTE, d, ENVIANDO) for d in devolvidos])
+
+    if feitos:
+        conn.executemany('''
+            UPDATE campanha_destinatarios
+            SET status = ?, message_id = ?, erro = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', [(ENVIADO if r.success else FALHOU, r.message_id, None if r.success else r.error, d)
+              for d, _, r in feitos])
+        sucesso = sum(1 for _, _, r in feitos if r.success)
+        conn.execute('''
+            UPDATE campanhas SET enviados = enviados + ?, sucesso = sucesso + ?, falha = falha + ?,
+                   updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (len(feitos), sucesso, len(feitos) - sucesso, campanha_id))
+
+    if recorder:
+        for _, lead, resultado in feitos:
+            if lead.get('id') is None:
+                continue
+            # Falha ao gravar no app não desfaz o estado do destinatário
+            conn.execute('SAVEPOINT campanha_recorder')
+            try:
+                recorder(conn, parametros, lead, resultado)
+                conn.execute('RELEASE campanha_recorder')
+            except Exception as e:
+                conn.execute('ROLLBACK TO campanha_recorder')
+                conn.execute('RELEASE campanha_recorder')
+                print(f"[CAMPANHA] Erro ao registrar envio do lead {lead.get('id')}: {e}")
+
+    return _reservar(conn, reservar)
+
+
+def _alterar_status(conn, campanha_id: int, status: str, de: Sequence[str]) -> bool:
+    placeholders = ','.join('?' * len(de))
+    finished = ', finished_at = CURRENT_TIMESTAMP' if status in (CANCELADA, CONCLUIDA) else ''
+    cursor = conn.execute(f'''
+        UPDATE campanhas SET status = ?, updated_at = CURRENT_TIMESTAMP{finished}
+        WHERE id = ? AND status IN ({placeholders})
+    ''', (status, campanha_id, *de))
+    if cursor.rowcount and status == CANCELADA:
+        conn.execute('''
+            UPDATE campanha_destinatarios SET status = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE campanha_id = ? AND status = ?
+        ''', (CANCELADO, campanha_id, PENDENTE))
+    return cursor.rowcount == 1
+
+
+def _recuperar_interrompidos(conn, origem: str) -> List[int]:
+    """Destinatários que ficaram em 'enviando' viram 'falhou'; retorna as campanhas ativas"""
+    ativas = [row[0] for row in conn.execute(
+        'SELECT id FROM campanhas WHERE origem = ? AND status = ? ORDER BY id', (origem, ATIVA)
+    ).fetchall()]
+    for campanha_id in ativas:
+        cursor = conn.execute('''
+            UPDATE campanha_destinatarios SET status = ?, erro = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE campanha_id = ? AND status = ?
+        ''', (FALHOU, ERRO_INTERROMPIDO, campanha_id, ENVIANDO))
+        if cursor.rowcount:
+            conn.execute('''
+                UPDATE campanhas SET enviados = enviados + ?, falha = falha + ? WHERE id = ?
+            ''', (cursor.rowcount, cursor.rowcount, campanha_id))
+    return ativas
+
+
+# ==================== LEITURA ====================
+
+def campaign_summary(conn: sqlite3.Connection, campanha_id: int) -> Optional[Dict]:
+    """Campanha com parâmetros, contadores e pendentes; None se não existir"""
+    row = conn.execute('SELECT * FROM campanhas WHERE id = ?', (campanha_id,)).fetchone()
+    if not row:
+        return None
+    campanha = dict(row)
+    campanha['parametros'] = json.loads(campanha['parametros'] or '{}')
+    campanha['pendentes'] = max(campanha['total'] - campanha['enviados'], 0) if campanha['status'] in (ATIVA, PAUSADA) else 0
+    campanha['ativa'] = campanha['status'] == ATIVA
+    return campanha
+
+
+def list_campaigns(conn: sqlite3.Connection, origem: str = None, after: Optional[List] = None,
+                   limit: int = 20) -> List[Dict]:
+    """Campanhas mais recentes primeiro (cursor por id)"""
+    where, params = keyset_where(('id',), after)
+    conditions = [where] if where else []
+    if origem:
+        conditions.append('origem = ?')
+        params.append(origem)
+    sql = 'SELECT id FROM campanhas'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY id DESC LIMIT ?'
+    ids = [row[0] for row in conn.execute(sql, params + [limit]).fetchall()]
+    return [campaign_summary(conn, campanha_id) for campanha_id in ids]
+
+
+def campaign_results(conn: sqlite3.Connection, campanha_id: int, status: str = None,
+                     after: Optional[List] = None, limit: int = 100) -> List[Dict]:
+    """Destinatários da campanha em ordem de envio (cursor por id do destinatário)"""
+    where, params = keyset_where(('d.id',), after, descending=False)
+    sql = '''
+        SELECT d.id, d.lead_id, l.nome, l.telefone, d.status, d.message_id, d.erro,
+               d.tentativas, d.updated_at
+        FROM campanha_destinatarios d
+        LEFT JOIN leads l ON l.id = d.lead_id
+        WHERE d.campanha_id = ?
+    '''
+    params = [campanha_id] + params
+    if where:
+        sql += f' AND {where}'
+    if status:
+        sql += ' AND d.status = ?'
+        params.append(status)
+    sql += ' ORDER BY d.id LIMIT ?'
+    params.append(limit)
+    return [dict(row) for row in conn.execute(sql, params).fetchall()]
+
+
+def latest_campaign_id(conn: sqlite3.Connection, origem: str) -> Optional[int]:
+    """Campanha mais recente da origem (para o /send-bulk/status antigo)"""
+    row = conn.execute(
+        'SELECT id FROM campanhas WHERE origem = ? ORDER BY id DESC LIMIT 1', (origem,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def recent_results(conn: sqlite3.Connection, campanha_id: int, limit: int = 100) -> List[Dict]:
+    """Últimos destinatários concluídos (enviado/falhou), do mais antigo para o mais novo"""
+    rows = conn.execute('''
+        SELECT d.lead_id, l.nome, l.telefone, d.status, d.erro
+        FROM campanha_destinatarios d
+        LEFT JOIN leads l ON l.id = d.lead_id
+        WHERE d.campanha_id = ? AND d.status IN (?, ?)
+        ORDER BY d.updated_at DESC, d.id DESC LIMIT ?
+    ''', (campanha_id, ENVIADO, FALHOU, limit)).fetchall()
+    return [dict(row) for row in reversed(rows)]
+
+
+# ==================== PROGRESSO ====================
+
+class ProgressCounters:
+    """
+    Contadores incrementados por várias threads sem lock: cada thread soma no
+    próprio dicionário e a leitura junta todos. Só o registro da thread (na
+    primeira vez) passa pelo lock.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def _shard(self) -> Dict:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def add(self, key, n: int = 1):
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + n
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            shards = list(self._shards)
+        total: Dict = {}
+        for shard in shards:
+            for key, value in list(shard.items()):
+                total[key] = total.get(key, 0) + value
+        return total
+
+
+# ==================== MOTOR ====================
+
+class CampaignEngine:
+    """
+    Executa as campanhas de uma origem (um app): uma thread coordenadora por
+    campanha lê os destinatários em lotes e distribui os envios num pool de
+    workers compartilhado.
+    """
+
+    def __init__(self, pool, writer, sender: Callable, origem: str,
+                 recorder: Callable = None, batch_size: int = 500, scheduler=None,
+                 workers: int = 1):
+        """
+        Args:
+            pool: ConnectionPool para leituras
+            writer: WriteQueue para as escritas de estado
+            sender: Envia para um lead; recebe (parametros, lead) e retorna o resultado
+            origem: Identifica o app dono das campanhas ('zapi', 'cloud_api')
+            recorder: Grava o envio nas tabelas do app, na mesma transação do estado
+            batch_size: Destinatários lidos por consulta
+            scheduler: SendScheduler usado pelo cliente; pausa/cancelamento
+                interrompem a espera por ele
+            workers: Envios simultâneos por campanha (1 quando há intervalo configurado)
+        """
+        self.pool = pool
+        self.writer = writer
+        self.sender = sender
+        self.origem = origem
+        self.recorder = recorder
+        self.batch_size = batch_size
+        self.scheduler = scheduler
+        self.workers = max(1, workers)
+
+        self._lock = threading.Lock()
+        self._runners: Dict[int, Dict] = {}
+        self._executor = ThreadPoolExecutor(max_workers=self.workers * 4,
+                                            thread_name_prefix=f'campanha-{origem}')
+        self._progress = ProgressCounters()
+
+    # ==================== CONTROLE ====================
+
+    def create(self, lead_ids: Sequence[int], parametros: Dict) -> int:
+        """Grava a campanha com todos os destinatários e começa a enviar"""
+        campanha_id = self.writer.run(_criar, self.origem, lead_ids, parametros)
+        self._start(campanha_id)
+        return campanha_id
+
+    def resume(self, campanha_id: int = None) -> List[int]:
+        """
+        Sem argumento: retoma as campanhas ativas desta origem (chamar ao iniciar o app).
+        Com campanha_id: reativa uma campanha pausada.
+        """
+        if campanha_id is None:
+            ativas = self.writer.run(_recuperar_interrompidos, self.origem)
+            for cid in ativas:
+                self._start(cid)
+            return ativas
+        if self.writer.run(_alterar_status, campanha_id, ATIVA, (PAUSADA,)):
+            self._start(campanha_id)
+            return [campanha_id]
+        return []
+
+    def pause(self, campanha_id: int) -> bool:
+        """Para depois dos envios em andamento; o que falta continua pendente"""
+        ok = self.writer.run(_alterar_status, campanha_id, PAUSADA, (ATIVA,))
+        self._stop(campanha_id)
+        return ok
+
+    def cancel(self, campanha_id: int) -> bool:
+        """Para a campanha e marca os pendentes como cancelados"""
+        ok = self.writer.run(_alterar_status, campanha_id, CANCELADA, (ATIVA, PAUSADA))
+        self._stop(campanha_id)
+        return ok
+
+    def active_ids(self) -> List[int]:
+        with self._lock:
+            return [cid for cid, r in self._runners.items() if r['thread'].is_alive()]
+
+    def _start(self, campanha_id: int):
+        with self._lock:
+            runner = self._runners.get(campanha_id)
+            if runner and runner['thread'].is_alive():
+                return
+            stop = threading.Event()
+            thread = threading.Thread(target=self._run, args=(campanha_id, stop),
+                                      name=f'campanha-{campanha_id}')
+            thread.daemon = True
+            self._runners[campanha_id] = {'thread': thread, 'stop': stop}
+        self._progress.add('started')
+        thread.start()
+
+    def _stop(self, campanha_id: int):
+        with self._lock:
+            runner = self._runners.get(campanha_id)
+        if runner:
+            runner['stop'].set()
+
+    # ==================== EXECUÇÃO ====================
+
+    def _proximos(self, campanha_id: int):
+        """Parâmetros e o próximo lote de pendentes já com os dados do lead (uma consulta)"""
+        conn = self.pool.acquire()
+        try:
+            campanha = conn.execute(
+                'SELECT status, parametros FROM campanhas WHERE id = ?', (campanha_id,)
+            ).fetchone()
+            if not campanha or campanha['status'] != ATIVA:
+                return None, []
+            rows = conn.execute('''
+                SELECT d.id AS destinatario_id, d.lead_id, l.*
+                FROM campanha_destinatarios d
+                LEFT JOIN leads l ON l.id = d.lead_id
+                WHERE d.campanha_id = ? AND d.status = ?
+                ORDER BY d.id LIMIT ?
+            ''', (campanha_id, PENDENTE, self.batch_size)).fetchall()
+            return json.loads(campanha['parametros'] or '{}'), [dict(row) for row in rows]
+        finally:
+            conn.close()
+
+    def _run(self, campanha_id: int, stop: threading.Event):
+        try:
+            self._coordenar(campanha_id, stop)
+        except Exception as e:
+            print(f"[CAMPANHA] Erro na campanha {campanha_id}: {e}")
+
+    def _coordenar(self, campanha_id: int, stop: threading.Event):
+        """
+        Janela deslizante: mantém até `workers` envios em andamento. A cada
+        rodada, os envios concluídos são gravados e as vagas abertas são
+        reservadas no mesmo job de escrita; enquanto ele roda, outros envios
+        terminam e entram na rodada seguinte (o lote cresce com a carga).
+        """
+        fila = deque()
+        em_voo: Dict = {}
+        concluidos = []
+        parametros = None
+        esgotada = False
+        ultimo_envio = None  # fim do último envio: o intervalo conta a partir dele
+
+        while True:
+            candidatos = []
+            if not stop.is_set() and not esgotada:
+                if not fila:
+                    parametros, lote = self._proximos(campanha_id)
+                    if parametros is None:
+                        stop.set()  # pausada/cancelada por outro processo
+                    fila.extend(lote)
+                    esgotada = not lote
+
+                intervalo = self._intervalo(parametros)
+                livres = (1 if intervalo else self.workers) - len(em_voo)
+                if intervalo and livres > 0 and fila and ultimo_envio is not None:
+                    if concluidos:
+                        # Grava o que terminou antes de esperar (progresso em dia e nada
+                        # preso em 'enviando' se o processo cair durante o intervalo)
+                        self.writer.run(_gravar_lote, campanha_id, parametros, concluidos, [], self.recorder)
+                        concluidos = []
+                    # Espera interrompível por pause/cancel
+                    stop.wait(max(0.0, ultimo_envio + intervalo - time.monotonic()))
+                if not stop.is_set():
+                    while fila and len(candidatos) < livres:
+                        candidatos.append(fila.popleft())
+
+            if concluidos or candidatos:
+                reservados = set(self.writer.run(
+                    _gravar_lote, campanha_id, parametros, concluidos,
+                    [dest['destinatario_id'] for dest in candidatos], self.recorder
+                ))
+                concluidos = []
+                for dest in candidatos:
+                    if dest['destinatario_id'] in reservados:
+                        future = self._executor.submit(self._enviar, parametros, dest, stop)
+                        em_voo[future] = dest['destinatario_id']
+                        self._progress.add(('em_andamento', campanha_id))
+
+            if not em_voo:
+                if stop.is_set():
+                    return
+                if esgotada:
+                    if self.writer.run(_alterar_status, campanha_id, CONCLUIDA, (ATIVA,)):
+                        self._progress.add('finished')
+                    return
+                continue
+
+            prontos, _ = wait(list(em_voo), return_when=FIRST_COMPLETED)
+            for future in prontos:
+                destinatario_id = em_voo.pop(future)
+                lead, resultado = future.result()
+                concluidos.append((destinatario_id, lead, resultado))
+                ultimo_envio = time.monotonic()
+                self._progress.add(('em_andamento', campanha_id), -1)
+                if resultado is not None:
+                    self._progress.add('sent' if resultado.success else 'failed')
+
+    @staticmethod
+    def _intervalo(parametros: Optional[Dict]) -> float:
+        """Pausa entre envios configurada na campanha (0 = no ritmo do scheduler)"""
+        if not parametros:
+            return 0.0
+        intervalo_min = float(parametros.get('intervalo_min', 0) or 0)
+        intervalo_max = float(parametros.get('intervalo_max', intervalo_min) or intervalo_min)
+        if intervalo_max <= 0:
+            return 0.0
+        return random.uniform(intervalo_min, max(intervalo_min, intervalo_max))
+
+    def _enviar(self, parametros: Dict, dest: Dict, stop: threading.Event):
+        """Executado no pool: retorna (lead, resultado); resultado None se a espera foi interrompida"""
+        lead = dict(dest)
+        lead.pop('destinatario_id', None)
+        if lead.get('id') is None:
+            return lead, _Falha('Lead não encontrado')
+        if not lead.get('telefone'):
+            return lead, _Falha('Lead sem telefone')
+        try:
+            with self.scheduler.cancel_on(stop) if self.scheduler else nullcontext():
+                resultado = self.sender(parametros, lead)
+        except Exception as e:
+            return lead, _Falha(str(e))
+        if (self.scheduler and not resultado.success
+                and getattr(resultado, 'error_code', None) == self.scheduler.CANCELLED):
+            return lead, None
+        return lead, resultado
+
+    def progress(self, campanha_id: int) -> Dict:
+        """Envios da campanha em andamento neste processo"""
+        return {'em_andamento': self._progress.snapshot().get(('em_andamento', campanha_id), 0)}
+
+    def get_stats(self) -> Dict:
+        snapshot = self._progress.snapshot()
+        stats = {key: snapshot.get(key, 0) for key in ('started', 'finished', 'sent', 'failed')}
+        stats['in_flight'] = sum(v for k, v in snapshot.items() if isinstance(k, tuple))
+        stats['workers'] = self.workers
+        stats['running'] = self.active_ids()
+        return stats
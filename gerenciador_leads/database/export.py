@@ -0,0 +1,134 @@
+"""
+Exportação de leads em streaming (CSV ou Parquet)
+
+Lê o cursor em lotes (fetchmany) e escreve cada lote direto no destino, sem
+montar DataFrame: a memória fica constante qualquer que seja o tamanho da
+exportação.
+    iter_csv()       gera os bytes do CSV (opcionalmente gzip) para uma Response
+    write_csv()      grava o CSV num arquivo (app desktop)
+    write_parquet()  grava Parquet (um row group por lote); requer pyarrow
+
+Uso:
+    colunas = select_columns(conn, request.args.get('colunas'))
+    cursor = conn.execute(f"SELECT {', '.join(colunas)} FROM leads WHERE ...", params)
+    return Response(iter_csv(cursor, colunas, compress=True), mimetype='application/gzip')
+"""
+
+import csv
+import gzip
+import io
+import zlib
+from typing import Iterable, Iterator, List, Optional
+
+BATCH_SIZE = 2000
+
+# Compressão gzip incremental (wbits 31 = cabeçalho e rodapé gzip)
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class InvalidColumns(ValueError):
+    """Coluna pedida não existe na tabela"""
+
+
+def table_columns(conn, table: str = 'leads') -> List[str]:
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def select_columns(conn, pedidas: Optional[str], table: str = 'leads') -> List[str]:
+    """
+    Colunas a exportar: 'nome,telefone,...' validadas contra o schema (na ordem
+    pedida), ou todas se `pedidas` está vazio. InvalidColumns se alguma não existe.
+    """
+    existentes = table_columns(conn, table)
+    if not pedidas:
+        return existentes
+    colunas = [c.strip() for c in pedidas.split(',') if c.strip()]
+    invalidas = [c for c in colunas if c not in existentes]
+    if invalidas:
+        raise InvalidColumns(f"Colunas inexistentes: {', '.join(invalidas)}")
+    return list(dict.fromkeys(colunas))
+
+
+def _batches(cursor, batch_size: int) -> Iterator[list]:
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def _csv_chunks(cursor, columns: Iterable[str], batch_size: int) -> Iterator[str]:
+    """Texto CSV em pedaços: cabeçalho e depois um pedaço por lote"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    for rows in _batches(cursor, batch_size):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_csv(cursor, columns: Iterable[str], compress: bool = False,
+             batch_size: int = BATCH_SIZE) -> Iterator[bytes]:
+    """
+    Bytes do CSV (UTF-8 com BOM, para o Excel abrir acentos) lote a lote,
+    comprimidos com gzip em streaming se `compress`.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS) if compress else None
+    primeiro = True
+    for texto in _csv_chunks(cursor, columns, batch_size):
+        dados = texto.encode('utf-8-sig' if primeiro else 'utf-8')
+        primeiro = False
+        if compressor is not None:
+            dados = compressor.compress(dados)
+        if dados:
+            yield dados
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def write_csv(cursor, columns: Iterable[str], destino: str, batch_size: int = BATCH_SIZE) -> int:
+    """Grava o CSV em `destino` (gzip se termina em .gz); retorna o número de linhas"""
+    abrir = gzip.open if destino.endswith('.gz') else open
+    linhas = 0
+    with abrir(destino, 'wt', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(columns)
+        for rows in _batches(cursor, batch_size):
+            writer.writerows(rows)
+            linhas += len(rows)
+    return linhas
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def write_parquet(cursor, columns: List[str], destino, compress: bool = False,
+                  batch_size: int = BATCH_SIZE) -> int:
+    """
+    Grava Parquet em `destino` (caminho ou arquivo), um row group por lote.
+    Todas as colunas como texto (o schema do SQLite não garante tipos).
+    `compress` usa o codec gzip do próprio Parquet (padrão: snappy).
+    Retorna o número de linhas.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(coluna, pa.string()) for coluna in columns])
+    linhas = 0
+    with pq.ParquetWriter(destino, schema, compression='gzip' if compress else 'snappy') as writer:
+        for rows in _batches(cursor, batch_size):
+            dados = [[None if row[i] is None else str(row[i]) for row in rows] for i in range(len(columns))]
+            writer.write_table(pa.Table.from_arrays([pa.array(d, pa.string()) for d in dados], schema=schema))
+            linhas += len(rows)
+        if not linhas:
+            writer.write_table(schema.empty_table())
+    return linhas
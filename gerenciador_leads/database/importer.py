@@ -0,0 +1,572 @@
+"""
+Importação de leads de planilhas (CSV/Excel) em lote
+
+Substitui os loops df.iterrows() com INSERT linha a linha:
+    prepare_leads()  mapeia colunas, limpa e valida com operações vetorizadas
+                     do pandas e remove telefones repetidos na própria planilha
+    insert_leads()   carrega a planilha numa tabela temporária e grava, num único
+                     INSERT ... SELECT, só os telefones que ainda não existem no
+                     banco (pelo índice de telefone_norm)
+
+Cada etapa é cronometrada (relatório['tempos_ms']).
+
+Arquivos grandes são lidos em blocos (iter_chunks: CSV com chunksize, Excel
+pelo iterador read-only do openpyxl) e gravados bloco a bloco (import_file);
+ImportJobs roda essas importações em segundo plano, com progresso e cancelamento.
+
+Uso:
+    preparado = prepare_leads(pd.read_excel(caminho, dtype=str), defaults={'cidade': 'Campinas'})
+    relatorio = db_writer.run(insert_leads, preparado)          # apps (fila de escrita)
+    relatorio = insert_leads(conn, preparado); conn.commit()    # conexão própria
+    relatorio = import_file(caminho, lambda p: db_writer.run(insert_leads, p))
+"""
+
+import codecs
+import copy
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+from typing import Callable, Dict, Iterator, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from .phones import normalize_phone_series
+
+# Colunas gravadas em leads e os nomes aceitos na planilha (sem diferenciar
+# maiúsculas). Os nomes com classe CSS vêm das extrações do Google Maps.
+LEAD_COLUMNS: Dict[str, Sequence[str]] = {
+    'nome': ('nome', 'name', 'empresa', 'company', 'qBF1Pd'),
+    'telefone': ('telefone', 'phone', 'tel', 'celular', 'whatsapp', 'UsdlK'),
+    'endereco': ('endereco', 'endereço', 'address', 'W4Efsd 3'),
+    'cidade': ('cidade', 'city', 'municipio', 'município'),
+    'tipo_servico': ('tipo_servico', 'categoria', 'category', 'W4Efsd'),
+    'avaliacao': ('avaliacao', 'avaliação', 'rating', 'MW4etd'),
+    'link_maps': ('link_maps', 'hfpxzc href'),
+}
+
+
+class _Timer:
+    def __init__(self, tempos: Dict[str, float]):
+        self.tempos = tempos
+
+    @contextmanager
+    def __call__(self, etapa: str):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.tempos[etapa] = round(self.tempos.get(etapa, 0.0) + (time.perf_counter() - inicio) * 1000, 3)
+
+
+def map_columns(columns: Sequence[str], column_map: Dict[str, Sequence[str]] = None) -> Dict[str, Optional[str]]:
+    """
+    Coluna da planilha para cada campo do lead: primeiro nome exato, depois
+    nome contido (ex.: 'Telefone 1'); cada coluna é usada por um campo só.
+    """
+    column_map = column_map or LEAD_COLUMNS
+    lower = {str(col).lower(): col for col in columns}
+    usadas = set()
+    mapeadas: Dict[str, Optional[str]] = {}
+
+    for campo, opcoes in column_map.items():
+        mapeadas[campo] = next((lower[o.lower()] for o in opcoes
+                                if o.lower() in lower and lower[o.lower()] not in usadas), None)
+        if mapeadas[campo] is not None:
+            usadas.add(mapeadas[campo])
+    for campo, opcoes in column_map.items():
+        if mapeadas[campo] is None:
+            mapeadas[campo] = next((col for o in opcoes for nome, col in lower.items()
+                                    if o.lower() in nome and col not in usadas), None)
+            if mapeadas[campo] is not None:
+                usadas.add(mapeadas[campo])
+    return mapeadas
+
+
+def _texto(coluna: pd.Series) -> pd.Series:
+    """Valores como texto sem espaços nas pontas; vazios e 'nan' viram ''"""
+    if pd.api.types.is_float_dtype(coluna.dtype) and coluna.dropna().mod(1).eq(0).all():
+        coluna = coluna.astype('Int64')  # 4.0 -> '4' (notas, números lidos como float)
+    texto = coluna.astype('string').str.strip().fillna('')
+    return texto.mask(texto.str.lower().isin(['nan', 'none', 'null']), '')
+
+
+def prepare_leads(df: pd.DataFrame, defaults: Dict[str, str] = None,
+                  column_map: Dict[str, Sequence[str]] = None, tempos: Dict[str, float] = None,
+                  phone_digits_only: bool = False) -> Dict:
+    """
+    Normaliza e valida a planilha. Retorna um dict com o DataFrame pronto
+    ('leads': campos encontrados + telefone_norm), as contagens e os tempos.
+
+    Args:
+        defaults: Valor para campos ausentes ou vazios (ex.: {'cidade': nome do arquivo})
+        column_map: Nomes aceitos por campo (padrão LEAD_COLUMNS)
+        phone_digits_only: Grava leads.telefone só com os dígitos
+    """
+    tempos = {} if tempos is None else tempos
+    etapa = _Timer(tempos)
+    column_map = column_map or LEAD_COLUMNS
+    defaults = defaults or {}
+
+    with etapa('mapeamento'):
+        mapeadas = map_columns(df.columns, column_map)
+        # Campos sem coluna na planilha nem default ficam fora (NULL no banco)
+        campos = [c for c in column_map if mapeadas[c] is not None or c in defaults or c == 'telefone']
+        leads = pd.DataFrame(index=df.index)
+        for campo in campos:
+            leads[campo] = _texto(df[mapeadas[campo]]) if mapeadas[campo] is not None else ''
+            if campo in defaults:
+                leads[campo] = leads[campo].mask(leads[campo] == '', defaults[campo] or '')
+
+    with etapa('normalizacao'):
+        leads['telefone_norm'] = normalize_phone_series(leads['telefone'])
+        validos = leads['telefone_norm'].notna()
+        invalidos = int((~validos & (leads['telefone'] != '')).sum())
+        sem_telefone = int((leads['telefone'] == '').sum())
+        leads = leads[validos]
+        if phone_digits_only:
+            leads['telefone'] = leads['telefone'].str.replace(r'\D', '', regex=True)
+
+    with etapa('deduplicacao'):
+        repetidos = leads['telefone_norm'].duplicated(keep='first')
+        leads = leads[~repetidos].reset_index(drop=True)
+
+    return {
+        'leads': leads,
+        'colunas': {campo: coluna for campo, coluna in mapeadas.items() if coluna is not None},
+        'total': len(df),
+        'invalidos': invalidos,
+        'sem_telefone': sem_telefone,
+        'duplicados_arquivo': int(repetidos.sum()),
+        'tempos_ms': tempos,
+    }
+
+
+def insert_leads(conn, preparado: Dict) -> Dict:
+    """
+    Grava os leads preparados que ainda não existem (por telefone_norm).
+    Não faz commit: roda dentro do job da fila de escrita ou da
+    transação de quem chamou. Retorna o relatório completo da importação.
+    """
+    tempos = preparado['tempos_ms']
+    etapa = _Timer(tempos)
+    leads: pd.DataFrame = preparado['leads']
+
+    colunas = ', '.join(leads.columns)
+
+    with etapa('carga_temporaria'):
+        conn.execute('DROP TABLE IF EXISTS temp.importacao_leads')
+        conn.execute(f'CREATE TEMP TABLE importacao_leads ({colunas})')
+        conn.executemany(
+            f"INSERT INTO importacao_leads VALUES ({', '.join('?' * len(leads.columns))})",
+            leads.itertuples(index=False, name=None)
+        )
+
+    with etapa('consulta_banco'):
+        duplicados_banco = conn.execute('''
+            SELECT COUNT(*) FROM importacao_leads i
+            WHERE EXISTS (SELECT 1 FROM leads l WHERE l.telefone_norm = i.telefone_norm)
+        ''').fetchone()[0]
+
+    with etapa('insercao'):
+        # Um único INSERT ... SELECT: os índices FTS (triggers) acumulam os termos
+        # e gravam no fim do comando, em vez de a cada linha como no executemany
+        cursor = conn.execute(f'''
+            INSERT OR IGNORE INTO leads ({colunas})
+            SELECT {colunas} FROM importacao_leads i
+            WHERE NOT EXISTS (SELECT 1 FROM leads l WHERE l.telefone_norm = i.telefone_norm)
+            ORDER BY i.rowid
+        ''')
+        # rowcount conta só as linhas inseridas (não as alteradas pelos triggers)
+        importados = max(cursor.rowcount, 0)
+        conn.execute('DROP TABLE temp.importacao_leads')
+
+    relatorio = {key: value for key, value in preparado.items() if key != 'leads'}
+    relatorio.update({
+        'validos': len(leads),
+        'duplicados_banco': duplicados_banco,
+        'importados': importados,
+        'ignorados': len(leads) - duplicados_banco - importados,
+    })
+    relatorio['tempos_ms']['total'] = round(sum(v for k, v in tempos.items() if k != 'total'), 3)
+    return relatorio
+
+
+# ==================== IMPORTAÇÃO EM STREAMING ====================
+
+CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', 5000))
+# Bytes do início do CSV examinados para escolher a codificação
+ENCODING_SAMPLE = 4 << 20
+
+# Campos somados de um lote para o total da importação
+_CONTADORES = ('total', 'invalidos', 'sem_telefone', 'duplicados_arquivo',
+               'validos', 'duplicados_banco', 'importados', 'ignorados')
+
+
+def _detect_encoding(caminho: str, amostra: int = ENCODING_SAMPLE) -> str:
+    """
+    'utf-8-sig' (UTF-8, ignorando BOM) se os primeiros `amostra` bytes
+    decodificam como UTF-8, senão 'latin-1'. Não relê o arquivo inteiro:
+    um byte inválido depois da amostra vira U+FFFD na leitura (iter_chunks).
+    """
+    with open(caminho, 'rb') as f:
+        bloco = f.read(amostra)
+        fim = len(bloco) < amostra
+    try:
+        # Sem final=True no meio do arquivo: caractere cortado no limite da amostra não é erro
+        codecs.getincrementaldecoder('utf-8')().decode(bloco, final=fim)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+
+def _excel_value(valor):
+    # Números inteiros gravados como float no Excel (telefones, notas): 19999990001.0 -> 19999990001
+    if isinstance(valor, float) and valor.is_integer():
+        return int(valor)
+    return valor
+
+
+def iter_chunks(caminho: str, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[pd.DataFrame, float]]:
+    """
+    Lê a planilha em blocos de até `chunk_size` linhas sem carregá-la inteira.
+    Gera (bloco, fração do arquivo já lida, de 0 a 1).
+
+    CSV: pd.read_csv(chunksize=...); Excel (.xlsx): openpyxl em modo read-only;
+    .xls (formato antigo, sem leitura em blocos): um único bloco.
+    """
+    if caminho.lower().endswith('.xls'):
+        yield pd.read_excel(caminho, dtype=str), 1.0
+        return
+    if caminho.lower().endswith('.csv'):
+        tamanho = os.path.getsize(caminho) or 1
+        with open(caminho, 'rb') as f:
+            for bloco in pd.read_csv(f, dtype=str, encoding=_detect_encoding(caminho),
+                                     encoding_errors='replace', chunksize=chunk_size):
+                yield bloco, min(1.0, f.tell() / tamanho)
+        return
+
+    from openpyxl import load_workbook
+
+    wb = load_workbook(caminho, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        total = max((ws.max_row or 0) - 1, 1)
+        linhas = ws.iter_rows(values_only=True)
+        cabecalho = next(linhas, None)
+        if cabecalho is None:
+            return
+        colunas = [str(c) if c is not None else f'coluna_{i}' for i, c in enumerate(cabecalho)]
+        lidas = 0
+        while True:
+            bloco = [tuple(_excel_value(v) for v in linha) for linha in islice(linhas, chunk_size)]
+            if not bloco:
+                break
+            lidas += len(bloco)
+            yield pd.DataFrame(bloco, columns=colunas, dtype=object), min(1.0, lidas / total)
+    finally:
+        wb.close()
+
+
+def import_file(caminho: str, gravar: Callable[[Dict], Dict], defaults: Dict[str, str] = None,
+                chunk_size: int = CHUNK_SIZE, stop: threading.Event = None,
+                progresso: Callable[[Dict, float], None] = None, **opcoes) -> Dict:
+    """
+    Importa um arquivo bloco a bloco: prepara cada bloco e chama `gravar(preparado)`
+    (ex.: lambda p: db_writer.run(insert_leads, p)), que grava e confirma o bloco.
+    A memória fica limitada a um bloco qualquer que seja o tamanho do arquivo.
+
+    Telefones repetidos em blocos diferentes são contados em duplicados_banco
+    (o bloco anterior já está gravado).
+
+    Args:
+        stop: Interrompe entre um bloco e outro (o que já foi gravado fica)
+        progresso: Chamado após cada bloco com (relatório acumulado, fração lida)
+        opcoes: Repassadas a prepare_leads (column_map, phone_digits_only)
+    """
+    relatorio = {campo: 0 for campo in _CONTADORES}
+    relatorio.update({'lotes': 0, 'colunas': {}, 'tempos_ms': {}})
+    tempos = relatorio['tempos_ms']
+
+    blocos = iter_chunks(caminho, chunk_size)
+    while True:
+        with _Timer(tempos)('leitura'):
+            proximo = next(blocos, None)
+        if proximo is None:
+            break
+        bloco, fracao = proximo
+        parcial = gravar(prepare_leads(bloco, defaults=defaults, **opcoes))
+
+        for campo in _CONTADORES:
+            relatorio[campo] += parcial[campo]
+        relatorio['colunas'] = relatorio['colunas'] or parcial['colunas']
+        relatorio['lotes'] += 1
+        for etapa_nome, ms in parcial['tempos_ms'].items():
+            if etapa_nome != 'total':
+                tempos[etapa_nome] = round(tempos.get(etapa_nome, 0.0) + ms, 3)
+        tempos['total'] = round(sum(v for k, v in tempos.items() if k != 'total'), 3)
+
+        if progresso is not None:
+            progresso(relatorio, fracao)
+        if stop is not None and stop.is_set():
+            blocos.close()
+            break
+    return relatorio
+
+
+IMPORT_EXTENSIONS = ('.csv', '.xlsx')
+
+
+def save_upload(arquivo, pasta: str, extensoes: Sequence[str] = IMPORT_EXTENSIONS) -> str:
+    """
+    Grava o upload (werkzeug FileStorage) em disco com nome único, copiando em
+    blocos, e retorna o caminho. ValueError se a extensão não está em `extensoes`.
+    """
+    extensao = os.path.splitext(arquivo.filename or '')[1].lower()
+    if extensao not in extensoes:
+        raise ValueError(f"Arquivo deve ser {' ou '.join(e.lstrip('.').upper() for e in extensoes)}")
+    fd, caminho = tempfile.mkstemp(prefix='import_', suffix=extensao, dir=pasta)
+    with os.fdopen(fd, 'wb') as destino:
+        arquivo.save(destino)
+    return caminho
+
+
+class ImportJobs:
+    """
+    Importações em segundo plano: cada job lê um ou mais arquivos em blocos
+    (import_file) e grava cada bloco pela fila de escrita.
+
+    Uso:
+        job_id = import_jobs.start([(caminho, {'cidade': 'Campinas'})], cleanup=True)
+        import_jobs.get(job_id)      # progresso
+        import_jobs.cancel(job_id)
+    """
+
+    def __init__(self, writer, chunk_size: int = CHUNK_SIZE, max_workers: int = 2, keep: int = 100,
+                 on_change: Callable[[], None] = None):
+        """
+        Args:
+            writer: WriteQueue usada para gravar os blocos
+            max_workers: Importações simultâneas (as demais esperam na fila)
+            keep: Jobs terminados mantidos em memória para consulta
+            on_change: Chamado ao fim de um job que gravou leads (ex.: invalidar caches)
+        """
+        self.writer = writer
+        self.on_change = on_change
+        self.chunk_size = chunk_size
+        self.keep = keep
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='import')
+        self._lock = threading.Lock()
+        self._jobs: 'OrderedDict[str, Dict]' = OrderedDict()
+        self._stops: Dict[str, threading.Event] = {}
+        self._stats = {'started': 0, 'finished': 0, 'cancelled': 0, 'failed': 0, 'rows': 0}
+
+    def start(self, fontes: Sequence[Tuple[str, Dict]], cleanup: bool = False, **opcoes) -> str:
+        """
+        Agenda a importação e retorna o id do job.
+
+        Args:
+            fontes: [(caminho, defaults)] importados em sequência
+            cleanup: Apaga os arquivos ao terminar (uploads temporários)
+            opcoes: Repassadas a prepare_leads
+        """
+        job_id = uuid.uuid4().hex[:12]
+        fontes = [(caminho, dict(defaults or {})) for caminho, defaults in fontes]
+        job = {
+            'id': job_id,
+            'status': 'na_fila',
+            'arquivos': [os.path.basename(caminho) for caminho, _ in fontes],
+            'arquivo_atual': None,
+            'progresso': 0.0,
+            'relatorio': None,
+            'erro': None,
+            'created_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None,
+        }
+        stop = threading.Event()
+        with self._lock:
+            self._jobs[job_id] = job
+            self._stops[job_id] = stop
+            self._stats['started'] += 1
+            self._prune()
+        self._executor.submit(self._run, job_id, fontes, stop, cleanup, opcoes)
+        return job_id
+
+    def _run(self, job_id: str, fontes, stop: threading.Event, cleanup: bool, opcoes: Dict):
+        self._update(job_id, status='executando', started_at=datetime.now().isoformat())
+        acumulado = None
+        status, erro = 'concluido', None
+        try:
+            for indice, (caminho, defaults) in enumerate(fontes):
+                if stop.is_set():
+                    break
+                self._update(job_id, arquivo_atual=os.path.basename(caminho))
+
+                def progresso(relatorio, fracao, indice=indice):
+                    self._update(job_id, relatorio=_somar(acumulado, relatorio),
+                                 progresso=round((indice + fracao) / len(fontes) * 100, 1))
+
+                parcial = import_file(caminho, lambda p: self.writer.run(insert_leads, p), defaults,
+                                      self.chunk_size, stop, progresso, **opcoes)
+                acumulado = _somar(acumulado, parcial)
+            if stop.is_set():
+                status = 'cancelado'
+        except Exception as e:
+            status, erro = 'erro', str(e)
+            print(f"[IMPORT] Job {job_id} falhou: {e}")
+        finally:
+            if cleanup:
+                for caminho, _ in fontes:
+                    try:
+                        os.remove(caminho)
+                    except OSError:
+                        pass
+
+        campos = {'status': status, 'erro': erro, 'finished_at': datetime.now().isoformat(),
+                  'arquivo_atual': None}
+        if acumulado is not None:
+            campos['relatorio'] = acumulado
+        if status == 'concluido':
+            campos['progresso'] = 100.0
+        self._update(job_id, **campos)
+        if self.on_change is not None and acumulado and acumulado['importados']:
+            try:
+                self.on_change()
+            except Exception as e:
+                print(f"[IMPORT] Erro no on_change do job {job_id}: {e}")
+        with self._lock:
+            self._stops.pop(job_id, None)
+            self._stats['finished'] += 1
+            self._stats['rows'] += acumulado['total'] if acumulado else 0
+            if status == 'cancelado':
+                self._stats['cancelled'] += 1
+            elif status == 'erro':
+                self._stats['failed'] += 1
+
+    def _update(self, job_id: str, **campos):
+        with self._lock:
+            self._jobs[job_id].update(campos)
+
+    def _prune(self):
+        terminados = [jid for jid, job in self._jobs.items() if job['finished_at']]
+        for jid in terminados[:max(0, len(self._jobs) - self.keep)]:
+            del self._jobs[jid]
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return copy.deepcopy(job) if job is not None else None
+
+    def list(self) -> list:
+        with self._lock:
+            return [copy.deepcopy(job) for job in reversed(self._jobs.values())]
+
+    def cancel(self, job_id: str) -> bool:
+        """Pede a interrupção após o bloco atual; False se o job não está em andamento"""
+        with self._lock:
+            stop = self._stops.get(job_id)
+            if stop is None:
+                return False
+            stop.set()
+            if self._jobs[job_id]['status'] == 'na_fila':
+                self._jobs[job_id]['status'] = 'cancelando'
+            return True
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['running'] = sum(1 for job in self._jobs.values() if job['status'] == 'executando')
+            stats['queued'] = sum(1 for job in self._jobs.values() if job['status'] == 'na_fila')
+        return stats
+
+
+def _somar(a: Optional[Dict], b: Dict) -> Dict:
+    """Soma dois relatórios de import_file (contadores, lotes e tempos)"""
+    if a is None:
+        return copy.deepcopy(b)
+    soma = {campo: a[campo] + b[campo] for campo in _CONTADORES}
+    soma['lotes'] = a['lotes'] + b['lotes']
+    soma['colunas'] = a['colunas'] or b['colunas']
+    soma['tempos_ms'] = {k: round(a['tempos_ms'].get(k, 0.0) + b['tempos_ms'].get(k, 0.0), 3)
+                         for k in set(a['tempos_ms']) | set(b['tempos_ms'])}
+    return soma
+
+
+# ==================== ATUALIZAÇÃO DE STATUS EM MASSA ====================
+
+def update_status_by_phone(conn, telefones: pd.DataFrame, novo_status: str, amostra: int = 50) -> Dict:
+    """
+    Muda o status dos leads cujos telefones estão na planilha, com operações
+    de conjunto: os telefones vão para uma tabela temporária, que é cruzada com
+    o índice de leads.telefone_norm; o histórico e o UPDATE são um comando cada.
+    Leads que já estavam no status pedido não ganham histórico nem updated_at.
+    Não faz commit (job da fila de escrita).
+
+    Args:
+        telefones: DataFrame com 'norm' (E.164) e 'original' (como veio na planilha)
+        amostra: Quantos itens de cada lista devolver
+
+    Returns:
+        Contagens (encontrados, alterados, sem_mudanca, nao_encontrados) e
+        amostras de 'atualizados' e 'nao_encontrados'
+    """
+    conn.execute('DROP TABLE IF EXISTS temp.atualizacao_telefones')
+    conn.execute('CREATE TEMP TABLE atualizacao_telefones (norm TEXT PRIMARY KEY, original TEXT)')
+    conn.executemany('INSERT OR IGNORE INTO atualizacao_telefones (norm, original) VALUES (?, ?)',
+                     telefones[['norm', 'original']].itertuples(index=False, name=None))
+
+    # Leads encontrados, com o status de antes da atualização
+    conn.execute('DROP TABLE IF EXISTS temp.atualizacao_leads')
+    conn.execute('''
+        CREATE TEMP TABLE atualizacao_leads AS
+        SELECT t.rowid AS ordem, t.original, l.id, l.telefone, l.status AS status_anterior,
+               l.status IS NOT ? AS alterado
+        FROM atualizacao_telefones t
+        JOIN leads l ON l.telefone_norm = t.norm
+    ''', (novo_status,))
+
+    conn.execute('''
+        INSERT INTO historico (lead_id, acao, descricao)
+        SELECT id, 'status_change',
+               'Status alterado de "' || COALESCE(status_anterior, '') || '" para "' || ? || '" (atualização em massa)'
+        FROM atualizacao_leads WHERE alterado ORDER BY ordem
+    ''', (novo_status,))
+    alterados = conn.execute('''
+        UPDATE leads SET status = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id IN (SELECT id FROM atualizacao_leads WHERE alterado)
+    ''', (novo_status,)).rowcount
+
+    encontrados = conn.execute('SELECT COUNT(*) FROM atualizacao_leads').fetchone()[0]
+    atualizados = [
+        {'telefone_planilha': row[0], 'telefone_sistema': row[1],
+         'status_anterior': row[2], 'alterado': bool(row[3])}
+        for row in conn.execute('''
+            SELECT original, telefone, status_anterior, alterado FROM atualizacao_leads
+            ORDER BY ordem LIMIT ?
+        ''', (amostra,))
+    ]
+    nao_encontrados_sql = '''
+        FROM atualizacao_telefones t
+        WHERE NOT EXISTS (SELECT 1 FROM leads l WHERE l.telefone_norm = t.norm)
+    '''
+    total_nao_encontrados = conn.execute(f'SELECT COUNT(*) {nao_encontrados_sql}').fetchone()[0]
+    nao_encontrados = [row[0] for row in conn.execute(
+        f'SELECT t.original {nao_encontrados_sql} ORDER BY t.rowid LIMIT ?', (amostra,))]
+
+    conn.execute('DROP TABLE temp.atualizacao_leads')
+    conn.execute('DROP TABLE temp.atualizacao_telefones')
+    return {
+        'encontrados': encontrados,
+        'alterados': alterados,
+        'sem_mudanca': encontrados - alterados,
+        'nao_encontrados': total_nao_encontrados,
+        'atualizados': atualizados,
+        'amostra_nao_encontrados': nao_encontrados,
+    }
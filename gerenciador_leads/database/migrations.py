@@ -0,0 +1,718 @@
+"""
+Migrações versionadas do schema SQLite (leads.db)
+
+- As versões aplicadas ficam registradas em schema_migrations
+- run_migrations() é chamado no init_db() dos apps e aplica só o que falta
+- Cada migração roda em transação própria
+- Migrações que dependem de tabelas/colunas ainda inexistentes ficam
+  pendentes e são tentadas de novo no próximo início (app.py e
+  app_whatsapp.py criam conjuntos diferentes de tabelas no mesmo arquivo)
+
+Verificação de planos de consulta:
+    python -m database.migrations --check [caminho/leads.db]
+
+Roda EXPLAIN QUERY PLAN em todas as consultas registradas em HOT_QUERIES
+e termina com erro se alguma fizer varredura completa de tabela.
+"""
+
+import re
+import sqlite3
+import sys
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from .phones import normalize_phone, normalize_phone_sql
+
+
+@dataclass
+class Migration:
+    """Uma alteração de schema versionada"""
+    version: int
+    name: str
+    apply: Callable[[sqlite3.Connection], None]
+    requires: Tuple[str, ...] = ()  # 'tabela' ou 'tabela.coluna'
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, name: str, requires: Sequence[str] = ()):
+    """Decorator que registra uma migração"""
+    def decorator(fn):
+        MIGRATIONS.append(Migration(version, name, fn, tuple(requires)))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return fn
+    return decorator
+
+
+# ==================== HELPERS DE SCHEMA ====================
+
+def table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (table,)
+    ).fetchone()
+    return row is not None
+
+
+def table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})').fetchall()]
+
+
+def add_column(conn: sqlite3.Connection, table: str, column: str, definition: str) -> bool:
+    """Adiciona uma coluna se ela ainda não existir"""
+    if column in table_columns(conn, table):
+        return False
+    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+
+def create_index(conn: sqlite3.Connection, name: str, table: str,
+                 columns: Sequence[str], unique: bool = False) -> bool:
+    """
+    Cria um índice, a menos que outro índice da tabela já comece
+    exatamente pelas mesmas colunas (ex.: autoindex de UNIQUE).
+    """
+    columns = list(columns)
+    for idx in conn.execute(f'PRAGMA index_list({table})').fetchall():
+        idx_cols = [row[2] for row in conn.execute(f'PRAGMA index_info({idx[1]})').fetchall()]
+        if idx_cols[:len(columns)] == columns:
+            return False
+
+    unique_sql = 'UNIQUE ' if unique else ''
+    conn.execute(
+        f'CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'
+    )
+    return True
+
+
+def _unmet_requirements(conn: sqlite3.Connection, requires: Sequence[str]) -> List[str]:
+    """Tabelas/colunas exigidas que não existem neste banco (vazia se todas existem)"""
+    faltando = []
+    for req in requires:
+        table, _, column = req.partition('.')
+        if not table_exists(conn, table):
+            faltando.append(req)
+        elif column and column not in table_columns(conn, table):
+            faltando.append(req)
+    return faltando
+
+
+# ==================== RUNNER ====================
+
+def _ensure_migrations_table(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+
+def applied_versions(conn: sqlite3.Connection) -> List[int]:
+    _ensure_migrations_table(conn)
+    return [row[0] for row in conn.execute('SELECT version FROM schema_migrations ORDER BY version')]
+
+
+def run_migrations(conn: sqlite3.Connection, verbose: bool = True) -> List[int]:
+    """
+    Aplica as migrações pendentes em ordem de versão.
+    Retorna as versões aplicadas nesta execução.
+    """
+    conn.commit()
+    done = set(applied_versions(conn))
+    applied = []
+
+    for m in MIGRATIONS:
+        if m.version in done:
+            continue
+        faltando = _unmet_requirements(conn, m.requires)
+        if faltando:
+            if verbose:
+                print(f"[MIGRAÇÃO] {m.version:04d} {m.name}: pendente (faltam {', '.join(faltando)})")
+            continue
+
+        try:
+            conn.execute('BEGIN')
+            m.apply(conn)
+            conn.execute(
+                'INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)',
+                (m.version, m.name, datetime.now())
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        applied.append(m.version)
+        if verbose:
+            print(f"[MIGRAÇÃO] {m.version:04d} {m.name}: aplicada")
+
+    if applied:
+        # Atualiza estatísticas do planejador para os novos índices
+        conn.execute('PRAGMA optimize')
+
+    return applied
+
+
+# ==================== MIGRAÇÕES ====================
+
+@migration(1, 'indices_hot_path', requires=('leads', 'anotacoes', 'historico'))
+def _m0001_indices_hot_path(conn):
+    """Índices das colunas consultadas a cada requisição/webhook"""
+    create_index(conn, 'idx_leads_cidade', 'leads', ['cidade'])
+    create_index(conn, 'idx_leads_status', 'leads', ['status'])
+    create_index(conn, 'idx_anotacoes_lead', 'anotacoes', ['lead_id', 'created_at'])
+    create_index(conn, 'idx_historico_lead', 'historico', ['lead_id', 'created_at'])
+
+
+@migration(2, 'indices_whatsapp_contatos', requires=('whatsapp_contacts.lead_id',))
+def _m0002_indices_whatsapp_contatos(conn):
+    create_index(conn, 'idx_whatsapp_contacts_lead', 'whatsapp_contacts', ['lead_id'])
+
+
+@migration(3, 'indices_whatsapp_mensagens', requires=(
+    'whatsapp_messages.wa_message_id', 'whatsapp_messages.contact_id', 'whatsapp_messages.timestamp'
+))
+def _m0003_indices_whatsapp_mensagens(conn):
+    create_index(conn, 'idx_whatsapp_messages_wa_id', 'whatsapp_messages', ['wa_message_id'])
+    create_index(conn, 'idx_whatsapp_messages_contact_ts', 'whatsapp_messages', ['contact_id', 'timestamp'])
+
+
+@migration(4, 'indices_crm_bot', requires=(
+    'crm_negocios', 'crm_estagios', 'lead_unidades', 'bot_historico'
+))
+def _m0004_indices_crm_bot(conn):
+    create_index(conn, 'idx_crm_negocios_pipeline_estagio', 'crm_negocios', ['pipeline_id', 'estagio_id'])
+    create_index(conn, 'idx_crm_estagios_pipeline', 'crm_estagios', ['pipeline_id', 'ordem'])
+    create_index(conn, 'idx_lead_unidades_unidade', 'lead_unidades', ['unidade_id'])
+    create_index(conn, 'idx_bot_historico_contact', 'bot_historico', ['contact_id', 'created_at'])
+
+
+@migration(5, 'vinculo_lead_contato', requires=('leads.telefone', 'whatsapp_contacts.lead_id'))
+def _m0005_vinculo_lead_contato(conn):
+    """
+    Preenche whatsapp_contacts.lead_id pelo telefone, uma única vez, para que
+    as leituras usem só o vínculo persistido em vez de "lead_id = ? OR phone = ?".
+    """
+    leads_por_telefone = {}
+    for lead_id, telefone in conn.execute(
+        "SELECT id, telefone FROM leads WHERE telefone IS NOT NULL AND telefone != '' ORDER BY id"
+    ):
+        chave = normalize_phone(telefone)
+        if chave:
+            leads_por_telefone.setdefault(chave, lead_id)
+
+    links = []
+    for contact_id, phone in conn.execute('SELECT id, phone FROM whatsapp_contacts WHERE lead_id IS NULL'):
+        lead_id = leads_por_telefone.get(normalize_phone(phone))
+        if lead_id:
+            links.append((lead_id, contact_id))
+
+    conn.executemany('UPDATE whatsapp_contacts SET lead_id = ? WHERE id = ?', links)
+
+
+@migration(6, 'ordem_recente_leads', requires=('leads.ultima_msg', 'leads.created_at', 'leads.updated_at'))
+def _m0006_ordem_recente_leads(conn):
+    """
+    Chave de ordenação armazenada para a paginação por cursor de /api/leads.
+    ORDER BY COALESCE(ultima_msg, created_at) não usa índice; a coluna
+    ordem_recente guarda o mesmo valor e é mantida por triggers.
+    """
+    add_column(conn, 'leads', 'ordem_recente', 'TIMESTAMP')
+    conn.execute('UPDATE leads SET ordem_recente = COALESCE(ultima_msg, created_at)')
+
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_leads_ordem_recente_ins
+        AFTER INSERT ON leads
+        BEGIN
+            UPDATE leads SET ordem_recente = COALESCE(NEW.ultima_msg, NEW.created_at)
+            WHERE id = NEW.id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_leads_ordem_recente_upd
+        AFTER UPDATE OF ultima_msg, created_at ON leads
+        BEGIN
+            UPDATE leads SET ordem_recente = COALESCE(NEW.ultima_msg, NEW.created_at)
+            WHERE id = NEW.id;
+        END
+    ''')
+
+    # Índices compostos (filtro, chave, id) para as páginas com e sem filtro;
+    # os índices simples de status/cidade passam a ser prefixo destes
+    conn.execute('DROP INDEX IF EXISTS idx_leads_status')
+    conn.execute('DROP INDEX IF EXISTS idx_leads_cidade')
+    create_index(conn, 'idx_leads_ordem_recente', 'leads', ['ordem_recente', 'id'])
+    create_index(conn, 'idx_leads_status_ordem', 'leads', ['status', 'ordem_recente', 'id'])
+    create_index(conn, 'idx_leads_cidade_ordem', 'leads', ['cidade', 'ordem_recente', 'id'])
+    create_index(conn, 'idx_leads_updated', 'leads', ['updated_at', 'id'])
+
+
+@migration(7, 'indice_historico_envios', requires=('whatsapp_messages.sent_at',))
+def _m0007_indice_historico_envios(conn):
+    """Ordenação de /api/whatsapp/history (app.py) por sent_at"""
+    create_index(conn, 'idx_whatsapp_messages_sent', 'whatsapp_messages', ['sent_at', 'id'])
+
+
+def fts5_available(conn: sqlite3.Connection) -> bool:
+    """Verifica se o SQLite embutido foi compilado com FTS5"""
+    try:
+        conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS temp._fts5_probe USING fts5(x)')
+        conn.execute('DROP TABLE temp._fts5_probe')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+# Dígitos do telefone em SQL puro (os triggers rodam em qualquer conexão, inclusive a do desktop)
+_TELEFONE_DIGITOS = (
+    "REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(REPLACE("
+    "COALESCE({col}, ''), '(', ''), ')', ''), '-', ''), ' ', ''), '+', ''), '.', '')"
+)
+
+
+@migration(8, 'busca_fts_leads', requires=(
+    'leads.nome', 'leads.endereco', 'leads.cidade', 'leads.tipo_servico', 'leads.telefone'
+))
+def _m0008_busca_fts_leads(conn):
+    """
+    Índice full-text dos leads (nome, endereço, cidade, tipo de serviço) sem
+    acentos, e índice trigram dos dígitos do telefone para busca por trecho/final.
+    """
+    if not fts5_available(conn):
+        print('[MIGRAÇÃO] FTS5 indisponível neste SQLite; busca de leads continua com LIKE')
+        return
+
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS leads_fts USING fts5(
+            nome, endereco, cidade, tipo_servico,
+            content='leads', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_leads_fts_ins AFTER INSERT ON leads BEGIN
+            INSERT INTO leads_fts (rowid, nome, endereco, cidade, tipo_servico)
+            VALUES (NEW.id, NEW.nome, NEW.endereco, NEW.cidade, NEW.tipo_servico);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_leads_fts_del AFTER DELETE ON leads BEGIN
+            INSERT INTO leads_fts (leads_fts, rowid, nome, endereco, cidade, tipo_servico)
+            VALUES ('delete', OLD.id, OLD.nome, OLD.endereco, OLD.cidade, OLD.tipo_servico);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_leads_fts_upd
+        AFTER UPDATE OF nome, endereco, cidade, tipo_servico ON leads BEGIN
+            INSERT INTO leads_fts (leads_fts, rowid, nome, endereco, cidade, tipo_servico)
+            VALUES ('delete', OLD.id, OLD.nome, OLD.endereco, OLD.cidade, OLD.tipo_servico);
+            INSERT INTO leads_fts (rowid, nome, endereco, cidade, tipo_servico)
+            VALUES (NEW.id, NEW.nome, NEW.endereco, NEW.cidade, NEW.tipo_servico);
+        END
+    ''')
+    conn.execute("INSERT INTO leads_fts (leads_fts) VALUES ('rebuild')")
+
+    if sqlite3.sqlite_version_info < (3, 34, 0):
+        print('[MIGRAÇÃO] tokenizer trigram requer SQLite 3.34+; busca por telefone continua com LIKE')
+        return
+
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS leads_telefone_fts USING fts5(
+            digitos, tokenize='trigram'
+        )
+    ''')
+    novo = _TELEFONE_DIGITOS.format(col='NEW.telefone')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_leads_telefone_fts_ins AFTER INSERT ON leads BEGIN
+            INSERT INTO leads_telefone_fts (rowid, digitos) VALUES (NEW.id, {novo});
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_leads_telefone_fts_del AFTER DELETE ON leads BEGIN
+            DELETE FROM leads_telefone_fts WHERE rowid = OLD.id;
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_leads_telefone_fts_upd AFTER UPDATE OF telefone ON leads BEGIN
+            DELETE FROM leads_telefone_fts WHERE rowid = OLD.id;
+            INSERT INTO leads_telefone_fts (rowid, digitos) VALUES (NEW.id, {novo});
+        END
+    ''')
+    conn.execute('DELETE FROM leads_telefone_fts')
+    conn.execute(f'INSERT INTO leads_telefone_fts (rowid, digitos) '
+                 f'SELECT id, {_TELEFONE_DIGITOS.format(col="telefone")} FROM leads')
+
+
+@migration(9, 'busca_fts_mensagens', requires=('whatsapp_messages.content',))
+def _m0009_busca_fts_mensagens(conn):
+    """Índice full-text do conteúdo das mensagens do WhatsApp"""
+    if not fts5_available(conn):
+        print('[MIGRAÇÃO] FTS5 indisponível neste SQLite; busca de mensagens desativada')
+        return
+
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS whatsapp_messages_fts USING fts5(
+            content,
+            content='whatsapp_messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_whatsapp_messages_fts_ins AFTER INSERT ON whatsapp_messages BEGIN
+            INSERT INTO whatsapp_messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_whatsapp_messages_fts_del AFTER DELETE ON whatsapp_messages BEGIN
+            INSERT INTO whatsapp_messages_fts (whatsapp_messages_fts, rowid, content)
+            VALUES ('delete', OLD.id, OLD.content);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_whatsapp_messages_fts_upd
+        AFTER UPDATE OF content ON whatsapp_messages BEGIN
+            INSERT INTO whatsapp_messages_fts (whatsapp_messages_fts, rowid, content)
+            VALUES ('delete', OLD.id, OLD.content);
+            INSERT INTO whatsapp_messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+    ''')
+    conn.execute("INSERT INTO whatsapp_messages_fts (whatsapp_messages_fts) VALUES ('rebuild')")
+
+
+def _stats_upsert(escopo: str, chave: str, delta: int) -> str:
+    """Comando de trigger que soma delta ao contador (escopo, chave)"""
+    return (
+        f"INSERT INTO stats_contadores (escopo, chave, valor) VALUES ('{escopo}', {chave}, {delta}) "
+        f"ON CONFLICT (escopo, chave) DO UPDATE SET valor = valor + ({delta});"
+    )
+
+
+def _create_stats_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_contadores (
+            escopo TEXT NOT NULL,
+            chave TEXT NOT NULL,
+            valor INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (escopo, chave)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _create_stats_triggers(conn, table: str, prefix: str, dimensions: Sequence[Tuple[str, str]]):
+    """
+    Triggers de INSERT/DELETE/UPDATE que mantêm o total (escopo = prefix) e um
+    contador por dimensão (escopo, expressão SQL sobre a linha, colunas envolvidas).
+    """
+    def upserts(row: str, delta: int) -> str:
+        cmds = [_stats_upsert(prefix, "''", delta)]
+        for escopo, expr, _ in dimensions:
+            cmds.append(_stats_upsert(escopo, expr.format(row=row), delta))
+        return '\n'.join(cmds)
+
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS trg_stats_{prefix}_ins AFTER INSERT ON {table} '
+                 f'BEGIN {upserts("NEW", 1)} END')
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS trg_stats_{prefix}_del AFTER DELETE ON {table} '
+                 f'BEGIN {upserts("OLD", -1)} END')
+
+    for escopo, expr, columns in dimensions:
+        old, new = expr.format(row='OLD'), expr.format(row='NEW')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{escopo}_upd
+            AFTER UPDATE OF {columns} ON {table}
+            WHEN {old} IS NOT {new}
+            BEGIN
+                {_stats_upsert(escopo, old, -1)}
+                {_stats_upsert(escopo, new, 1)}
+            END
+        ''')
+
+
+@migration(10, 'contadores_leads', requires=('leads.status', 'leads.cidade'))
+def _m0010_contadores_leads(conn):
+    """Contadores de leads (total, por status, por cidade) para /api/stats"""
+    from .stats import rebuild_counters
+
+    _create_stats_table(conn)
+    _create_stats_triggers(conn, 'leads', 'leads', (
+        ('leads_status', "COALESCE({row}.status, '')", 'status'),
+        ('leads_cidade', "COALESCE({row}.cidade, '')", 'cidade'),
+    ))
+    rebuild_counters(conn)
+
+
+@migration(11, 'contadores_mensagens', requires=('whatsapp_messages.status', 'whatsapp_messages.sent_at'))
+def _m0011_contadores_mensagens(conn):
+    """Contadores de whatsapp_messages (total, por status, por dia) para /api/whatsapp/stats"""
+    from .stats import rebuild_counters
+
+    _create_stats_table(conn)
+    _create_stats_triggers(conn, 'whatsapp_messages', 'mensagens', (
+        ('mensagens_status', "COALESCE({row}.status, '')", 'status'),
+        ('mensagens_dia', "COALESCE(DATE({row}.sent_at), '')", 'sent_at'),
+    ))
+    rebuild_counters(conn)
+
+
+@migration(12, 'telefone_normalizado_leads', requires=('leads.telefone',))
+def _m0012_telefone_normalizado_leads(conn):
+    """
+    leads.telefone_norm: telefone em E.164 (database.phones), com índice único,
+    para buscar lead por telefone com igualdade em vez de REPLACE(...) LIKE.
+    Se dois leads normalizam para o mesmo número, só o mais antigo fica com
+    telefone_norm; o outro fica NULL (e é listado aqui).
+    """
+    add_column(conn, 'leads', 'telefone_norm', 'TEXT')
+
+    vistos = {}
+    rows = []
+    for lead_id, telefone in conn.execute('SELECT id, telefone FROM leads ORDER BY id'):
+        norm = normalize_phone(telefone)
+        if not norm:
+            continue
+        if norm in vistos:
+            print(f'[MIGRAÇÃO] Lead {lead_id} tem o mesmo telefone do lead {vistos[norm]} ({norm})')
+            continue
+        vistos[norm] = lead_id
+        rows.append((norm, lead_id))
+    conn.execute('UPDATE leads SET telefone_norm = NULL')
+    conn.executemany('UPDATE leads SET telefone_norm = ? WHERE id = ?', rows)
+    create_index(conn, 'idx_leads_telefone_norm', 'leads', ['telefone_norm'], unique=True)
+
+    novo = normalize_phone_sql('NEW.telefone')
+    for nome, evento in (('ins', 'INSERT'), ('upd', 'UPDATE OF telefone')):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_leads_telefone_norm_{nome} AFTER {evento} ON leads BEGIN
+                UPDATE leads SET telefone_norm = CASE
+                    WHEN EXISTS (SELECT 1 FROM leads WHERE telefone_norm = {novo} AND id != NEW.id) THEN NULL
+                    ELSE {novo}
+                END
+                WHERE id = NEW.id;
+            END
+        ''')
+
+
+@migration(13, 'telefone_normalizado_contatos', requires=('whatsapp_contacts.phone',))
+def _m0013_telefone_normalizado_contatos(conn):
+    """
+    whatsapp_contacts.telefone_norm (E.164), para casar contato e lead por
+    igualdade mesmo quando o wa_id vem sem o nono dígito.
+    """
+    add_column(conn, 'whatsapp_contacts', 'telefone_norm', 'TEXT')
+    conn.executemany(
+        'UPDATE whatsapp_contacts SET telefone_norm = ? WHERE id = ?',
+        [(normalize_phone(phone), contact_id)
+         for contact_id, phone in conn.execute('SELECT id, phone FROM whatsapp_contacts').fetchall()]
+    )
+    create_index(conn, 'idx_whatsapp_contacts_telefone_norm', 'whatsapp_contacts', ['telefone_norm'])
+
+    novo = normalize_phone_sql('NEW.phone')
+    for nome, evento in (('ins', 'INSERT'), ('upd', 'UPDATE OF phone')):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_whatsapp_contacts_telefone_norm_{nome}
+            AFTER {evento} ON whatsapp_contacts BEGIN
+                UPDATE whatsapp_contacts SET telefone_norm = {novo} WHERE id = NEW.id;
+            END
+        ''')
+
+
+@migration(14, 'campanhas')
+def _m0014_campanhas(conn):
+    """Campanhas de envio em massa e estado por destinatário (database.campaigns)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS campanhas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            origem TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'ativa',
+            parametros TEXT,
+            total INTEGER DEFAULT 0,
+            enviados INTEGER DEFAULT 0,
+            sucesso INTEGER DEFAULT 0,
+            falha INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS campanha_destinatarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campanha_id INTEGER NOT NULL,
+            lead_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pendente',
+            tentativas INTEGER DEFAULT 0,
+            message_id TEXT,
+            erro TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (campanha_id, lead_id),
+            FOREIGN KEY (campanha_id) REFERENCES campanhas(id)
+        )
+    ''')
+    create_index(conn, 'idx_campanhas_origem_status', 'campanhas', ['origem', 'status'])
+    create_index(conn, 'idx_campanha_destinatarios_status', 'campanha_destinatarios',
+                 ['campanha_id', 'status', 'id'])
+
+
+@migration(15, 'bot_roteamento_provedores', requires=('bot_config',))
+def _m0015_bot_roteamento_provedores(conn):
+    """Failover/hedge entre provedores de IA (bot/router.py)"""
+    add_column(conn, 'bot_config', 'roteamento_ativo', 'INTEGER DEFAULT 0')
+    # JSON {"gemini": "...", "openai": "...", "claude": "..."}: chaves dos provedores reserva
+    add_column(conn, 'bot_config', 'cloud_api_keys', 'TEXT')
+    add_column(conn, 'bot_config', 'hedge_ms', 'INTEGER DEFAULT 4000')
+
+
+@migration(16, 'ordem_mensagens_sem_data', requires=('whatsapp_messages',))
+def _m0016_ordem_mensagens_sem_data(conn):
+    """
+    Paginação de mensagens por COALESCE(data, 0) (database.pagination.sort_key):
+    mensagem sem data não interrompe o cursor. O índice usa a mesma expressão.
+    """
+    colunas = set(table_columns(conn, 'whatsapp_messages'))
+    if {'contact_id', 'timestamp'} <= colunas:
+        create_index(conn, 'idx_whatsapp_messages_contact_ordem', 'whatsapp_messages',
+                     ['contact_id', 'COALESCE(timestamp, 0)'])
+    if 'sent_at' in colunas:
+        create_index(conn, 'idx_whatsapp_messages_sent_ordem', 'whatsapp_messages',
+                     ['COALESCE(sent_at, 0)', 'id'])
+
+
+# ==================== VERIFICAÇÃO DE PLANOS ====================
+
+# Consultas quentes que nunca devem varrer a tabela inteira
+# (nome, sql, parâmetros de exemplo, tabelas/colunas necessárias)
+HOT_QUERIES: List[Tuple[str, str, tuple, Tuple[str, ...]]] = []
+
+
+def register_hot_query(name: str, sql: str, params: tuple = (), requires: Sequence[str] = ()):
+    """Registra uma consulta para a verificação de EXPLAIN QUERY PLAN"""
+    HOT_QUERIES.append((name, sql, tuple(params), tuple(requires)))
+
+
+register_hot_query('webhook_mensagem_duplicada',
+                   'SELECT id FROM whatsapp_messages WHERE wa_message_id = ?', ('wamid.x',),
+                   ('whatsapp_messages.wa_message_id',))
+register_hot_query('mensagens_da_conversa',
+                   'SELECT * FROM whatsapp_messages WHERE contact_id = ? '
+                   'ORDER BY COALESCE(timestamp, 0) DESC, id DESC LIMIT 50', (1,),
+                   ('whatsapp_messages.contact_id', 'whatsapp_messages.timestamp'))
+register_hot_query('contato_por_lead',
+                   'SELECT id FROM whatsapp_contacts WHERE lead_id = ?', (1,), ('whatsapp_contacts.lead_id',))
+register_hot_query('contatos_dos_leads',
+                   'SELECT id, lead_id, phone, unread_count FROM whatsapp_contacts WHERE lead_id IN (?, ?, ?)',
+                   (1, 2, 3), ('whatsapp_contacts.lead_id',))
+register_hot_query('contato_por_telefone',
+                   'SELECT id, lead_id FROM whatsapp_contacts WHERE phone = ?', ('5511999999999',),
+                   ('whatsapp_contacts',))
+register_hot_query('lead_por_telefone',
+                   'SELECT id FROM leads WHERE telefone_norm = ?', ('+5511999999999',), ('leads.telefone_norm',))
+register_hot_query('contatos_por_telefone_norm',
+                   'SELECT id, lead_id FROM whatsapp_contacts WHERE telefone_norm IN (?, ?)',
+                   ('+5511999999999', '+5511988888888'), ('whatsapp_contacts.telefone_norm',))
+register_hot_query('leads_por_cidade',
+                   'SELECT * FROM leads WHERE cidade = ?', ('Campinas',), ('leads',))
+register_hot_query('leads_por_status',
+                   'SELECT * FROM leads WHERE status = ?', ('novo',), ('leads',))
+register_hot_query('anotacoes_do_lead',
+                   'SELECT * FROM anotacoes WHERE lead_id = ? ORDER BY created_at DESC', (1,), ('anotacoes',))
+register_hot_query('pagina_de_leads',
+                   'SELECT * FROM leads WHERE (ordem_recente, id) < (?, ?) ORDER BY ordem_recente DESC, id DESC LIMIT 200',
+                   ('2024-01-01 00:00:00', 1000), ('leads.ordem_recente',))
+register_hot_query('pagina_de_leads_por_status',
+                   'SELECT * FROM leads WHERE status = ? ORDER BY ordem_recente DESC, id DESC LIMIT 200',
+                   ('novo',), ('leads.ordem_recente',))
+register_hot_query('pagina_de_mensagens',
+                   'SELECT * FROM whatsapp_messages WHERE contact_id = ? AND COALESCE(timestamp, 0) <= ? '
+                   'AND (COALESCE(timestamp, 0), id) < (?, ?) ORDER BY COALESCE(timestamp, 0) DESC, id DESC LIMIT 50',
+                   (1, '2024-01-01 00:00:00', '2024-01-01 00:00:00', 1000),
+                   ('whatsapp_messages.contact_id', 'whatsapp_messages.timestamp'))
+register_hot_query('historico_de_envios',
+                   'SELECT * FROM whatsapp_messages WHERE COALESCE(sent_at, 0) <= ? '
+                   'AND (COALESCE(sent_at, 0), id) < (?, ?) ORDER BY COALESCE(sent_at, 0) DESC, id DESC LIMIT 50',
+                   ('2024-01-01 00:00:00', '2024-01-01 00:00:00', 1000), ('whatsapp_messages.sent_at',))
+register_hot_query('historico_do_lead',
+                   'SELECT * FROM historico WHERE lead_id = ? ORDER BY created_at DESC', (1,), ('historico',))
+register_hot_query('historico_do_bot',
+                   'SELECT role, content FROM bot_historico WHERE contact_id = ? ORDER BY created_at DESC LIMIT 10',
+                   (1,), ('bot_historico',))
+register_hot_query('negocios_do_pipeline',
+                   'SELECT * FROM crm_negocios WHERE pipeline_id = ? AND estagio_id = ?', (1, 1),
+                   ('crm_negocios',))
+register_hot_query('pendentes_da_campanha',
+                   'SELECT id, lead_id FROM campanha_destinatarios WHERE campanha_id = ? AND status = ? '
+                   'ORDER BY id LIMIT 50', (1, 'pendente'), ('campanha_destinatarios',))
+register_hot_query('resultados_da_campanha',
+                   'SELECT * FROM campanha_destinatarios WHERE campanha_id = ? AND id > ? ORDER BY id LIMIT 100',
+                   (1, 0), ('campanha_destinatarios',))
+register_hot_query('estagios_do_pipeline',
+                   'SELECT * FROM crm_estagios WHERE pipeline_id = ? ORDER BY ordem', (1,), ('crm_estagios',))
+
+
+# 'SCAN tabela' (SQLite >= 3.36) ou 'SCAN TABLE tabela' (versões anteriores)
+_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+
+def explain(conn: sqlite3.Connection, sql: str, params: tuple = ()) -> List[str]:
+    """Retorna as linhas de EXPLAIN QUERY PLAN de uma consulta"""
+    return [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()]
+
+
+def check_query_plans(conn: sqlite3.Connection) -> List[Dict]:
+    """
+    Verifica o plano de todas as consultas registradas.
+    Cada resultado tem: name, plan, full_scan (tabelas varridas) e skipped.
+    """
+    results = []
+    for name, sql, params, requires in HOT_QUERIES:
+        if _unmet_requirements(conn, requires):
+            results.append({'name': name, 'plan': [], 'full_scan': [], 'skipped': True})
+            continue
+        plan = explain(conn, sql, params)
+        scans = [m.group(1) for m in (_FULL_SCAN.match(line) for line in plan) if m]
+        results.append({'name': name, 'plan': plan, 'full_scan': scans, 'skipped': False})
+    return results
+
+
+def main(argv: List[str] = None) -> int:
+    import os
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    check = '--check' in argv
+    paths = [a for a in argv if not a.startswith('--')]
+    db_path = paths[0] if paths else os.path.join(os.path.dirname(os.path.dirname(__file__)), 'leads.db')
+
+    conn = sqlite3.connect(db_path)
+    try:
+        run_migrations(conn)
+        if not check:
+            return 0
+
+        falhas = 0
+        for result in check_query_plans(conn):
+            if result['skipped']:
+                print(f"  - {result['name']}: ignorada (tabela ausente)")
+            elif result['full_scan']:
+                falhas += 1
+                print(f"  ✗ {result['name']}: SCAN em {', '.join(result['full_scan'])}")
+                for line in result['plan']:
+                    print(f"      {line}")
+            else:
+                print(f"  ✓ {result['name']}")
+
+        if falhas:
+            print(f"\n{falhas} consulta(s) com varredura completa de tabela")
+            return 1
+        print('\nNenhuma varredura completa encontrada')
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""
+Paginação por cursor (keyset) para as listagens grandes
+
+Em vez de LIMIT/OFFSET, que lê e descarta todas as linhas anteriores,
+a próxima página começa logo após a última linha da página atual:
+
+    WHERE (sort_key, id) < (?, ?) ORDER BY sort_key DESC, id DESC LIMIT ?
+
+O cursor enviado ao cliente é opaco (base64 de um JSON com o tipo da
+listagem e os valores da última linha), então o formato pode mudar sem
+quebrar o frontend.
+
+Chave de ordenação que pode ser NULL: comparar com NULL dá NULL e a
+paginação pararia na primeira linha sem valor. Ordene por sort_key(coluna)
+(COALESCE com NULL_SORT_KEY, com índice na mesma expressão); next_cursor
+grava NULL como NULL_SORT_KEY e keyset_where recusa cursor com NULL.
+
+Uso:
+    after = decode_cursor(request.args.get('cursor'), 'leads', size=2)  # None se ausente
+    where, params = keyset_where(('ordem_recente', 'id'), after)
+    ...
+    next_cursor = encode_cursor('leads', [ultimo['ordem_recente'], ultimo['id']])
+
+    # Coluna que aceita NULL
+    where, params = keyset_where((sort_key('timestamp'), 'id'), after)
+    ... ORDER BY COALESCE(timestamp, 0) DESC, id DESC
+    next_cursor('mensagens', rows, ('timestamp', 'id'), limit)
+"""
+
+import base64
+import json
+from typing import List, Optional, Sequence, Tuple
+
+
+# Valor que substitui NULL na ordenação: inteiro vem antes de qualquer texto no SQLite
+NULL_SORT_KEY = 0
+
+
+class InvalidCursor(ValueError):
+    """Cursor malformado ou de outra listagem"""
+
+
+def sort_key(column: str) -> str:
+    """Expressão de ordenação para coluna que aceita NULL (usar também no ORDER BY e no índice)"""
+    return f'COALESCE({column}, {NULL_SORT_KEY})'
+
+
+def encode_cursor(kind: str, values: Sequence) -> str:
+    """Gera o token opaco a partir dos valores da última linha"""
+    raw = json.dumps([kind, list(values)], separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token: Optional[str], kind: str, size: int = None) -> Optional[List]:
+    """
+    Retorna os valores do cursor, None se não informado; InvalidCursor se
+    inválido (inclusive se não tiver `size` valores escalares).
+    """
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        token_kind, values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError):
+        raise InvalidCursor('Cursor inválido')
+    if token_kind != kind or not isinstance(values, list):
+        raise InvalidCursor('Cursor não pertence a esta listagem')
+    if size is not None and len(values) != size:
+        raise InvalidCursor('Cursor inválido')
+    if not all(v is None or isinstance(v, (str, int, float)) for v in values):
+        raise InvalidCursor('Cursor inválido')
+    return values
+
+
+def decode_offset_cursor(token: Optional[str], kind: str) -> Optional[int]:
+    """Cursor de deslocamento (listagens por relevância): inteiro >= 0 ou None"""
+    values = decode_cursor(token, kind, size=1)
+    if values is None:
+        return None
+    if not isinstance(values[0], int) or isinstance(values[0], bool) or values[0] < 0:
+        raise InvalidCursor('Cursor inválido')
+    return values[0]
+
+
+def keyset_where(columns: Sequence[str], after: Optional[Sequence],
+                 descending: bool = True) -> Tuple[str, list]:
+    """
+    Monta a condição "depois do cursor" usando comparação de row values,
+    que o SQLite resolve como faixa no índice composto das mesmas colunas.
+    A primeira coluna também vai como limite simples: com uma expressão
+    (sort_key) o SQLite só usa o índice para faixa nessa forma.
+    """
+    if after is None:
+        return '', []
+    if len(after) != len(columns) or any(v is None for v in after):
+        raise InvalidCursor('Cursor inválido')
+    op = '<' if descending else '>'
+    placeholders = ', '.join('?' * len(columns))
+    return (f"{columns[0]} {op}= ? AND ({', '.join(columns)}) {op} ({placeholders})",
+            [after[0]] + list(after))
+
+
+def next_cursor(kind: str, rows: Sequence, columns: Sequence[str], limit: int) -> Optional[str]:
+    """Cursor da próxima página, ou None se esta foi a última"""
+    if len(rows) < limit or not rows:
+        return None
+    last = rows[-1]
+    return encode_cursor(kind, [NULL_SORT_KEY if last[col] is None else last[col] for col in columns])
@@ -0,0 +1,123 @@
+"""
+Normalização canônica de telefones (E.164)
+
+Um único formato para comparar telefones em todo o sistema:
+    '(11) 99999-8888'      -> '+5511999998888'
+    '5511999998888'        -> '+5511999998888'   (wa_id do WhatsApp)
+    '551199998888'         -> '+5511999998888'   (celular sem o nono dígito)
+    '011 2082-3091'        -> '+551120823091'
+    '+351 912 345 678'     -> '+351912345678'
+    '9999-8888'            -> None               (sem DDD)
+
+Regras:
+- Separadores aceitos: espaço ( ) - + .  ; qualquer outro caractere invalida
+- Com '+' e DDI diferente de 55, o número é mantido como veio (8 a 15 dígitos)
+- Números brasileiros: remove zeros à esquerda e o DDI 55; celular com 8
+  dígitos (começando com 6-9) ganha o nono dígito; fica DDD + número
+  (10 dígitos fixo, 11 celular)
+
+A mesma regra existe em SQL (normalize_phone_sql) para os triggers que mantêm
+leads.telefone_norm e whatsapp_contacts.telefone_norm em qualquer conexão,
+inclusive as que não passam pelo Python dos apps.
+
+Uso:
+    norm = normalize_phone(request.json['telefone'])
+    cursor.execute('SELECT id FROM leads WHERE telefone_norm = ?', (norm,))
+"""
+
+import re
+from typing import Optional
+
+# Caracteres ignorados ao extrair os dígitos (iguais aos do REPLACE em SQL)
+_SEPARATORS = ('(', ')', '-', ' ', '+', '.')
+_DIGITS = re.compile(r'[0-9]+')
+
+
+def normalize_phone(telefone) -> Optional[str]:
+    """Telefone em E.164 ('+55DDDNUMERO'), ou None se não der para normalizar"""
+    if telefone is None:
+        return None
+    texto = str(telefone).strip(' ')
+    digitos = texto
+    for sep in _SEPARATORS:
+        digitos = digitos.replace(sep, '')
+    if not _DIGITS.fullmatch(digitos):
+        return None
+
+    if texto.startswith('+') and not digitos.startswith('55'):
+        if 8 <= len(digitos) <= 15 and not digitos.startswith('0'):
+            return '+' + digitos
+        return None
+
+    numero = digitos.lstrip('0')
+    if len(numero) in (12, 13) and numero.startswith('55'):
+        numero = numero[2:]
+    if len(numero) == 10 and numero[2] in '6789':
+        numero = numero[:2] + '9' + numero[2:]
+    if len(numero) == 10 or (len(numero) == 11 and numero[2] == '9'):
+        return '+55' + numero
+    return None
+
+
+def phone_digits_sql(col: str) -> str:
+    """Expressão SQL com o valor da coluna sem os separadores"""
+    expr = f"COALESCE({col}, '')"
+    for sep in _SEPARATORS:
+        expr = f"REPLACE({expr}, '{sep}', '')"
+    return expr
+
+
+def normalize_phone_sql(col: str) -> str:
+    """
+    Expressão SQL equivalente a normalize_phone() para a coluna/valor `col`
+    (ex.: 'telefone' ou 'NEW.telefone'); só funções nativas do SQLite.
+    """
+    return f'''(SELECT CASE
+        WHEN d = '' OR d GLOB '*[^0-9]*' THEN NULL
+        WHEN intl AND d NOT GLOB '55*' THEN
+            CASE WHEN length(d) BETWEEN 8 AND 15 AND d NOT GLOB '0*' THEN '+' || d END
+        WHEN length(n) = 10 AND substr(n, 3, 1) IN ('6', '7', '8', '9')
+            THEN '+55' || substr(n, 1, 2) || '9' || substr(n, 3)
+        WHEN length(n) = 10 OR (length(n) = 11 AND substr(n, 3, 1) = '9') THEN '+55' || n
+    END FROM (
+        SELECT d, intl,
+               CASE WHEN length(z) IN (12, 13) AND z GLOB '55*' THEN substr(z, 3) ELSE z END AS n
+        FROM (SELECT d, intl, LTRIM(d, '0') AS z
+              FROM (SELECT {phone_digits_sql(col)} AS d,
+                           TRIM(COALESCE({col}, ''), ' ') GLOB '+*' AS intl))
+    ))'''
+
+
+def normalize_phone_series(telefones):
+    """
+    normalize_phone() vetorizado para uma pandas Series (importação de planilhas);
+    inválidos viram None. Números lidos como float/int do Excel são tratados
+    como inteiros (sem o '.0').
+    """
+    import pandas as pd
+
+    if pd.api.types.is_numeric_dtype(telefones.dtype):
+        telefones = telefones.round().astype('Int64')
+    texto = telefones.astype('string').str.strip(' ')
+    digitos = texto.str.replace(r'[()\- +.]', '', regex=True)
+    valido = digitos.str.fullmatch(r'[0-9]+').fillna(False).astype(bool)
+
+    internacional = (texto.str.startswith('+') & ~digitos.str.startswith('55')).fillna(False).astype(bool)
+    intl_ok = (digitos.str.len().between(8, 15) & ~digitos.str.startswith('0')).fillna(False).astype(bool)
+
+    numero = digitos.str.lstrip('0')
+    tamanho = numero.str.len()
+    com_ddi = (tamanho.isin([12, 13]) & numero.str.startswith('55')).fillna(False).astype(bool)
+    numero = numero.where(~com_ddi, numero.str[2:])
+    tamanho = numero.str.len()
+    sem_nono = ((tamanho == 10) & numero.str[2].isin(['6', '7', '8', '9'])).fillna(False).astype(bool)
+    numero = numero.where(~sem_nono, numero.str[:2] + '9' + numero.str[2:])
+    tamanho = numero.str.len()
+    br_ok = ((tamanho == 10) | ((tamanho == 11) & (numero.str[2] == '9'))).fillna(False).astype(bool)
+
+    resultado = pd.Series(None, index=telefones.index, dtype=object)
+    intl = valido & internacional & intl_ok
+    br = valido & ~internacional & br_ok
+    resultado[intl] = ('+' + digitos[intl]).astype(object)
+    resultado[br] = ('+55' + numero[br]).astype(object)
+    return resultado.where(resultado.notna(), None)
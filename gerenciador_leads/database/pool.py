@@ -0,0 +1,246 @@
+"""
+Pool de conexões SQLite compartilhado pelos apps Flask
+
+- Conexões reaproveitadas entre requisições (sem sqlite3.connect por rota)
+- WAL + PRAGMAs ajustados (synchronous, cache_size, mmap_size, busy_timeout)
+- Afinidade por thread: cada thread recebe de volta a última conexão que usou
+- Métricas de uso do pool e tempo de espera
+
+Uso:
+    pool = ConnectionPool(DB_PATH)
+    conn = pool.acquire()
+    ...
+    conn.close()  # devolve ao pool em vez de fechar
+"""
+
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Dict
+
+
+# PRAGMAs aplicados em toda conexão nova
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',        # Leitores não bloqueiam o escritor
+    'synchronous': 'NORMAL',      # Seguro com WAL e bem mais rápido que FULL
+    'cache_size': -20000,         # ~20MB de cache de páginas por conexão
+    'mmap_size': 268435456,       # 256MB de I/O mapeado em memória
+    'temp_store': 'MEMORY',
+}
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    Conexão SQLite que volta para o pool ao ser fechada.
+    As rotas continuam chamando conn.close() normalmente.
+    """
+
+    def close(self):
+        pool = getattr(self, '_pool', None)
+        if pool is None:
+            super().close()
+        elif getattr(self, '_checked_out', False):
+            # Ignora close() duplicado para não devolver a conexão duas vezes
+            self._checked_out = False
+            pool._release(self)
+
+    def _close_real(self):
+        self._pool = None
+        super().close()
+
+
+class ConnectionPool:
+    """Pool de conexões SQLite com afinidade por thread"""
+
+    def __init__(self, db_path: str, max_size: int = 16,
+                 busy_timeout: int = 5000, acquire_timeout: float = 2.0,
+                 pragmas: Dict = None):
+        """
+        Args:
+            db_path: Caminho do arquivo SQLite
+            max_size: Máximo de conexões emprestadas ao mesmo tempo (excedentes viram overflow)
+            busy_timeout: Milissegundos que o SQLite espera por um lock antes de falhar
+            acquire_timeout: Segundos esperando uma conexão livre antes de abrir uma extra
+            pragmas: PRAGMAs adicionais/sobrescritos
+        """
+        self.db_path = db_path
+        self.max_size = max_size
+        self.busy_timeout = busy_timeout
+        self.acquire_timeout = acquire_timeout
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+
+        self._idle = deque()
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+        # Métricas
+        self._stats = {
+            'opened': 0,
+            'closed': 0,
+            'acquired': 0,
+            'reused': 0,
+            'thread_hits': 0,
+            'overflow': 0,
+            'waits': 0,
+            'wait_total_ms': 0.0,
+            'wait_max_ms': 0.0,
+            'rollbacks_on_release': 0,
+        }
+
+    # ==================== CONEXÕES ====================
+
+    def _connect(self) -> PooledConnection:
+        """Abre uma conexão nova já com os PRAGMAs aplicados"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout / 1000,
+            check_same_thread=False,
+            factory=PooledConnection
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        conn._pool = self
+        with self._cond:
+            self._stats['opened'] += 1
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        """
+        Obtém uma conexão do pool.
+        Prefere a última conexão usada pela thread atual; se não houver conexão
+        livre, espera até acquire_timeout e depois abre uma conexão de overflow.
+        """
+        start = time.perf_counter()
+        waited = False
+        holding = getattr(self._local, 'holding', 0)
+
+        with self._cond:
+            while not self._idle and self._in_use >= self.max_size:
+                # Aninhamento na mesma thread nunca espera (evita deadlock)
+                if holding:
+                    break
+                remaining = self.acquire_timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    break
+                waited = True
+                self._cond.wait(remaining)
+
+            conn = None
+            preferred = getattr(self._local, 'last', None)
+            if preferred is not None and preferred in self._idle:
+                self._idle.remove(preferred)
+                conn = preferred
+                self._stats['thread_hits'] += 1
+            elif self._idle:
+                conn = self._idle.pop()
+
+            if conn is not None:
+                self._stats['reused'] += 1
+            elif self._in_use >= self.max_size:
+                self._stats['overflow'] += 1
+
+            self._in_use += 1
+            self._stats['acquired'] += 1
+
+            if waited:
+                wait_ms = (time.perf_counter() - start) * 1000
+                self._stats['waits'] += 1
+                self._stats['wait_total_ms'] += wait_ms
+                self._stats['wait_max_ms'] = max(self._stats['wait_max_ms'], wait_ms)
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+
+        conn._checked_out = True
+        self._local.last = conn
+        self._local.holding = holding + 1
+        return conn
+
+    def _release(self, conn: PooledConnection):
+        """Devolve a conexão ao pool (chamado por conn.close())"""
+        self._local.holding = max(0, getattr(self._local, 'holding', 1) - 1)
+
+        try:
+            if conn.in_transaction:
+                # Mesmo comportamento de fechar sem commit: descarta alterações
+                conn.rollback()
+                with self._cond:
+                    self._stats['rollbacks_on_release'] += 1
+            conn.row_factory = sqlite3.Row
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._in_use -= 1
+            if len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                conn = None
+            else:
+                self._stats['closed'] += 1
+            self._cond.notify()
+
+        if conn is not None:
+            conn._close_real()
+
+    def _discard(self, conn: PooledConnection):
+        """Fecha uma conexão com problema sem devolvê-la ao pool"""
+        with self._cond:
+            self._in_use -= 1
+            self._stats['closed'] += 1
+            self._cond.notify()
+        try:
+            conn._close_real()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        """Fecha todas as conexões ociosas"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._stats['closed'] += len(idle)
+        for conn in idle:
+            conn._close_real()
+
+    # ==================== MÉTRICAS ====================
+
+    def get_stats(self) -> Dict:
+        """Retorna métricas do pool"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._in_use
+        stats['max_size'] = self.max_size
+        stats['wait_avg_ms'] = round(stats['wait_total_ms'] / stats['waits'], 3) if stats['waits'] else 0.0
+        stats['wait_total_ms'] = round(stats['wait_total_ms'], 3)
+        stats['wait_max_ms'] = round(stats['wait_max_ms'], 3)
+        stats['reuse_ratio'] = round(stats['reused'] / stats['acquired'], 4) if stats['acquired'] else 0.0
+        return stats
+
+
+# Pools compartilhados por caminho (app.py e app_whatsapp.py usam o mesmo leads.db)
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path: str, **kwargs) -> ConnectionPool:
+    """Obtém (ou cria) o pool do banco informado"""
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = ConnectionPool(db_path, **kwargs)
+            _pools[db_path] = pool
+        return pool
@@ -0,0 +1,400 @@
+"""
+Fila durável em SQLite com processamento em lote e ordem por chave
+
+Usada pelo webhook do WhatsApp: a rota só grava os eventos na fila e
+responde 200 na hora; o processamento pesado (contato, lead, mensagem,
+mark-as-read) acontece depois, em threads de trabalho.
+
+- Arquivo SQLite próprio (não disputa o lock de escrita do leads.db)
+- Reserva atômica (BEGIN IMMEDIATE + UPDATE ... RETURNING): mais de um
+  processo pode consumir o mesmo arquivo sem pegar o mesmo item
+- Eventos sobrevivem a reinício: um item 'processando' cuja reserva passou de
+  lease_timeout (processo que caiu) volta a pendente. O pool só reserva o que
+  as threads conseguem absorver (max_in_flight) e renova a reserva quando a
+  thread pega o lote, para um item esperando na fila interna não expirar e
+  ser entregue duas vezes
+- Eventos com a mesma chave (ex.: telefone do contato) são sempre entregues
+  à mesma thread, na ordem de chegada; enquanto um item de uma chave está em
+  processamento ou esperando nova tentativa, os seguintes da chave ficam retidos
+- Falhas são por item: um lote que falha é reprocessado item a item e só o
+  item com defeito é reprocessado com espera crescente; depois de
+  max_attempts fica com status 'erro' para análise
+
+Uso:
+    fila = DurableQueue('webhook_queue.db')
+    fila.put_many([('5511999999999', {'type': 'message', ...})])
+
+    pool = PartitionedWorkerPool(fila, processar_lote, workers=4)
+    pool.start()
+"""
+
+import json
+import queue as _queue
+import sqlite3
+import threading
+import time
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple
+
+
+class DurableQueue:
+    """Fila persistente de itens JSON com chave de ordenação"""
+
+    def __init__(self, db_path: str, max_attempts: int = 5, retry_delay: float = 2.0,
+                 lease_timeout: float = 120.0):
+        """
+        Args:
+            db_path: Arquivo SQLite da fila
+            max_attempts: Tentativas antes de marcar o item como 'erro'
+            retry_delay: Segundos de espera base entre tentativas (dobra a cada falha)
+            lease_timeout: Segundos até uma reserva sem ack/fail ser considerada abandonada
+        """
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_timeout = lease_timeout
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.execute('PRAGMA synchronous = FULL')  # fila é a única cópia do evento
+        self._conn.execute('PRAGMA busy_timeout = 5000')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS fila (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chave TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pendente',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                available_at REAL NOT NULL,
+                claimed_at REAL
+            )
+        ''')
+        colunas = [row[1] for row in self._conn.execute('PRAGMA table_info(fila)').fetchall()]
+        if 'claimed_at' not in colunas:
+            self._conn.execute('ALTER TABLE fila ADD COLUMN claimed_at REAL')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_fila_status ON fila (status, available_at, id)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_fila_chave ON fila (chave, id)')
+
+        self._stats = {
+            'enqueued': 0,
+            'processed': 0,
+            'retried': 0,
+            'held': 0,
+            'expired_leases': 0,
+            'dead': 0,
+            'lag_total_ms': 0.0,
+            'lag_max_ms': 0.0,
+        }
+
+    @contextmanager
+    def _transaction(self):
+        """Transação explícita (um único fsync por operação). Chamar com self._lock adquirido."""
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    # ==================== PRODUTOR ====================
+
+    def put_many(self, items: Sequence[Tuple[str, Dict]]) -> int:
+        """Grava (chave, payload) em uma única transação. Retorna quantos foram gravados."""
+        if not items:
+            return 0
+        now = time.time()
+        rows = [(str(chave or ''), json.dumps(payload, default=str), now, now) for chave, payload in items]
+        with self._lock, self._transaction() as conn:
+            conn.executemany(
+                'INSERT INTO fila (chave, payload, created_at, available_at) VALUES (?, ?, ?, ?)', rows
+            )
+            self._stats['enqueued'] += len(rows)
+            self._available.notify_all()
+        return len(rows)
+
+    # ==================== CONSUMIDOR ====================
+
+    def claim(self, limit: int = 200, timeout: float = 1.0) -> List[Dict]:
+        """
+        Reserva até `limit` itens pendentes em ordem de chegada.
+        Itens com um anterior da mesma chave em processamento ou aguardando
+        nova tentativa não são reservados (ordem por chave).
+        Espera até `timeout` segundos se não houver nada disponível.
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            while True:
+                now = time.time()
+                with self._transaction() as conn:
+                    # Reservas abandonadas (processo que caiu no meio) voltam para a fila
+                    expiradas = conn.execute('''
+                        UPDATE fila SET status = 'pendente', claimed_at = NULL
+                        WHERE status = 'processando' AND (claimed_at IS NULL OR claimed_at < ?)
+                    ''', (now - self.lease_timeout,)).rowcount
+                    rows = conn.execute('''
+                        UPDATE fila SET status = 'processando', claimed_at = :now
+                        WHERE id IN (
+                            SELECT f.id FROM fila AS f
+                            WHERE f.status = 'pendente' AND f.available_at <= :now
+                              AND NOT EXISTS (
+                                  SELECT 1 FROM fila AS anterior
+                                  WHERE anterior.chave = f.chave AND anterior.id < f.id
+                                    AND (anterior.status = 'processando'
+                                         OR (anterior.status = 'pendente' AND anterior.available_at > :now))
+                              )
+                            ORDER BY f.id LIMIT :limit
+                        )
+                        RETURNING id, chave, payload, attempts, created_at
+                    ''', {'now': now, 'limit': limit}).fetchall()
+                self._stats['expired_leases'] += expiradas
+                if rows or now >= deadline:
+                    break
+                self._available.wait(deadline - now)
+
+        # RETURNING não garante ordem
+        rows.sort(key=lambda row: row[0])
+        return [
+            {'id': row[0], 'chave': row[1], 'payload': json.loads(row[2]),
+             'attempts': row[3], 'created_at': row[4]}
+            for row in rows
+        ]
+
+    def ack(self, items: Sequence[Dict]):
+        """Remove itens processados com sucesso"""
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            with self._transaction() as conn:
+                conn.executemany('DELETE FROM fila WHERE id = ?', [(item['id'],) for item in items])
+            for item in items:
+                lag_ms = (now - item['created_at']) * 1000
+                self._stats['lag_total_ms'] += lag_ms
+                self._stats['lag_max_ms'] = max(self._stats['lag_max_ms'], lag_ms)
+            self._stats['processed'] += len(items)
+            self._available.notify_all()  # libera itens seguintes das mesmas chaves
+
+    def fail(self, items: Sequence[Dict], error: str):
+        """Devolve itens para nova tentativa (com espera) ou marca como 'erro'"""
+        if not items:
+            return
+        now = time.time()
+        with self._lock, self._transaction() as conn:
+            for item in items:
+                attempts = item['attempts'] + 1
+                if attempts >= self.max_attempts:
+                    conn.execute(
+                        "UPDATE fila SET status = 'erro', attempts = ?, error = ? WHERE id = ?",
+                        (attempts, error[:500], item['id'])
+                    )
+                    self._stats['dead'] += 1
+                else:
+                    delay = self.retry_delay * (2 ** (attempts - 1))
+                    conn.execute(
+                        "UPDATE fila SET status = 'pendente', attempts = ?, error = ?, available_at = ? WHERE id = ?",
+                        (attempts, error[:500], now + delay, item['id'])
+                    )
+                    self._stats['retried'] += 1
+            self._available.notify_all()
+
+    def renew(self, items: Sequence[Dict]):
+        """Renova a reserva de itens ainda em processamento (recomeça o lease_timeout)"""
+        if not items:
+            return
+        now = time.time()
+        with self._lock, self._transaction() as conn:
+            conn.executemany(
+                "UPDATE fila SET claimed_at = ? WHERE id = ? AND status = 'processando'",
+                [(now, item['id']) for item in items]
+            )
+
+    def release(self, items: Sequence[Dict]):
+        """Devolve itens reservados sem contar tentativa (retidos atrás de uma falha da mesma chave)"""
+        if not items:
+            return
+        with self._lock, self._transaction() as conn:
+            conn.executemany(
+                "UPDATE fila SET status = 'pendente', claimed_at = NULL WHERE id = ?",
+                [(item['id'],) for item in items]
+            )
+            self._stats['held'] += len(items)
+            self._available.notify_all()
+
+    # ==================== MÉTRICAS ====================
+
+    def get_stats(self) -> Dict:
+        """Profundidade da fila, atraso do item mais antigo e contadores"""
+        now = time.time()
+        with self._lock:
+            counts = dict(self._conn.execute('SELECT status, COUNT(*) FROM fila GROUP BY status').fetchall())
+            oldest = self._conn.execute(
+                "SELECT MIN(created_at) FROM fila WHERE status IN ('pendente', 'processando')"
+            ).fetchone()[0]
+            stats = dict(self._stats)
+
+        processed = stats['processed']
+        stats['depth'] = counts.get('pendente', 0)
+        stats['in_flight'] = counts.get('processando', 0)
+        stats['dead_letters'] = counts.get('erro', 0)
+        stats['oldest_lag_s'] = round(now - oldest, 3) if oldest else 0.0
+        stats['lag_avg_ms'] = round(stats['lag_total_ms'] / processed, 3) if processed else 0.0
+        stats['lag_total_ms'] = round(stats['lag_total_ms'], 3)
+        stats['lag_max_ms'] = round(stats['lag_max_ms'], 3)
+        return stats
+
+
+class PartitionedWorkerPool:
+    """
+    Threads que consomem uma DurableQueue em lotes.
+    Cada chave é sempre atendida pela mesma thread, preservando a ordem por chave.
+    """
+
+    def __init__(self, fila: DurableQueue, handler: Callable[[List[Dict]], None],
+                 workers: int = 4, batch_size: int = 200, max_in_flight: int = None,
+                 name: str = 'fila'):
+        """
+        Args:
+            fila: Fila de origem
+            handler: Recebe a lista de payloads (em ordem) de um lote de uma thread
+            workers: Quantidade de threads de processamento
+            batch_size: Máximo de itens reservados por vez
+            max_in_flight: Máximo de itens reservados e ainda não concluídos
+                (padrão: 2 lotes); o restante espera na fila durável
+        """
+        self.fila = fila
+        self.handler = handler
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight or batch_size * 2
+        self.name = name
+
+        self._inboxes = [_queue.Queue() for _ in range(workers)]
+        self._in_flight = 0
+        self._capacity = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'batches': 0, 'failed_batches': 0, 'failed_items': 0, 'handler_total_ms': 0.0}
+
+    def _partition(self, chave: str) -> int:
+        return zlib.crc32(chave.encode('utf-8')) % self.workers
+
+    def start(self):
+        """Inicia o despachante e as threads de trabalho (idempotente)"""
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, args=(i,), name=f'{self.name}-worker-{i}')
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+            t = threading.Thread(target=self._dispatcher, name=f'{self.name}-dispatcher')
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _dispatcher(self):
+        while True:
+            # Só reserva o que as threads conseguem absorver: nada fica parado
+            # nas filas internas até a reserva expirar
+            with self._capacity:
+                while self._in_flight >= self.max_in_flight:
+                    self._capacity.wait()
+                limite = min(self.batch_size, self.max_in_flight - self._in_flight)
+            try:
+                items = self.fila.claim(limite)
+            except sqlite3.Error as e:
+                print(f"[FILA] Erro ao ler fila {self.name}: {e}")
+                time.sleep(1)
+                continue
+            if not items:
+                continue
+            with self._capacity:
+                self._in_flight += len(items)
+
+            por_worker = defaultdict(list)
+            for item in items:
+                por_worker[self._partition(item['chave'])].append(item)
+            for index, lote in por_worker.items():
+                self._inboxes[index].put(lote)
+
+    def _worker(self, index: int):
+        inbox = self._inboxes[index]
+        while True:
+            lote = inbox.get()
+            # Junta lotes que chegaram enquanto esta thread estava ocupada
+            while True:
+                try:
+                    lote = lote + inbox.get_nowait()
+                except _queue.Empty:
+                    break
+
+            try:
+                self._process(lote)
+            finally:
+                with self._capacity:
+                    self._in_flight -= len(lote)
+                    self._capacity.notify()
+
+    def _process(self, lote: List[Dict]):
+        # O tempo de espera na fila interna não conta para a reserva
+        self.fila.renew(lote)
+        start = time.perf_counter()
+        try:
+            self.handler([item['payload'] for item in lote])
+        except Exception as e:
+            print(f"[FILA] Erro ao processar lote de {len(lote)} em {self.name}: {e}")
+            with self._stats_lock:
+                self._stats['failed_batches'] += 1
+            self._process_individually(lote)
+            return
+
+        self.fila.ack(lote)
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['handler_total_ms'] += (time.perf_counter() - start) * 1000
+
+    def _process_individually(self, lote: List[Dict]):
+        """
+        Reprocessa um lote que falhou item a item, em ordem, para isolar o item
+        com defeito. Depois de uma falha, os itens seguintes da mesma chave não
+        são processados: voltam para a fila e esperam a nova tentativa dele.
+        """
+        bloqueadas = set()
+        retidos = []
+        for item in lote:
+            if item['chave'] in bloqueadas:
+                retidos.append(item)
+                continue
+            try:
+                self.handler([item['payload']])
+            except Exception as e:
+                print(f"[FILA] Erro ao processar item {item['id']} ({item['chave']}) em {self.name}: {e}")
+                self.fila.fail([item], str(e))
+                bloqueadas.add(item['chave'])
+                with self._stats_lock:
+                    self._stats['failed_items'] += 1
+                continue
+            self.fila.ack([item])
+        self.fila.release(retidos)
+
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['workers'] = self.workers
+        with self._capacity:
+            stats['pool_in_flight'] = self._in_flight
+        stats['max_in_flight'] = self.max_in_flight
+        stats['handler_avg_ms'] = round(stats['handler_total_ms'] / stats['batches'], 3) if stats['batches'] else 0.0
+        stats['handler_total_ms'] = round(stats['handler_total_ms'], 3)
+        stats['inbox_depth'] = [inbox.qsize() for inbox in self._inboxes]
+        stats.update(self.fila.get_stats())
+        return stats
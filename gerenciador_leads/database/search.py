@@ -0,0 +1,114 @@
+"""
+Busca full-text (FTS5) de leads e mensagens
+
+As tabelas virtuais são criadas pelas migrações e mantidas por triggers:
+    leads_fts              nome, endereco, cidade, tipo_servico
+                           (unicode61 remove_diacritics: "sao joao" acha "São João")
+    leads_telefone_fts     dígitos do telefone, tokenizer trigram
+                           (qualquer trecho de 3+ dígitos, ex.: final do número)
+    whatsapp_messages_fts  conteúdo das mensagens
+
+Enquanto as tabelas não existirem (banco antigo ou SQLite sem FTS5) as
+funções retornam None e quem chama mantém a busca com LIKE.
+
+Uso:
+    busca = lead_search(conn, 'joao campinas')
+    if busca:
+        sub, params = busca
+        sql = f'SELECT leads.* FROM ({sub}) busca CROSS JOIN leads ON leads.id = busca.id ORDER BY busca.rank'
+
+O CROSS JOIN mantém o FTS como laço externo; com JOIN comum o planejador pode
+preferir um índice de leads (status, cidade) e repetir a busca FTS por linha.
+
+O trecho de message_search() vem com marcadores de controle em volta dos
+termos encontrados; highlight_snippet() escapa o texto (conteúdo enviado
+pelo cliente) e só depois troca os marcadores por <b>...</b>.
+"""
+
+import html
+import re
+import sqlite3
+from typing import List, Optional, Tuple
+
+# Pesos do bm25 por coluna de leads_fts (nome pesa mais que endereço etc.)
+LEAD_WEIGHTS = (10.0, 2.0, 3.0, 1.0)
+
+# Consultas só com dígitos (e pontuação de telefone) a partir deste tamanho
+# vão para o índice de telefone; o trigram precisa de pelo menos 3 caracteres
+MIN_PHONE_DIGITS = 3
+
+_PHONE_QUERY = re.compile(r'^[\d\s()+.\-]+$')
+
+# Marcadores do snippet() (caracteres de controle, não aparecem em texto digitado)
+_HIGHLIGHT_START = '\x02'
+_HIGHLIGHT_END = '\x03'
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def build_match(text: str) -> Optional[str]:
+    """
+    Converte o texto digitado em expressão MATCH segura:
+    cada palavra vira um prefixo entre aspas e todas precisam aparecer.
+    """
+    tokens = _TOKEN.findall(text or '')
+    if not tokens:
+        return None
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def phone_digits(text: str) -> Optional[str]:
+    """Dígitos da busca se ela parecer um telefone (ou trecho dele)"""
+    if not text or not _PHONE_QUERY.match(text):
+        return None
+    digits = re.sub(r'\D', '', text)
+    return digits if len(digits) >= MIN_PHONE_DIGITS else None
+
+
+def _has_table(conn: sqlite3.Connection, name: str) -> bool:
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone()
+    return row is not None
+
+
+def lead_search(conn: sqlite3.Connection, text: str) -> Optional[Tuple[str, List]]:
+    """
+    Subconsulta (id, rank) com os leads que casam com a busca, menor rank = mais relevante.
+    Retorna None se o índice FTS não existir (use LIKE como antes).
+    """
+    digits = phone_digits(text)
+    if digits:
+        if not _has_table(conn, 'leads_telefone_fts'):
+            return None
+        # Trigram: o número inteiro entre aspas casa como substring
+        return ('SELECT rowid AS id, bm25(leads_telefone_fts) AS rank '
+                'FROM leads_telefone_fts WHERE leads_telefone_fts MATCH ?', [f'"{digits}"'])
+
+    match = build_match(text)
+    if not match or not _has_table(conn, 'leads_fts'):
+        return None
+    weights = ', '.join(str(w) for w in LEAD_WEIGHTS)
+    return (f'SELECT rowid AS id, bm25(leads_fts, {weights}) AS rank '
+            f'FROM leads_fts WHERE leads_fts MATCH ?', [match])
+
+
+def message_search(conn: sqlite3.Connection, text: str) -> Optional[Tuple[str, List]]:
+    """
+    Subconsulta (id, rank, trecho) das mensagens que casam com a busca.
+    Retorna None se o índice FTS não existir.
+    """
+    match = build_match(text)
+    if not match or not _has_table(conn, 'whatsapp_messages_fts'):
+        return None
+    return ("SELECT rowid AS id, bm25(whatsapp_messages_fts) AS rank, "
+            "snippet(whatsapp_messages_fts, 0, char(2), char(3), '…', 12) AS trecho "
+            "FROM whatsapp_messages_fts WHERE whatsapp_messages_fts MATCH ?", [match])
+
+
+def highlight_snippet(trecho: Optional[str]) -> Optional[str]:
+    """Trecho do snippet() como HTML seguro: texto escapado e termos em <b>"""
+    if trecho is None:
+        return None
+    return (html.escape(trecho)
+            .replace(_HIGHLIGHT_START, '<b>')
+            .replace(_HIGHLIGHT_END, '</b>'))
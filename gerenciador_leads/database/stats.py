@@ -0,0 +1,254 @@
+"""
+Contadores do dashboard mantidos incrementalmente
+
+A tabela stats_contadores (criada pelas migrações) guarda um valor por
+(escopo, chave) e é atualizada por triggers em cada INSERT/UPDATE/DELETE:
+
+    leads           ''            total de leads
+    leads_status    <status>      leads por status
+    leads_cidade    <cidade>      leads por cidade
+    mensagens       ''            total de whatsapp_messages
+    mensagens_status <status>     mensagens por status
+    mensagens_dia   <AAAA-MM-DD>  mensagens por DATE(sent_at)
+
+Valores NULL são gravados com chave '' (cidade vazia e sem cidade contam juntas).
+
+Com isso /api/stats e /api/whatsapp/stats leem poucas linhas, qualquer que
+seja o tamanho das tabelas. rebuild_counters() recalcula tudo do zero e
+informa a diferença (drift) em relação ao que os triggers mantinham.
+
+Reconciliação manual:
+    python -m database.stats [caminho/leads.db]
+"""
+
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+STATS_TABLE = 'stats_contadores'
+
+# Consultas que recalculam cada escopo do zero: (escopo, sql, tabela.coluna necessárias)
+REBUILD_QUERIES = (
+    ('leads', "SELECT '', COUNT(*) FROM leads", ('leads',)),
+    ('leads_status', "SELECT COALESCE(status, ''), COUNT(*) FROM leads GROUP BY 1", ('leads.status',)),
+    ('leads_cidade', "SELECT COALESCE(cidade, ''), COUNT(*) FROM leads GROUP BY 1", ('leads.cidade',)),
+    ('mensagens', "SELECT '', COUNT(*) FROM whatsapp_messages", ('whatsapp_messages.status',)),
+    ('mensagens_status', "SELECT COALESCE(status, ''), COUNT(*) FROM whatsapp_messages GROUP BY 1",
+     ('whatsapp_messages.status',)),
+    ('mensagens_dia', "SELECT COALESCE(DATE(sent_at), ''), COUNT(*) FROM whatsapp_messages GROUP BY 1",
+     ('whatsapp_messages.sent_at',)),
+)
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})').fetchall()]
+
+
+def _available(conn: sqlite3.Connection, requires) -> bool:
+    for req in requires:
+        table, _, column = req.partition('.')
+        columns = _columns(conn, table)
+        if not columns or (column and column not in columns):
+            return False
+    return True
+
+
+def counters_ready(conn: sqlite3.Connection, escopo: str) -> bool:
+    """True se o escopo já é mantido por triggers (migração aplicada)"""
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+        (f'trg_stats_{escopo.split("_")[0]}_ins',)
+    ).fetchone()
+    return row is not None
+
+
+def _read_scope(conn: sqlite3.Connection, escopo: str) -> Dict[str, int]:
+    return {
+        row[0]: row[1] for row in conn.execute(
+            f'SELECT chave, valor FROM {STATS_TABLE} WHERE escopo = ? AND valor != 0', (escopo,)
+        ).fetchall()
+    }
+
+
+# ==================== LEITURA ====================
+
+def lead_stats(conn: sqlite3.Connection, top_cidades: int = 10) -> Dict:
+    """Totais de leads por status e cidade (contadores, ou agregação se ainda não existirem)"""
+    if counters_ready(conn, 'leads'):
+        total = _read_scope(conn, 'leads').get('', 0)
+        por_status = _read_scope(conn, 'leads_status')
+        rows = conn.execute(f'''
+            SELECT chave, valor FROM {STATS_TABLE}
+            WHERE escopo = 'leads_cidade' AND valor > 0
+            ORDER BY valor DESC LIMIT ?
+        ''', (top_cidades,)).fetchall()
+        total_cidades = conn.execute(f'''
+            SELECT COUNT(*) FROM {STATS_TABLE}
+            WHERE escopo = 'leads_cidade' AND valor > 0 AND chave != ''
+        ''').fetchone()[0]
+    else:
+        total = conn.execute('SELECT COUNT(*) FROM leads').fetchone()[0]
+        por_status = {
+            row[0] or '': row[1]
+            for row in conn.execute('SELECT status, COUNT(*) FROM leads GROUP BY status').fetchall()
+        }
+        rows = conn.execute(
+            'SELECT cidade, COUNT(*) as count FROM leads GROUP BY cidade ORDER BY count DESC LIMIT ?',
+            (top_cidades,)
+        ).fetchall()
+        total_cidades = conn.execute('SELECT COUNT(DISTINCT cidade) FROM leads').fetchone()[0]
+
+    return {
+        'total': total,
+        'por_status': por_status,
+        'por_cidade': [{'cidade': row[0] or None, 'count': row[1]} for row in rows],
+        'total_cidades': total_cidades,
+    }
+
+
+def message_stats(conn: sqlite3.Connection, dia: Optional[str] = None) -> Dict:
+    """Totais de whatsapp_messages por status e do dia informado (padrão: hoje, UTC como DATE('now'))"""
+    if dia is None:
+        dia = conn.execute("SELECT DATE('now')").fetchone()[0]
+
+    if counters_ready(conn, 'mensagens'):
+        total = _read_scope(conn, 'mensagens').get('', 0)
+        por_status = _read_scope(conn, 'mensagens_status')
+        row = conn.execute(
+            f"SELECT valor FROM {STATS_TABLE} WHERE escopo = 'mensagens_dia' AND chave = ?", (dia,)
+        ).fetchone()
+        hoje = row[0] if row else 0
+    else:
+        total = conn.execute('SELECT COUNT(*) FROM whatsapp_messages').fetchone()[0]
+        por_status = {
+            row[0] or '': row[1]
+            for row in conn.execute('SELECT status, COUNT(*) FROM whatsapp_messages GROUP BY status').fetchall()
+        }
+        hoje = conn.execute(
+            'SELECT COUNT(*) FROM whatsapp_messages WHERE DATE(sent_at) = ?', (dia,)
+        ).fetchone()[0]
+
+    return {'total': total, 'por_status': por_status, 'hoje': hoje}
+
+
+# ==================== RECONCILIAÇÃO ====================
+
+def rebuild_counters(conn: sqlite3.Connection) -> Dict:
+    """
+    Recalcula todos os contadores do zero e grava o resultado.
+    Deve rodar dentro de uma transação de escrita (ex.: pela fila de escrita),
+    para que nenhum trigger altere as tabelas no meio da contagem.
+
+    Retorna {'drift': [...], 'escopos': n, 'duration_ms': x}; cada item de drift
+    tem escopo, chave, esperado (recontado) e atual (mantido pelos triggers).
+    """
+    start = time.perf_counter()
+    drift = []
+    escopos = 0
+
+    for escopo, sql, requires in REBUILD_QUERIES:
+        if not _available(conn, requires) or not counters_ready(conn, escopo):
+            continue
+        escopos += 1
+        esperado = {row[0]: row[1] for row in conn.execute(sql).fetchall()}
+        atual = _read_scope(conn, escopo)
+
+        for chave in set(esperado) | set(atual):
+            if esperado.get(chave, 0) != atual.get(chave, 0):
+                drift.append({
+                    'escopo': escopo,
+                    'chave': chave,
+                    'esperado': esperado.get(chave, 0),
+                    'atual': atual.get(chave, 0),
+                })
+
+        conn.execute(f'DELETE FROM {STATS_TABLE} WHERE escopo = ?', (escopo,))
+        conn.executemany(
+            f'INSERT INTO {STATS_TABLE} (escopo, chave, valor) VALUES (?, ?, ?)',
+            [(escopo, chave, valor) for chave, valor in esperado.items()]
+        )
+
+    return {
+        'drift': drift,
+        'escopos': escopos,
+        'duration_ms': round((time.perf_counter() - start) * 1000, 2),
+        'checked_at': datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+class StatsReconciler:
+    """Roda rebuild_counters() periodicamente pela fila de escrita e guarda o último relatório"""
+
+    def __init__(self, writer, interval: float = 3600):
+        self.writer = writer
+        self.interval = interval
+        self.last_report: Optional[Dict] = None
+        self.runs = 0
+        self.drift_total = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def run_now(self) -> Dict:
+        report = self.writer.run(rebuild_counters)
+        with self._lock:
+            self.last_report = report
+            self.runs += 1
+            self.drift_total += len(report['drift'])
+        if report['drift']:
+            print(f"[STATS] Reconciliação corrigiu {len(report['drift'])} contador(es)")
+        return report
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_now()
+            except Exception as e:
+                print(f"[STATS] Erro na reconciliação: {e}")
+
+    def start(self):
+        """Inicia a reconciliação periódica (idempotente)"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name='stats-reconciler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'runs': self.runs,
+                'drift_total': self.drift_total,
+                'interval_s': self.interval,
+                'last_report': self.last_report,
+            }
+
+
+def main(argv: List[str] = None) -> int:
+    import os
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    db_path = argv[0] if argv else os.path.join(os.path.dirname(os.path.dirname(__file__)), 'leads.db')
+
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        report = rebuild_counters(conn)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+    print(f"{report['escopos']} escopo(s) verificados em {report['duration_ms']} ms")
+    for item in report['drift']:
+        print(f"  {item['escopo']}[{item['chave']!r}]: esperado {item['esperado']}, atual {item['atual']}")
+    if not report['drift']:
+        print('Nenhuma divergência encontrada')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""
+Fila de escrita única (single-writer) para o SQLite
+
+O SQLite aceita apenas um escritor por vez. Em vez de várias threads
+(webhook, envio em massa, rotas) disputarem o lock e receberem
+"database is locked", as escritas pesadas são enfileiradas e executadas
+por uma única thread com conexão própria.
+
+Jobs enfileirados juntos são agrupados na mesma transação (group commit),
+cada um isolado por SAVEPOINT: se um job falhar, só ele é desfeito.
+
+Uso:
+    writer = WriteQueue(DB_PATH)
+
+    def salvar(conn, lead_id, status):
+        conn.execute('UPDATE leads SET status = ? WHERE id = ?', (status, lead_id))
+
+    writer.run(salvar, 10, 'em_contato')       # espera terminar
+    future = writer.submit(salvar, 11, 'novo')  # não espera
+
+A função recebe a conexão como primeiro argumento e NÃO deve chamar commit().
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict
+
+from .pool import DEFAULT_PRAGMAS
+
+
+class WriteQueue:
+    """Executa escritas em uma thread dedicada, com commit em lote"""
+
+    def __init__(self, db_path: str, max_batch: int = 64,
+                 busy_timeout: int = 5000, pragmas: Dict = None):
+        """
+        Args:
+            db_path: Caminho do arquivo SQLite
+            max_batch: Máximo de jobs por transação
+            busy_timeout: Milissegundos de espera por lock
+            pragmas: PRAGMAs adicionais/sobrescritos
+        """
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self.busy_timeout = busy_timeout
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+        # Métricas
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'batches': 0,
+            'wait_total_ms': 0.0,
+            'wait_max_ms': 0.0,
+            'exec_total_ms': 0.0,
+            'exec_max_ms': 0.0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout / 1000,
+            isolation_level=None,  # Transações controladas manualmente
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._worker, name='sqlite-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    # ==================== API ====================
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Enfileira uma escrita e retorna um Future com o resultado de fn"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((fn, args, kwargs, future, time.perf_counter()))
+        with self._stats_lock:
+            self._stats['submitted'] += 1
+        return future
+
+    def run(self, fn: Callable, *args, timeout: float = None, **kwargs):
+        """Enfileira uma escrita e espera o commit. Exceções de fn são repassadas."""
+        if threading.current_thread() is self._thread:
+            # Chamada de dentro de outro job: executa direto na transação atual
+            return fn(self._conn, *args, **kwargs)
+        return self.submit(fn, *args, **kwargs).result(timeout)
+
+    def depth(self) -> int:
+        """Quantidade de escritas aguardando na fila"""
+        return self._queue.qsize()
+
+    # ==================== WORKER ====================
+
+    def _worker(self):
+        self._conn = self._connect()
+
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        conn = self._conn
+        done = []
+
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error as e:
+            for _, _, _, future, _ in batch:
+                future.set_exception(e)
+            self._record(len(batch), failed=len(batch))
+            return
+
+        for fn, args, kwargs, future, enqueued in batch:
+            started = time.perf_counter()
+            try:
+                conn.execute('SAVEPOINT job')
+                result = fn(conn, *args, **kwargs)
+                conn.execute('RELEASE SAVEPOINT job')
+                done.append((future, result, None))
+            except BaseException as e:
+                try:
+                    conn.execute('ROLLBACK TO SAVEPOINT job')
+                    conn.execute('RELEASE SAVEPOINT job')
+                except sqlite3.Error:
+                    pass
+                done.append((future, None, e))
+            finished = time.perf_counter()
+            self._record_timing((started - enqueued) * 1000, (finished - started) * 1000)
+
+        try:
+            conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            try:
+                conn.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            done = [(future, None, e) for future, _, _ in done]
+
+        failed = 0
+        for future, result, error in done:
+            if error is not None:
+                failed += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        self._record(len(batch), failed=failed)
+
+    def _record_timing(self, wait_ms: float, exec_ms: float):
+        with self._stats_lock:
+            self._stats['wait_total_ms'] += wait_ms
+            self._stats['wait_max_ms'] = max(self._stats['wait_max_ms'], wait_ms)
+            self._stats['exec_total_ms'] += exec_ms
+            self._stats['exec_max_ms'] = max(self._stats['exec_max_ms'], exec_ms)
+
+    def _record(self, size: int, failed: int = 0):
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['completed'] += size - failed
+            self._stats['failed'] += failed
+
+    # ==================== MÉTRICAS ====================
+
+    def get_stats(self) -> Dict:
+        """Retorna métricas da fila de escrita"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        processed = stats['completed'] + stats['failed']
+        stats['depth'] = self.depth()
+        stats['wait_avg_ms'] = round(stats['wait_total_ms'] / processed, 3) if processed else 0.0
+        stats['exec_avg_ms'] = round(stats['exec_total_ms'] / processed, 3) if processed else 0.0
+        stats['avg_batch'] = round(processed / stats['batches'], 2) if stats['batches'] else 0.0
+        for key in ('wait_total_ms', 'wait_max_ms', 'exec_total_ms', 'exec_max_ms'):
+            stats[key] = round(stats[key], 3)
+        return stats
+
+
+_writers: Dict[str, WriteQueue] = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(db_path: str, **kwargs) -> WriteQueue:
+    """Obtém (ou cria) a fila de escrita do banco informado"""
+    with _writers_lock:
+        writer = _writers.get(db_path)
+        if writer is None:
+            writer = WriteQueue(db_path, **kwargs)
+            _writers[db_path] = writer
+        return writer
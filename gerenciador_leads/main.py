@@ -27,7 +27,7 @@ os.chdir(BASE_DIR)
 sys.path.insert(0, BASE_DIR)
 
 # Importar app Flask
-from app import app, init_db
+from app import app, init_db, iniciar_servicos
 
 # Configurações
 PORT = 5000
@@ -36,8 +36,9 @@ DEBUG = False
 
 def start_server():
     """Inicia o servidor Flask em uma thread separada"""
-    # Inicializar banco de dados
+    # Inicializar banco de dados e serviços em segundo plano (retomada de campanhas)
     init_db()
+    iniciar_servicos()
     
     # Desativar logs do Flask em produção
     import logging
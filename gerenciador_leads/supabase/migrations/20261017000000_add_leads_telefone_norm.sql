@@ -0,0 +1,77 @@
+-- ============================================================
+-- Telefone normalizado (E.164) em leads
+-- Mesma regra de database/phones.py (normalize_phone): busca de lead
+-- por telefone vira igualdade no índice único em vez de LIKE/REPLACE
+-- ============================================================
+
+CREATE OR REPLACE FUNCTION normalizar_telefone(valor TEXT)
+RETURNS TEXT
+LANGUAGE plpgsql
+IMMUTABLE
+AS $$
+DECLARE
+  texto TEXT := btrim(COALESCE(valor, ''), ' ');
+  d TEXT := translate(texto, '()- +.', '');
+  n TEXT;
+BEGIN
+  IF d = '' OR d ~ '[^0-9]' THEN
+    RETURN NULL;
+  END IF;
+
+  -- Internacional (DDI diferente de 55): mantém como veio
+  IF left(texto, 1) = '+' AND left(d, 2) <> '55' THEN
+    IF length(d) BETWEEN 8 AND 15 AND left(d, 1) <> '0' THEN
+      RETURN '+' || d;
+    END IF;
+    RETURN NULL;
+  END IF;
+
+  n := ltrim(d, '0');
+  IF length(n) IN (12, 13) AND left(n, 2) = '55' THEN
+    n := substr(n, 3);
+  END IF;
+  -- Celular sem o nono dígito
+  IF length(n) = 10 AND substr(n, 3, 1) IN ('6', '7', '8', '9') THEN
+    n := substr(n, 1, 2) || '9' || substr(n, 3);
+  END IF;
+  IF length(n) = 10 OR (length(n) = 11 AND substr(n, 3, 1) = '9') THEN
+    RETURN '+55' || n;
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+ALTER TABLE leads ADD COLUMN IF NOT EXISTS telefone_norm TEXT;
+
+-- Preenche; se dois leads têm o mesmo número, só o mais antigo recebe o valor
+UPDATE leads l
+SET telefone_norm = x.norm
+FROM (
+  SELECT id, normalizar_telefone(telefone) AS norm,
+         row_number() OVER (PARTITION BY normalizar_telefone(telefone) ORDER BY id) AS ordem
+  FROM leads
+) x
+WHERE l.id = x.id AND x.norm IS NOT NULL AND x.ordem = 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_leads_telefone_norm ON leads(telefone_norm);
+
+-- Mantém telefone_norm em qualquer INSERT/UPDATE (app, backend, edge functions)
+CREATE OR REPLACE FUNCTION leads_telefone_norm_trigger()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  NEW.telefone_norm := normalizar_telefone(NEW.telefone);
+  IF NEW.telefone_norm IS NOT NULL AND EXISTS (
+    SELECT 1 FROM leads WHERE telefone_norm = NEW.telefone_norm AND id IS DISTINCT FROM NEW.id
+  ) THEN
+    NEW.telefone_norm := NULL;
+  END IF;
+  RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_leads_telefone_norm ON leads;
+CREATE TRIGGER trg_leads_telefone_norm
+  BEFORE INSERT OR UPDATE OF telefone ON leads
+  FOR EACH ROW EXECUTE FUNCTION leads_telefone_norm_trigger();
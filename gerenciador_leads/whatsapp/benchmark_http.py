@@ -0,0 +1,130 @@
+"""
+Benchmark do transporte HTTP dos clientes WhatsApp contra um servidor local
+
+Sobe um servidor HTTP/1.1 (keep-alive) que imita as rotas de envio da
+Cloud API e da Z-API e mede envios por segundo:
+    antes   - funções requests.post/get do módulo (conexão nova a cada envio)
+    depois  - sessão compartilhada de whatsapp.transport (pool keep-alive)
+
+Em localhost não há TLS; --handshake-ms simula o custo de abrir uma
+conexão nova (handshake TCP+TLS até a Graph API, tipicamente dezenas de ms).
+
+Uso (na pasta gerenciador_leads):
+    python -m whatsapp.benchmark_http [--envios 500] [--threads 8] [--latencia-ms 0] [--handshake-ms 0]
+"""
+
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from .meta_client import WhatsAppCloudAPI
+from .transport import build_session
+from .zapi_client import ZAPIClient
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # cabeçalho e corpo saem em escritas separadas
+    latencia = 0.0
+    handshake = 0.0
+
+    def setup(self):
+        super().setup()
+        if self.handshake:
+            time.sleep(self.handshake)  # custo de conexão nova
+
+    def do_POST(self):
+        tamanho = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(tamanho)
+        if self.latencia:
+            time.sleep(self.latencia)
+        if self.path.endswith('/messages'):
+            corpo = {'messaging_product': 'whatsapp', 'messages': [{'id': 'wamid.mock'}]}
+        else:
+            corpo = {'zapiMessageId': 'mock', 'messageId': 'mock'}
+        dados = json.dumps(corpo).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_mock_server(latencia: float = 0.0, handshake: float = 0.0):
+    """Servidor local em porta livre; retorna (server, base_url)"""
+    handler = type('MockHandler', (_MockHandler,), {'latencia': latencia, 'handshake': handshake})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def _cloud_client(base_url: str, session) -> WhatsAppCloudAPI:
+    cls = type('MockCloudAPI', (WhatsAppCloudAPI,), {'BASE_URL': base_url})
+    return cls('123', 'token', session=session)
+
+
+def _zapi_client(base_url: str, session) -> ZAPIClient:
+    client = ZAPIClient('inst', 'token', session=session)
+    client.base_url = f'{base_url}/instances/inst/token/token'
+    return client
+
+
+def _medir(enviar, envios: int, threads: int) -> dict:
+    falhas = 0
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for ok in pool.map(lambda i: enviar(f'1199999{i:04d}'), range(envios)):
+            falhas += 0 if ok else 1
+    duracao = time.perf_counter() - inicio
+    return {'envios_s': round(envios / duracao, 1), 'duracao_s': round(duracao, 3), 'falhas': falhas}
+
+
+def run(envios: int = 500, threads: int = 8, latencia_ms: float = 0.0, handshake_ms: float = 0.0) -> dict:
+    server, base_url = start_mock_server(latencia_ms / 1000, handshake_ms / 1000)
+    # "antes": o módulo requests abre uma Session (e uma conexão) por chamada
+    transportes = {'antes': requests, 'depois': build_session(pool_size=max(threads, 1))}
+    resultados = {}
+    try:
+        for nome, session in transportes.items():
+            cloud = _cloud_client(base_url, session)
+            zapi = _zapi_client(base_url, session)
+            resultados[nome] = {
+                'cloud_api': _medir(lambda tel: cloud.send_text(tel, 'teste').success, envios, threads),
+                'zapi': _medir(lambda tel: zapi.enviar_texto(tel, 'teste').success, envios, threads),
+            }
+    finally:
+        server.shutdown()
+    return resultados
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Envios por segundo com e sem sessão HTTP compartilhada')
+    parser.add_argument('--envios', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latencia-ms', type=float, default=0.0, help='Atraso simulado do servidor')
+    parser.add_argument('--handshake-ms', type=float, default=0.0, help='Custo simulado de conexão nova')
+    args = parser.parse_args(argv)
+
+    resultados = run(args.envios, args.threads, args.latencia_ms, args.handshake_ms)
+    print(f'{args.envios} envios, {args.threads} threads, latência simulada {args.latencia_ms} ms, '
+          f'handshake {args.handshake_ms} ms')
+    for cliente in ('cloud_api', 'zapi'):
+        antes = resultados['antes'][cliente]
+        depois = resultados['depois'][cliente]
+        ganho = depois['envios_s'] / antes['envios_s'] if antes['envios_s'] else 0
+        print(f"  {cliente:10s} antes {antes['envios_s']:8.1f}/s   depois {depois['envios_s']:8.1f}/s"
+              f"   ({ganho:.1f}x, falhas {antes['falhas']}/{depois['falhas']})")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
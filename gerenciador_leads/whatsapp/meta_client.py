@@ -7,6 +7,10 @@ Limites importantes:
 - Rate limit por usuário: 1 mensagem a cada 6 segundos para o mesmo destinatário
 - Pico permitido: até 45 mensagens em 6 segundos (usa cota futura)
 - Erro 131056: rate limit excedido
+
+Com um SendScheduler (whatsapp.scheduler), cada envio espera sua vez nos
+baldes de tokens e os erros de limite ajustam a taxa em vez de bloquear o
+envio com esperas fixas.
 """
 
 import requests
@@ -14,16 +18,24 @@ import json
 import time
 import re
 import os
-from typing import Optional, Dict, List, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, Dict, List, Tuple
 from dataclasses import dataclass, field
 from enum import Enum
 from datetime import datetime
 
+from .scheduler import SendScheduler
+from .transport import get_session
+
 
 # Códigos de erro comuns da API
 class ErrorCodes:
     """Códigos de erro da API WhatsApp"""
-    RATE_LIMIT = 131056          # Rate limit excedido
+    RATE_LIMIT = 131056          # Rate limit excedido (mesmo destinatário)
+    THROUGHPUT_LIMIT = 130429    # Limite de mensagens por segundo do número
+    SPAM_RATE_LIMIT = 131048     # Limite de envio por qualidade/spam
+    ACCOUNT_RATE_LIMIT = 80007   # Limite de chamadas da conta WhatsApp Business
     INVALID_PHONE = 131026       # Número de telefone inválido
     NOT_WHATSAPP_USER = 131005   # Usuário não está no WhatsApp
     MESSAGE_BLOCKED = 131047     # Mensagem bloqueada pelo usuário
@@ -85,7 +97,8 @@ class WhatsAppCloudAPI:
     
     BASE_URL = "https://graph.facebook.com/v18.0"
     
-    def __init__(self, phone_number_id: str, access_token: str, business_account_id: str = None):
+    def __init__(self, phone_number_id: str, access_token: str, business_account_id: str = None,
+                 session: requests.Session = None, scheduler: SendScheduler = None):
         """
         Inicializa o cliente da API.
         
@@ -93,10 +106,16 @@ class WhatsAppCloudAPI:
             phone_number_id: ID do número de telefone do WhatsApp Business
             access_token: Token de acesso da API (permanente)
             business_account_id: ID da conta WhatsApp Business (opcional)
+            session: Sessão HTTP (padrão: sessão compartilhada de whatsapp.transport)
+            scheduler: Agendador de envios (limites de taxa); None envia sem controle
         """
         self.phone_number_id = phone_number_id
         self.access_token = access_token
         self.business_account_id = business_account_id
+        self.session = session or get_session()
+        self.scheduler = scheduler
+        # Envios agendados: 429 não é repetido no adapter, para chegar ao agendador
+        self.send_session = session or (get_session('whatsapp_agendado') if scheduler else self.session)
         
         self.headers = {
             "Authorization": f"Bearer {access_token}",
@@ -134,31 +153,55 @@ class WhatsAppCloudAPI:
         
         Conforme documentação:
         - Se falhar por rate limit (131056), retry após 4^X segundos
+        
+        Com scheduler, envios de mensagem (POST com "to") esperam a vez no
+        agendador, o resultado ajusta as taxas dele e o retry após limite de
+        taxa espera o tempo que ele indicar.
+        
+        Falhas de conexão e 503 já são repetidos pelo adapter da sessão
+        (whatsapp.transport), e 429 também quando não há agendador; aqui só o
+        rate limit por código de erro da API. Com agendador, um HTTP 429 sem
+        código de limite conta como limite de vazão do número.
         """
         last_error = None
+        destinatario = data.get('to') if (self.scheduler and method == "POST" and data) else None
         
         for attempt in range(max_retries):
             try:
+                if destinatario and not self.scheduler.acquire(destinatario):
+                    return False, {"error": "Envio cancelado antes de sair", "error_code": SendScheduler.CANCELLED}
+                
                 if method == "GET":
-                    response = requests.get(url, headers=self.headers, timeout=30)
+                    response = self.session.get(url, headers=self.headers, timeout=30)
                 elif method == "POST":
-                    response = requests.post(url, headers=self.headers, json=data, timeout=30)
+                    sessao = self.send_session if destinatario else self.session
+                    response = sessao.post(url, headers=self.headers, json=data, timeout=30)
                 elif method == "DELETE":
-                    response = requests.delete(url, headers=self.headers, timeout=30)
+                    response = self.session.delete(url, headers=self.headers, timeout=30)
                 else:
                     return False, {"error": f"Método {method} não suportado"}
                 
                 result = response.json() if response.text else {}
                 
                 if response.status_code in [200, 201]:
+                    if destinatario:
+                        self.scheduler.report(destinatario, True)
                     return True, result
                 else:
                     error_data = result.get('error', {})
                     error_code = error_data.get('code', 0)
                     error_msg = error_data.get('message', response.text[:200])
                     
+                    if destinatario and response.status_code == 429 and not SendScheduler.is_rate_limited(error_code):
+                        error_code = ErrorCodes.THROUGHPUT_LIMIT
+                    
+                    if destinatario:
+                        self.scheduler.report(destinatario, False, error_code)
+                        if SendScheduler.is_rate_limited(error_code) and attempt < max_retries - 1:
+                            print(f"[API] Limite de taxa ({error_code}) para {destinatario}; reagendando")
+                            continue
                     # Rate limit - aplicar backoff exponencial
-                    if error_code == ErrorCodes.RATE_LIMIT:
+                    elif error_code == ErrorCodes.RATE_LIMIT:
                         wait_time = 4 ** attempt  # 1, 4, 16 segundos
                         print(f"[API] Rate limit atingido. Aguardando {wait_time}s...")
                         time.sleep(wait_time)
@@ -172,10 +215,10 @@ class WhatsAppCloudAPI:
                     
             except requests.exceptions.Timeout:
                 last_error = {"error": "Timeout na requisição", "error_code": -1}
-                time.sleep(2 ** attempt)
+                break
             except requests.exceptions.RequestException as e:
                 last_error = {"error": str(e), "error_code": -2}
-                time.sleep(2 ** attempt)
+                break
             except Exception as e:
                 last_error = {"error": str(e), "error_code": -3}
                 break
@@ -552,7 +595,7 @@ class WhatsAppCloudAPI:
                 }
                 
                 headers = {"Authorization": f"Bearer {self.access_token}"}
-                response = requests.post(self.media_url, headers=headers, files=files, timeout=60)
+                response = self.session.post(self.media_url, headers=headers, files=files, timeout=60)
                 
                 if response.status_code == 200:
                     return response.json().get('id')
@@ -574,7 +617,7 @@ class WhatsAppCloudAPI:
     def download_media(self, media_url: str, save_path: str) -> bool:
         """Baixa uma mídia da API."""
         try:
-            response = requests.get(
+            response = self.session.get(
                 media_url,
                 headers={"Authorization": f"Bearer {self.access_token}"},
                 timeout=60
@@ -802,3 +845,143 @@ class WhatsAppCloudAPI:
         if mode == "subscribe" and token == verify_token:
             return challenge
         return None
+
+
+class ReadReceiptDispatcher:
+    """
+    Envia confirmações de leitura (mark as read) em segundo plano.
+    
+    Marcar uma mensagem como lida marca também as anteriores da mesma conversa,
+    então só a confirmação mais recente de cada conversa é enviada; as que
+    chegam enquanto ela ainda está pendente substituem a anterior.
+    
+    Uso:
+        receipts = ReadReceiptDispatcher(get_whatsapp_client, max_workers=4)
+        receipts.submit(msg_id, conversation=telefone)
+    """
+    
+    def __init__(self, get_client: Callable[[], Any], max_workers: int = 4,
+                 flush_interval: float = 0.2):
+        """
+        Args:
+            get_client: Retorna o cliente (com mark_as_read) a usar, ou None se não configurado
+            max_workers: Máximo de confirmações enviadas ao mesmo tempo
+            flush_interval: Segundos acumulando confirmações antes de cada envio
+        """
+        self.get_client = get_client
+        self.max_workers = max_workers
+        self.flush_interval = flush_interval
+        
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._idle = threading.Condition(self._lock)
+        self._pending: Dict[str, str] = {}
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='read-receipt')
+        self._thread = None
+        self._stats = {
+            'submitted': 0,
+            'collapsed': 0,
+            'sent': 0,
+            'failed': 0,
+            'skipped': 0,
+            'in_flight': 0,
+            'latency_total_ms': 0.0,
+            'latency_max_ms': 0.0,
+        }
+    
+    def start(self):
+        """Inicia a thread de envio (idempotente)"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name='read-receipt-dispatcher')
+            self._thread.daemon = True
+            self._thread.start()
+    
+    def submit(self, message_id: str, conversation: str = None):
+        """Agenda a confirmação de leitura; substitui a pendente da mesma conversa"""
+        if not message_id:
+            return
+        key = conversation or message_id
+        with self._lock:
+            self._stats['submitted'] += 1
+            if key in self._pending:
+                self._stats['collapsed'] += 1
+            self._pending[key] = message_id
+        self.start()
+        self._wakeup.set()
+    
+    def _loop(self):
+        while True:
+            self._wakeup.wait()
+            # Janela curta para juntar várias mensagens da mesma conversa
+            time.sleep(self.flush_interval)
+            with self._lock:
+                self._wakeup.clear()
+                lote = list(self._pending.values())
+                self._pending.clear()
+                self._stats['in_flight'] += len(lote)
+            if lote:
+                self._dispatch(lote)
+    
+    def _dispatch(self, message_ids: List[str]):
+        try:
+            client = self.get_client()
+        except Exception as e:
+            print(f"[READ] Erro ao obter cliente: {e}")
+            client = None
+        
+        if client is None:
+            with self._lock:
+                self._stats['in_flight'] -= len(message_ids)
+                self._stats['skipped'] += len(message_ids)
+                self._idle.notify_all()
+            return
+        
+        for message_id in message_ids:
+            # Bloqueia quando todos os envios estão ocupados; enquanto isso,
+            # novas confirmações continuam se acumulando (e colapsando) em _pending
+            self._slots.acquire()
+            self._executor.submit(self._send, client, message_id)
+    
+    def _send(self, client, message_id: str):
+        start = time.perf_counter()
+        try:
+            result = client.mark_as_read(message_id)
+            ok = result.get('success', False) if isinstance(result, dict) else bool(result)
+        except Exception as e:
+            print(f"[READ] Erro ao marcar {message_id} como lida: {e}")
+            ok = False
+        finally:
+            self._slots.release()
+        
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._stats['in_flight'] -= 1
+            self._stats['sent' if ok else 'failed'] += 1
+            self._stats['latency_total_ms'] += elapsed_ms
+            self._stats['latency_max_ms'] = max(self._stats['latency_max_ms'], elapsed_ms)
+            self._idle.notify_all()
+    
+    def wait_idle(self, timeout: float = None) -> bool:
+        """Espera até não haver confirmações pendentes nem em envio"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._pending or self._stats['in_flight'] or self._wakeup.is_set():
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining if remaining is not None else 1.0)
+        return True
+    
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        done = stats['sent'] + stats['failed']
+        stats['max_workers'] = self.max_workers
+        stats['latency_avg_ms'] = round(stats['latency_total_ms'] / done, 3) if done else 0.0
+        stats['latency_total_ms'] = round(stats['latency_total_ms'], 3)
+        stats['latency_max_ms'] = round(stats['latency_max_ms'], 3)
+        return stats
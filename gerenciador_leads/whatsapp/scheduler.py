@@ -0,0 +1,282 @@
+"""
+Agendador central de envios WhatsApp (token buckets)
+
+Em vez de um atraso fixo entre mensagens, cada envio pede passagem a três
+baldes de tokens e sai assim que todos permitem:
+    global   mensagens por segundo do número (Cloud API: 80/s por padrão)
+    tier     destinatários novos em 24h (tier de mensagens da conta: 1k, 10k, 100k)
+    par      mensagens para o mesmo destinatário (1 a cada 6 s)
+
+Adapta-se às respostas da API:
+- Erros de throughput (130429, 80007, 4, 131048): reduz a taxa global pela
+  metade e pausa por alguns segundos; cada envio bem-sucedido devolve um
+  pouco da taxa até o teto configurado (AIMD)
+- Erro de par (131056): bloqueia só aquele destinatário, com espera dobrando
+  a cada repetição
+
+Destinatários que escreveram nas últimas 24h (janela de atendimento aberta)
+não consomem o tier.
+
+Configuração por variáveis de ambiente:
+    WHATSAPP_MPS            mensagens por segundo (padrão 80)
+    WHATSAPP_TIER_LIMIT     destinatários novos por 24h (padrão 1000; 0 = sem limite)
+    WHATSAPP_PAIR_INTERVAL  segundos entre mensagens ao mesmo destinatário (padrão 6)
+
+Uso:
+    scheduler = SendScheduler()
+    if scheduler.acquire(telefone, stop=evento_cancelamento):
+        resultado = client.send_text(telefone, texto)
+        scheduler.report(telefone, resultado.success, resultado.error_code)
+"""
+
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+DEFAULT_MPS = float(os.getenv('WHATSAPP_MPS', 80))
+DEFAULT_TIER_LIMIT = int(os.getenv('WHATSAPP_TIER_LIMIT', 1000))
+DEFAULT_PAIR_INTERVAL = float(os.getenv('WHATSAPP_PAIR_INTERVAL', 6))
+
+JANELA_24H = 24 * 3600
+
+# Limite de taxa da conta/número: reduz a taxa global
+THROUGHPUT_CODES = frozenset({4, 80007, 130429, 131048})
+# Limite por par (conta, destinatário): segura só o destinatário
+PAIR_CODES = frozenset({131056})
+
+
+def _chave(destinatario) -> str:
+    return re.sub(r'\D', '', str(destinatario or ''))
+
+
+class TokenBucket:
+    """Balde de tokens (não thread-safe; o SendScheduler serializa o acesso)"""
+
+    def __init__(self, rate: float, capacity: float, now: float = None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float, amount: float = 1.0) -> float:
+        """Segundos até haver `amount` tokens (0 se já há)"""
+        self._refill(now)
+        if self.tokens >= amount:
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (amount - self.tokens) / self.rate
+
+    def take(self, now: float, amount: float = 1.0):
+        self._refill(now)
+        self.tokens -= amount
+
+    def drain(self, now: float):
+        self._refill(now)
+        self.tokens = 0.0
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SendScheduler:
+    """Libera envios no ritmo máximo permitido pelos limites da API (thread-safe)"""
+
+    # error_code do resultado quando a espera foi interrompida (o envio não saiu)
+    CANCELLED = -4
+
+    def __init__(self, mps: float = DEFAULT_MPS, tier_limit: int = DEFAULT_TIER_LIMIT,
+                 pair_interval: float = DEFAULT_PAIR_INTERVAL, pair_burst: int = 1,
+                 cooldown: float = 5.0, min_mps: float = 1.0):
+        """
+        Args:
+            mps: Teto de mensagens por segundo
+            tier_limit: Destinatários novos por 24h (0 ou None = sem limite)
+            pair_interval: Segundos entre mensagens ao mesmo destinatário
+            pair_burst: Mensagens seguidas permitidas ao mesmo destinatário
+            cooldown: Pausa global após um erro de throughput (segundos)
+            min_mps: Piso da taxa adaptativa
+        """
+        now = time.monotonic()
+        self.max_mps = mps
+        self.min_mps = min(min_mps, mps)
+        self.tier_limit = tier_limit or 0
+        self.pair_interval = pair_interval
+        self.pair_burst = pair_burst
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._local = threading.local()
+        self._global = TokenBucket(mps, max(1.0, mps), now)
+        self._tier = TokenBucket(self.tier_limit / JANELA_24H, self.tier_limit, now) if self.tier_limit else None
+        self._pairs: Dict[str, TokenBucket] = {}
+        self._pair_blocked: Dict[str, float] = {}
+        self._pair_strikes: Dict[str, int] = {}
+        self._recent: Dict[str, float] = {}   # destinatário -> último envio/recebimento (janela 24h)
+        self._paused_until = 0.0
+        self._stats = {
+            'acquired': 0,
+            'waited_total_s': 0.0,
+            'throughput_limited': 0,
+            'pair_limited': 0,
+            'tier_waits': 0,
+            'cancelled': 0,
+        }
+
+    # ==================== ENVIO ====================
+
+    def acquire(self, destinatario, stop: threading.Event = None, timeout: float = None) -> bool:
+        """
+        Bloqueia até o envio para `destinatario` ser permitido e consome os tokens.
+        Retorna False se `stop` (ou o de cancel_on()) for sinalizado ou o timeout expirar.
+        """
+        if stop is None:
+            stop = getattr(self._local, 'stop', None)
+        chave = _chave(destinatario)
+        inicio = time.monotonic()
+        deadline = None if timeout is None else inicio + timeout
+        tier_esperado = False
+
+        with self._lock:
+            while True:
+                if stop is not None and stop.is_set():
+                    self._stats['cancelled'] += 1
+                    return False
+                now = time.monotonic()
+                espera, tier = self._wait_time(chave, now)
+                if espera <= 0:
+                    self._take(chave, now)
+                    self._stats['acquired'] += 1
+                    self._stats['waited_total_s'] += now - inicio
+                    return True
+                if tier and not tier_esperado:
+                    tier_esperado = True
+                    self._stats['tier_waits'] += 1
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    espera = min(espera, deadline - now)
+                # Acorda também em report()/open_window(), e a cada 0.25 s para checar `stop`
+                self._changed.wait(min(espera, 0.25))
+
+    @contextmanager
+    def cancel_on(self, stop: threading.Event):
+        """
+        Envios feitos nesta thread dentro do bloco desistem da espera quando
+        `stop` é sinalizado (para o cliente, que chama acquire() por conta própria):
+            with scheduler.cancel_on(evento_pausa):
+                client.send_text(...)
+        """
+        anterior = getattr(self._local, 'stop', None)
+        self._local.stop = stop
+        try:
+            yield
+        finally:
+            self._local.stop = anterior
+
+    def _wait_time(self, chave: str, now: float):
+        esperas = [self._paused_until - now, self._global.wait_time(now)]
+        esperas.append(self._pair_blocked.get(chave, 0.0) - now)
+        pair = self._pairs.get(chave)
+        if pair is not None:
+            esperas.append(pair.wait_time(now))
+        tier = 0.0
+        if self._tier is not None and not self._in_window(chave, now):
+            tier = self._tier.wait_time(now)
+            esperas.append(tier)
+        return max(esperas), tier > 0
+
+    def _take(self, chave: str, now: float):
+        self._global.take(now)
+        if self._tier is not None and not self._in_window(chave, now):
+            self._tier.take(now)
+        if chave:
+            pair = self._pairs.get(chave)
+            if pair is None:
+                pair = self._pairs[chave] = TokenBucket(1.0 / self.pair_interval, self.pair_burst, now)
+            pair.take(now)
+            self._recent[chave] = now
+        if len(self._pairs) > 10000:
+            self._prune(now)
+
+    def _in_window(self, chave: str, now: float) -> bool:
+        visto = self._recent.get(chave)
+        return visto is not None and now - visto < JANELA_24H
+
+    def _prune(self, now: float):
+        self._pairs = {k: b for k, b in self._pairs.items() if not b.full(now)}
+        self._pair_blocked = {k: t for k, t in self._pair_blocked.items() if t > now}
+        self._recent = {k: t for k, t in self._recent.items() if now - t < JANELA_24H}
+
+    # ==================== RETORNO DA API ====================
+
+    def report(self, destinatario, success: bool, error_code: Optional[int] = None) -> float:
+        """
+        Informa o resultado de um envio; ajusta as taxas.
+        Retorna quantos segundos esperar antes de repetir (0 se não foi limite de taxa).
+        """
+        chave = _chave(destinatario)
+        with self._lock:
+            now = time.monotonic()
+            espera = 0.0
+            if success:
+                self._pair_strikes.pop(chave, None)
+                if self._global.rate < self.max_mps:
+                    # Aumento aditivo: recupera o teto em ~max_mps envios
+                    self._global.rate = min(self.max_mps, self._global.rate + max(self.max_mps / 100, 0.1))
+            elif error_code in THROUGHPUT_CODES:
+                self._stats['throughput_limited'] += 1
+                self._global.rate = max(self.min_mps, self._global.rate / 2)
+                self._global.drain(now)
+                self._paused_until = max(self._paused_until, now + self.cooldown)
+                espera = self.cooldown
+                # A mensagem não saiu: devolve o token do destinatário para o retry
+                pair = self._pairs.get(chave)
+                if pair is not None:
+                    pair.tokens = min(pair.capacity, pair.tokens + 1)
+            elif error_code in PAIR_CODES:
+                self._stats['pair_limited'] += 1
+                strikes = self._pair_strikes.get(chave, 0) + 1
+                self._pair_strikes[chave] = strikes
+                espera = min(self.pair_interval * (2 ** strikes), 15 * 60)
+                self._pair_blocked[chave] = now + espera
+            self._changed.notify_all()
+            return espera
+
+    def open_window(self, destinatario):
+        """Destinatário escreveu para nós: respostas nas próximas 24h não consomem o tier"""
+        chave = _chave(destinatario)
+        if chave:
+            with self._lock:
+                self._recent[chave] = time.monotonic()
+                self._changed.notify_all()
+
+    @staticmethod
+    def is_rate_limited(error_code: Optional[int]) -> bool:
+        return error_code in THROUGHPUT_CODES or error_code in PAIR_CODES
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            now = time.monotonic()
+            stats = dict(self._stats)
+            stats['mps'] = round(self._global.rate, 2)
+            stats['max_mps'] = self.max_mps
+            stats['paused_s'] = round(max(0.0, self._paused_until - now), 2)
+            stats['tier_limit'] = self.tier_limit
+            if self._tier is not None:
+                self._tier.wait_time(now)  # atualiza os tokens
+            stats['tier_available'] = int(self._tier.tokens) if self._tier is not None else None
+            stats['pairs_blocked'] = sum(1 for t in self._pair_blocked.values() if t > now)
+        stats['waited_avg_s'] = round(stats['waited_total_s'] / stats['acquired'], 4) if stats['acquired'] else 0.0
+        stats['waited_total_s'] = round(stats['waited_total_s'], 3)
+        return stats
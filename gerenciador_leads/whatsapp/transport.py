@@ -0,0 +1,125 @@
+"""
+Transporte HTTP compartilhado pelos clientes WhatsApp (Cloud API e Z-API)
+e pelos clientes de IA do bot (Ollama, Gemini, OpenAI, Claude)
+
+Uma requests.Session por perfil ('whatsapp', 'whatsapp_agendado' e 'bot')
+em cada processo:
+- Conexões keep-alive reaproveitadas (sem novo handshake TCP/TLS a cada envio)
+- Pool de conexões por host com tamanho configurável
+- Retry com backoff exponencial no próprio adapter:
+    * falhas de conexão (a requisição não chegou ao servidor): todos os métodos
+    * 429 e 503 (o servidor recusou sem processar): respeita Retry-After
+    * timeout de leitura NÃO é repetido, para não duplicar um envio
+  No perfil 'whatsapp_agendado' (envios controlados por um SendScheduler) o
+  429 não é repetido: volta para o agendador, que reduz a taxa e reagenda.
+  No perfil 'bot' só falhas de conexão são repetidas: um 429/503 do provedor
+  de IA vai direto para o failover do roteador (bot/router.py).
+
+Configuração por variáveis de ambiente (lidas na importação):
+    WHATSAPP_HTTP_POOL_SIZE   conexões mantidas por host (padrão 16)
+    WHATSAPP_HTTP_RETRIES     tentativas extras (padrão 3)
+    WHATSAPP_HTTP_BACKOFF     fator do backoff em segundos (padrão 0.5)
+    BOT_HTTP_POOL_SIZE        conexões por host do perfil 'bot' (padrão 8)
+    BOT_HTTP_RETRIES          tentativas extras em falha de conexão (padrão 2)
+
+Ou em código, antes do primeiro envio:
+    configure_session(pool_size=32, retries=2)
+    configure_session('bot', pool_size=4)
+"""
+
+import os
+import threading
+from typing import Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_POOL_SIZE = int(os.getenv('WHATSAPP_HTTP_POOL_SIZE', 16))
+DEFAULT_RETRIES = int(os.getenv('WHATSAPP_HTTP_RETRIES', 3))
+DEFAULT_BACKOFF = float(os.getenv('WHATSAPP_HTTP_BACKOFF', 0.5))
+
+# Respostas em que o servidor recusou a requisição sem processá-la
+RETRY_STATUS = (429, 503)
+
+# Parâmetros padrão de cada sessão compartilhada
+PROFILES: Dict[str, Dict] = {
+    'whatsapp': {
+        'pool_size': DEFAULT_POOL_SIZE,
+        'retries': DEFAULT_RETRIES,
+        'backoff': DEFAULT_BACKOFF,
+        'retry_status': RETRY_STATUS,
+    },
+    'whatsapp_agendado': {
+        'pool_size': DEFAULT_POOL_SIZE,
+        'retries': DEFAULT_RETRIES,
+        'backoff': DEFAULT_BACKOFF,
+        'retry_status': (503,),
+    },
+    'bot': {
+        'pool_size': int(os.getenv('BOT_HTTP_POOL_SIZE', 8)),
+        'retries': int(os.getenv('BOT_HTTP_RETRIES', 2)),
+        'backoff': 0.0,
+        'retry_status': (),
+    },
+}
+
+_sessions: Dict[str, requests.Session] = {}
+_settings: Dict[str, Dict] = {}
+_lock = threading.Lock()
+
+
+def build_session(pool_size: int = DEFAULT_POOL_SIZE, retries: int = DEFAULT_RETRIES,
+                  backoff: float = DEFAULT_BACKOFF, retry_status=RETRY_STATUS) -> requests.Session:
+    """Cria uma Session com pool de conexões e retry/backoff no adapter"""
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries if retry_status else 0,
+        backoff_factor=backoff,
+        status_forcelist=retry_status,
+        allowed_methods=frozenset({'GET', 'POST', 'DELETE'}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(name: str = 'whatsapp') -> requests.Session:
+    """Sessão compartilhada do perfil no processo (criada na primeira chamada)"""
+    with _lock:
+        if name not in _sessions:
+            _settings[name] = dict(PROFILES[name])
+            _sessions[name] = build_session(**_settings[name])
+        return _sessions[name]
+
+
+def configure_session(name: str = 'whatsapp', pool_size: int = None, retries: int = None,
+                      backoff: float = None) -> requests.Session:
+    """
+    Recria a sessão compartilhada do perfil com novos parâmetros.
+    Clientes criados depois passam a usar a nova sessão.
+    """
+    with _lock:
+        settings = dict(PROFILES[name])
+        if pool_size is not None:
+            settings['pool_size'] = pool_size
+        if retries is not None:
+            settings['retries'] = retries
+        if backoff is not None:
+            settings['backoff'] = backoff
+        _sessions[name] = build_session(**settings)
+        _settings[name] = settings
+        return _sessions[name]
+
+
+def get_settings(name: str = 'whatsapp') -> Dict:
+    """Parâmetros da sessão compartilhada atual do perfil"""
+    with _lock:
+        return dict(_settings.get(name, {}))
@@ -10,6 +10,8 @@ from typing import Optional, Dict, List, Tuple
 from dataclasses import dataclass
 from enum import Enum
 
+from .transport import get_session
+
 
 class MessageStatus(Enum):
     PENDING = "pendente"
@@ -30,10 +32,15 @@ class SendResult:
 class ZAPIClient:
     """Cliente para interagir com a Z-API"""
     
-    def __init__(self, instance_id: str, token: str, client_token: str = None):
+    def __init__(self, instance_id: str, token: str, client_token: str = None,
+                 session: requests.Session = None, scheduler=None):
         self.instance_id = instance_id
         self.token = token
         self.client_token = client_token
+        # Sessão HTTP compartilhada (keep-alive, pool de conexões, retry no adapter)
+        self.session = session or get_session()
+        # Agendador de envios (whatsapp.scheduler); sem ele, enviar_em_massa usa intervalo aleatório
+        self.scheduler = scheduler
         self.base_url = f"https://api.z-api.io/instances/{instance_id}/token/{token}"
         
         # Headers - Client-Token é opcional mas recomendado para segurança
@@ -72,7 +79,7 @@ class ZAPIClient:
         """
         try:
             url = f"{self.base_url}/status"
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self.session.get(url, headers=self.headers, timeout=10)
             
             if response.status_code == 200:
                 data = response.json()
@@ -114,7 +121,7 @@ class ZAPIClient:
         try:
             numero = self._formatar_telefone(telefone)
             url = f"{self.base_url}/phone-exists/{numero}"
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self.session.get(url, headers=self.headers, timeout=10)
             data = response.json()
             
             exists = data.get("exists", False)
@@ -133,7 +140,7 @@ class ZAPIClient:
                 "message": mensagem
             }
             
-            response = requests.post(url, json=payload, headers=self.headers, timeout=30)
+            response = self.session.post(url, json=payload, headers=self.headers, timeout=30)
             data = response.json()
             
             if response.status_code == 200 and data.get("zapiMessageId"):
@@ -168,7 +175,7 @@ class ZAPIClient:
                 "caption": caption
             }
             
-            response = requests.post(url, json=payload, headers=self.headers, timeout=30)
+            response = self.session.post(url, json=payload, headers=self.headers, timeout=30)
             data = response.json()
             
             if response.status_code == 200 and data.get("zapiMessageId"):
@@ -203,7 +210,7 @@ class ZAPIClient:
                 "caption": caption
             }
             
-            response = requests.post(url, json=payload, headers=self.headers, timeout=60)
+            response = self.session.post(url, json=payload, headers=self.headers, timeout=60)
             data = response.json()
             
             if response.status_code == 200 and data.get("zapiMessageId"):
@@ -237,7 +244,7 @@ class ZAPIClient:
                 "fileName": nome_arquivo
             }
             
-            response = requests.post(url, json=payload, headers=self.headers, timeout=30)
+            response = self.session.post(url, json=payload, headers=self.headers, timeout=30)
             data = response.json()
             
             if response.status_code == 200 and data.get("zapiMessageId"):
@@ -275,7 +282,7 @@ class ZAPIClient:
                 "linkDescription": descricao
             }
             
-            response = requests.post(url, json=payload, headers=self.headers, timeout=30)
+            response = self.session.post(url, json=payload, headers=self.headers, timeout=30)
             data = response.json()
             
             if response.status_code == 200 and data.get("zapiMessageId"):
@@ -307,8 +314,8 @@ class ZAPIClient:
         Args:
             contatos: Lista de dicts com 'telefone', 'nome', 'cidade', etc.
             mensagem_template: Template da mensagem com variáveis {nome}, {cidade}
-            intervalo_min: Intervalo mínimo entre mensagens (segundos)
-            intervalo_max: Intervalo máximo entre mensagens (segundos)
+            intervalo_min: Intervalo mínimo entre mensagens (segundos; ignorado com scheduler)
+            intervalo_max: Intervalo máximo entre mensagens (segundos; ignorado com scheduler)
             callback: Função chamada após cada envio (progress, total, result)
         
         Returns:
@@ -332,6 +339,10 @@ class ZAPIClient:
             except KeyError:
                 mensagem = mensagem_template
             
+            # Com scheduler, o envio sai assim que os limites de taxa permitem
+            if self.scheduler:
+                self.scheduler.acquire(contato.get('telefone', ''))
+            
             # Enviar mensagem
             resultado = self.enviar_texto(contato.get('telefone', ''), mensagem)
             resultado.phone = contato.get('telefone', '')
@@ -342,7 +353,7 @@ class ZAPIClient:
                 callback(i + 1, total, resultado)
             
             # Aguardar intervalo aleatório (exceto no último)
-            if i < total - 1:
+            if i < total - 1 and not self.scheduler:
                 intervalo = random.randint(intervalo_min, intervalo_max)
                 time.sleep(intervalo)
         
@@ -352,7 +363,7 @@ class ZAPIClient:
         """Obtém o QR Code para conexão (se desconectado)"""
         try:
             url = f"{self.base_url}/qr-code/image"
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self.session.get(url, headers=self.headers, timeout=10)
             
             if response.status_code == 200:
                 return {
@@ -374,7 +385,7 @@ class ZAPIClient:
         """Desconecta a sessão do WhatsApp"""
         try:
             url = f"{self.base_url}/disconnect"
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self.session.get(url, headers=self.headers, timeout=10)
             return response.json()
         except Exception as e:
             return {"error": str(e)}
@@ -383,7 +394,7 @@ class ZAPIClient:
         """Reinicia a instância"""
         try:
             url = f"{self.base_url}/restart"
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self.session.get(url, headers=self.headers, timeout=10)
             return response.json()
         except Exception as e:
             return {"error": str(e)}